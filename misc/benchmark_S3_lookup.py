@@ -0,0 +1,59 @@
+import random
+import sys
+import time
+from os.path import join, abspath, dirname
+
+import pandas as pd
+from dateutil import parser
+
+import water_rights_visualizer
+from water_rights_visualizer.file_catalog import FileCatalog
+
+if len(sys.argv) > 1:
+    S3_table_filename = sys.argv[1]
+else:
+    S3_table_filename = join(abspath(dirname(water_rights_visualizer.__file__)), "S3_filenames.csv")
+
+lookups = 20
+
+S3_table = pd.read_csv(S3_table_filename)
+print(f"{len(S3_table)} rows in {S3_table_filename}")
+
+start_time = time.perf_counter()
+catalog = FileCatalog(pd.read_csv(S3_table_filename))
+index_seconds = time.perf_counter() - start_time
+print(f"parsed and indexed table once in {index_seconds:0.3f} seconds")
+
+start_time = time.perf_counter()
+FileCatalog.from_CSV(S3_table_filename)
+FileCatalog.from_CSV(S3_table_filename)
+cache_seconds = time.perf_counter() - start_time
+print(f"built and reloaded cached catalog in {cache_seconds:0.3f} seconds")
+
+keys = random.sample(list(catalog.index.keys()), min(lookups, len(catalog)))
+
+start_time = time.perf_counter()
+
+for tile, variable, date in keys:
+    date_str = f"{date:%Y-%m-%d}"
+    filtered_table = S3_table[
+        S3_table.apply(
+            lambda row: row.tile == tile
+            and row.variable == variable
+            and parser.parse(str(row.date)).date().strftime("%Y-%m-%d") == date_str,
+            axis=1,
+        )
+    ]
+    filename = str(filtered_table.iloc[0].filename)
+
+scan_seconds = (time.perf_counter() - start_time) / len(keys)
+print(f"table scan lookup: {scan_seconds * 1000:0.3f} ms")
+
+start_time = time.perf_counter()
+
+for tile, variable, date in keys * 1000:
+    filename = catalog.lookup(tile, variable, date)["filename"]
+
+index_seconds = (time.perf_counter() - start_time) / (len(keys) * 1000)
+print(f"indexed lookup: {index_seconds * 1000:0.6f} ms")
+print(f"speedup: {scan_seconds / index_seconds:0.0f}x")
@@ -0,0 +1,60 @@
+import sys
+import time
+from os.path import join, abspath, dirname
+
+import geopandas as gpd
+
+import water_rights_visualizer
+from water_rights_visualizer.constants import WGS84, ARD_TILES_FILENAME, TILE_SELECTION_BUFFER_RADIUS_DEGREES
+from water_rights_visualizer.select_tiles import load_tile_index, select_tiles, select_tiles_for_WKB
+
+if len(sys.argv) > 1:
+    ROI_filename = sys.argv[1]
+else:
+    ROI_filename = join(dirname(abspath(dirname(water_rights_visualizer.__file__))), "test_target.geojson")
+
+calls = 20
+
+ROI_latlon = gpd.read_file(ROI_filename).to_crs(WGS84).geometry[0]
+
+
+def select_tiles_from_file(target_geometry_latlon):
+    # selection as it was before the tile index was cached
+    tiles_df = gpd.read_file(ARD_TILES_FILENAME).to_crs(WGS84)
+    selection = tiles_df.intersects(target_geometry_latlon.buffer(TILE_SELECTION_BUFFER_RADIUS_DEGREES))
+
+    return [item[2:] for item in list(tiles_df[selection]["name"])]
+
+
+start_time = time.perf_counter()
+
+for i in range(calls):
+    file_tiles = select_tiles_from_file(ROI_latlon)
+
+file_rate = calls / (time.perf_counter() - start_time)
+print(f"reading tiles file: {file_rate:0.1f} calls per second")
+
+start_time = time.perf_counter()
+load_tile_index()
+print(f"loaded tile index once in {time.perf_counter() - start_time:0.3f} seconds")
+
+start_time = time.perf_counter()
+
+for i in range(calls * 100):
+    select_tiles_for_WKB.cache_clear()
+    index_tiles = select_tiles(ROI_latlon)
+
+index_rate = calls * 100 / (time.perf_counter() - start_time)
+print(f"querying tile index: {index_rate:0.1f} calls per second")
+
+start_time = time.perf_counter()
+
+for i in range(calls * 1000):
+    cached_tiles = select_tiles(ROI_latlon)
+
+cached_rate = calls * 1000 / (time.perf_counter() - start_time)
+print(f"memoized selection: {cached_rate:0.1f} calls per second")
+
+assert file_tiles == index_tiles == cached_tiles, (file_tiles, index_tiles, cached_tiles)
+print(f"selected tiles: {', '.join(cached_tiles)}")
+print(f"speedup: {index_rate / file_rate:0.0f}x indexed, {cached_rate / file_rate:0.0f}x memoized")
@@ -0,0 +1,94 @@
+"""
+Check windowed remote reads from S3Source against a local S3 stand-in.
+
+Runs a moto server, uploads a tiled and a striped GeoTIFF, and reads a small window of each through S3Source
+with remote_reads enabled. The tiled file should be read in place and the striped file should be downloaded.
+Requires moto with its server extras (pip install "moto[server]").
+"""
+import os
+import tempfile
+from datetime import date
+from os.path import join
+
+import boto3
+import numpy as np
+import rasterio
+from affine import Affine
+from moto.server import ThreadedMotoServer
+
+from raster import Raster, RasterGrid
+from water_rights_visualizer.S3_source import S3Source
+
+PORT = 5055
+BUCKET_NAME = "water-rights-tiles"
+REGION_NAME = "us-west-2"
+TILE = "012013"
+CRS = "EPSG:32613"
+TILE_SIZE = 2000
+
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+
+server = ThreadedMotoServer(port=PORT)
+server.start()
+endpoint_url = f"http://127.0.0.1:{PORT}"
+
+try:
+    working_directory = tempfile.mkdtemp()
+    bucket = boto3.resource("s3", endpoint_url=endpoint_url, region_name=REGION_NAME).Bucket(BUCKET_NAME)
+    bucket.create(CreateBucketConfiguration={"LocationConstraint": REGION_NAME})
+
+    image = np.random.rand(TILE_SIZE, TILE_SIZE).astype(np.float32)
+    tile_affine = Affine(30, 0, 300000, 0, -30, 4000000)
+    profile = dict(
+        driver="GTiff",
+        height=TILE_SIZE,
+        width=TILE_SIZE,
+        count=1,
+        dtype="float32",
+        crs=CRS,
+        transform=tile_affine,
+    )
+
+    files = {
+        date(2005, 3, 4): ("LC08_012013_20050304_ET.tif", dict(tiled=True, blockxsize=256, blockysize=256)),
+        date(2005, 3, 5): ("LC08_012013_20050305_ET.tif", {}),
+    }
+
+    table_filename = join(working_directory, "S3_filenames.csv")
+
+    with open(table_filename, "w") as table_file:
+        table_file.write("tile,variable,date,filename\n")
+
+        for acquisition_date, (filename_base, options) in files.items():
+            filename = join(working_directory, filename_base)
+
+            with rasterio.open(filename, "w", **profile, **options) as file:
+                file.write(image, 1)
+
+            bucket.upload_file(filename, filename_base)
+            table_file.write(f"{int(TILE)},ET,{acquisition_date},{filename_base}\n")
+
+    source = S3Source(
+        bucket_name=BUCKET_NAME,
+        region_name=REGION_NAME,
+        temporary_directory=join(working_directory, "temp"),
+        S3_table_filename=table_filename,
+        catalog_cache_directory=join(working_directory, "catalogs"),
+        remote_reads=True,
+        endpoint_url=endpoint_url,
+    )
+
+    row, col = 1000, 1000
+    target_geometry = RasterGrid.from_affine(
+        affine=tile_affine * Affine.translation(col, row), rows=20, cols=20, crs=CRS
+    )
+
+    for acquisition_date in files:
+        with source.get_filename(tile=TILE, variable_name="ET", acquisition_date=acquisition_date) as filename:
+            subset = Raster.open(filename, geometry=target_geometry)
+
+        matches = np.allclose(np.array(subset), image[row : row + 20, col : col + 20])
+        print(f"{acquisition_date} read from {filename}: {'matches' if matches else 'DOES NOT MATCH'}")
+finally:
+    server.stop()
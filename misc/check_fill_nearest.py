@@ -0,0 +1,91 @@
+"""
+Check the vectorized nearest fill in interpolate_stack against the original per-pixel interp1d version.
+
+Builds random stacks with a range of NaN densities, plus pixels that are entirely NaN, have a single valid
+value, or have exactly the minimum number of observations, and compares both implementations value for value.
+"""
+import numpy as np
+from scipy.interpolate import interp1d
+
+from water_rights_visualizer.interpolate_stack import MINIMUM_OBSERVATIONS, fill_nearest
+
+DAYS = 365
+ROWS = 40
+COLS = 50
+NAN_FRACTIONS = [0.0, 0.3, 0.7, 0.95, 0.99]
+SEED = 0
+
+
+def fill_nearest_per_pixel(stack: np.ndarray) -> np.ndarray:
+    """
+    The original per-pixel nearest interpolation, kept here as the reference.
+    """
+    days, rows, cols = stack.shape
+    filled_stack = np.full((days, rows, cols), np.nan, dtype=np.float32)
+    x = np.arange(days)
+
+    for row in range(rows):
+        for col in range(cols):
+            pixel_timeseries = stack[:, row, col]
+            known_indices = ~np.isnan(pixel_timeseries)
+            known_days = x[known_indices]
+
+            if len(known_days) < MINIMUM_OBSERVATIONS:
+                continue
+
+            f = interp1d(known_days, pixel_timeseries[known_indices], axis=0, kind="nearest", fill_value="extrapolate")
+            filled_stack[:, row, col] = f(x)
+
+    return filled_stack
+
+
+def random_stack(rng: np.random.Generator, nan_fraction: float) -> np.ndarray:
+    stack = rng.random((DAYS, ROWS, COLS)).astype(np.float32)
+    stack[rng.random(stack.shape) < nan_fraction] = np.nan
+
+    # all-NaN pixels
+    stack[:, 0, :] = np.nan
+
+    # pixels with a single valid value, including at the first and last day
+    stack[:, 1, :] = np.nan
+    stack[rng.integers(0, DAYS, COLS), 1, np.arange(COLS)] = 1.0
+    stack[:, 2, :] = np.nan
+    stack[0, 2, : COLS // 2] = 2.0
+    stack[DAYS - 1, 2, COLS // 2 :] = 2.0
+
+    # pixels just below and exactly at the minimum number of observations
+    for row, count in ((3, MINIMUM_OBSERVATIONS - 1), (4, MINIMUM_OBSERVATIONS)):
+        stack[:, row, :] = np.nan
+
+        for col in range(COLS):
+            days = rng.choice(DAYS, count, replace=False)
+            stack[days, row, col] = rng.random(count)
+
+    # evenly spaced observations, so every gap has a tie in the middle
+    stack[:, 5, :] = np.nan
+    stack[::4, 5, :] = rng.random((len(range(0, DAYS, 4)), COLS))
+
+    return stack
+
+
+rng = np.random.default_rng(SEED)
+failures = 0
+
+for nan_fraction in NAN_FRACTIONS:
+    stack = random_stack(rng, nan_fraction)
+    expected = fill_nearest_per_pixel(stack)
+    actual = fill_nearest(stack)
+
+    matches = np.array_equal(expected, actual, equal_nan=True)
+    mismatched_pixels = np.count_nonzero(
+        np.any(~((expected == actual) | (np.isnan(expected) & np.isnan(actual))), axis=0)
+    )
+    print(f"NaN fraction {nan_fraction:.2f}: {'match' if matches else f'{mismatched_pixels} pixels differ'}")
+
+    if not matches:
+        failures += 1
+
+if failures:
+    raise SystemExit(f"fill_nearest differs from the per-pixel version for {failures} of {len(NAN_FRACTIONS)} stacks")
+
+print("fill_nearest matches the per-pixel version")
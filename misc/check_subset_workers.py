@@ -0,0 +1,130 @@
+"""
+Check that generating the subsets of a stack in worker processes gives the same stack as generating them serially.
+
+Writes synthetic daily (2005) and monthly (2010) tiles for the tiles under the test target into a FilepathSource
+directory, then generates the stack of each year with subset_workers=1, which reads the subsets in batches of
+dates, and with several worker processes, which read each date on its own. The ET and PET stacks and their
+affine transforms should be identical.
+"""
+import tempfile
+from datetime import date, timedelta
+from os import makedirs
+from os.path import abspath, dirname, join
+
+import geopandas as gpd
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+from water_rights_visualizer.constants import UTM, WGS84
+from water_rights_visualizer.file_path_source import FilepathSource
+from water_rights_visualizer.generate_stack import generate_stack
+from water_rights_visualizer.select_tiles import select_tiles
+
+ROI_FILENAME = join(dirname(dirname(abspath(__file__))), "test_target.geojson")
+ROI_NAME = "test_target"
+ROI_ACRES = 50.0
+DAILY_YEAR = 2005
+MONTHLY_YEAR = 2010
+SUBSET_WORKERS = 4
+TILE_SIZE = 300
+CELL_SIZE = 30
+# UTM zone 13 origin of a tile grid covering the test target
+TILE_ORIGIN = (670000, 3805000)
+NAN_FRACTION = 0.3
+SEED = 0
+
+rng = np.random.default_rng(SEED)
+
+
+def write_tile(filename: str):
+    image = (rng.random((TILE_SIZE, TILE_SIZE)) * 5).astype(np.float32)
+    image[rng.random(image.shape) < NAN_FRACTION] = np.nan
+
+    with rasterio.open(
+        filename,
+        "w",
+        driver="GTiff",
+        height=TILE_SIZE,
+        width=TILE_SIZE,
+        count=1,
+        dtype="float32",
+        crs=UTM,
+        transform=from_origin(*TILE_ORIGIN, CELL_SIZE, CELL_SIZE),
+        nodata=np.nan,
+    ) as file:
+        file.write(image, 1)
+
+
+ROI_latlon = gpd.read_file(ROI_FILENAME).to_crs(WGS84).geometry[0]
+tiles = select_tiles(ROI_latlon)
+working_directory = tempfile.mkdtemp()
+source_directory = join(working_directory, "source")
+makedirs(join(source_directory, "monthly"))
+
+# daily ET and ESI on roughly every other day of the daily year
+date_step = date(DAILY_YEAR, 1, 1)
+
+while date_step.year == DAILY_YEAR:
+    if rng.random() < 0.5:
+        date_directory = join(source_directory, f"{date_step:%Y.%m.%d}")
+        makedirs(date_directory)
+
+        for tile in tiles:
+            for variable in ("ET", "ESI"):
+                write_tile(join(date_directory, f"LC08_{tile}_{date_step:%Y%m%d}_{variable}.tif"))
+
+    date_step += timedelta(days=1)
+
+# monthly ET and ETO for every month of the monthly year
+for month in range(1, 13):
+    for tile in tiles:
+        for variable in ("ET", "ETO"):
+            write_tile(join(source_directory, "monthly", f"OPENET_ENSEMBLE_{tile}_{MONTHLY_YEAR}{month:02d}01_{variable}.tif"))
+
+input_datastore = FilepathSource(source_directory)
+years_available, dates_available = input_datastore.inventory()
+failures = []
+
+for year in (DAILY_YEAR, MONTHLY_YEAR):
+    stacks = {}
+
+    for subset_workers in (1, SUBSET_WORKERS):
+        run_directory = join(working_directory, f"{year}_{subset_workers}")
+
+        ET_stack, PET_stack, affine = generate_stack(
+            ROI_name=ROI_NAME,
+            ROI_latlon=ROI_latlon,
+            year=year,
+            ROI_acres=ROI_ACRES,
+            input_datastore=input_datastore,
+            subset_directory=join(run_directory, "subset"),
+            dates_available=dates_available,
+            stack_filename=join(run_directory, "stack", f"{year}.h5"),
+            target_CRS=WGS84,
+            subset_workers=subset_workers,
+            use_stack_cache=False,
+        )
+
+        stacks[subset_workers] = (np.asarray(ET_stack), np.asarray(PET_stack), affine)
+
+    serial_ET, serial_PET, serial_affine = stacks[1]
+    parallel_ET, parallel_PET, parallel_affine = stacks[SUBSET_WORKERS]
+
+    for name, matches in (
+        ("ET", np.array_equal(serial_ET, parallel_ET, equal_nan=True)),
+        ("PET", np.array_equal(serial_PET, parallel_PET, equal_nan=True)),
+        ("affine", serial_affine == parallel_affine),
+    ):
+        print(f"{year} {name}: {'match' if matches else 'differs'}")
+
+        if not matches:
+            failures.append(f"{year} {name}")
+
+    if np.all(np.isnan(serial_ET)):
+        failures.append(f"{year} ET is empty")
+
+if failures:
+    raise SystemExit(f"serial and parallel stacks differ: {', '.join(failures)}")
+
+print(f"stacks generated with 1 and {SUBSET_WORKERS} subset workers match")
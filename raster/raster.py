@@ -15,6 +15,7 @@ import warnings
 from abc import abstractmethod
 from collections import OrderedDict
 from collections.abc import Iterable
+from itertools import groupby
 from os import makedirs
 from os.path import dirname, exists, abspath, expanduser, splitext
 from typing import List, Tuple, Iterator, Union, Any, Optional
@@ -775,6 +776,102 @@ class KDTree:
         return output_raster
 
 
+# number of source and target grid pairs whose nearest neighbour warps are remembered, 0 to disable
+REPROJECTION_PLAN_CACHE_SIZE = 64
+
+
+class ReprojectionPlan:
+    """
+    Precomputed nearest neighbour warp from a source grid to a target grid.
+    The source pixel of each target pixel is found once by warping an array of pixel indices with GDAL,
+    so applying the plan to data on the same source grid is a NumPy gather with the same result as reprojecting it.
+    """
+    _cache = OrderedDict()
+
+    def __init__(
+            self,
+            src_transform: Affine,
+            src_shape: Tuple[int, int],
+            src_crs: Union[CRS, str],
+            dst_transform: Affine,
+            dst_shape: Tuple[int, int],
+            dst_crs: Union[CRS, str]):
+        self.src_shape = tuple(src_shape)
+        self.dst_shape = tuple(dst_shape)
+
+        source_indices = np.arange(self.src_shape[0] * self.src_shape[1], dtype=np.int32).reshape(self.src_shape)
+        destination_indices = np.empty(self.dst_shape, np.int32)
+
+        with rasterio.Env():
+            reproject(
+                source_indices,
+                destination_indices,
+                src_transform=src_transform,
+                src_crs=CRS(src_crs),
+                src_nodata=-1,
+                dst_transform=dst_transform,
+                dst_crs=CRS(dst_crs),
+                dst_nodata=-1,
+                resampling=Resampling.nearest
+            )
+
+        self.valid = destination_indices >= 0
+        self.indices = destination_indices[self.valid].astype(np.intp)
+
+    @classmethod
+    def key(cls, src_transform, src_shape, src_crs, dst_transform, dst_shape, dst_crs) -> tuple:
+        return (
+            tuple(src_transform),
+            tuple(src_shape),
+            str(src_crs),
+            tuple(dst_transform),
+            tuple(dst_shape),
+            str(dst_crs)
+        )
+
+    @classmethod
+    def get(cls, src_transform, src_shape, src_crs, dst_transform, dst_shape, dst_crs) -> ReprojectionPlan:
+        """
+        Get the plan of a warp, computing it only the first time the pair of grids is seen.
+        """
+        key = cls.key(src_transform, src_shape, src_crs, dst_transform, dst_shape, dst_crs)
+
+        if key in cls._cache:
+            cls._cache.move_to_end(key)
+            return cls._cache[key]
+
+        plan = cls(src_transform, src_shape, src_crs, dst_transform, dst_shape, dst_crs)
+        cls._cache[key] = plan
+
+        while len(cls._cache) > REPROJECTION_PLAN_CACHE_SIZE:
+            cls._cache.popitem(last=False)
+
+        return plan
+
+    @classmethod
+    def clear(cls):
+        cls._cache.clear()
+
+    def apply(self, source: np.ndarray, nodata: Any, dtype=None) -> np.ndarray:
+        """
+        Warp data on the source grid to the target grid, filling target pixels outside the source with nodata.
+        The source may have leading dimensions, such as one layer per date, which are all warped at once.
+        """
+        source = np.asarray(source)
+
+        if source.shape[-2:] != self.src_shape:
+            raise ValueError(f"source shape {source.shape} does not match plan shape {self.src_shape}")
+
+        if dtype is None:
+            dtype = source.dtype
+
+        leading_shape = source.shape[:-2]
+        destination = np.full(leading_shape + self.dst_shape, nodata, dtype=dtype)
+        destination[..., self.valid] = source.reshape(leading_shape + (-1,))[..., self.indices]
+
+        return destination
+
+
 class RasterGeometry(SpatialGeometry):
     """
     This is the base class for encapsulating a raster's geography.
@@ -3081,7 +3178,8 @@ class Raster:
         if filename.startswith("~"):
             filename = expanduser(filename)
 
-        if ":" not in filename and not exists(filename):
+        # GDAL virtual file systems such as /vsis3/ can't be checked locally
+        if ":" not in filename and not filename.startswith("/vsi") and not exists(filename):
             raise IOError(f"raster file not found: {filename}")
 
         source_geometry = RasterGrid.open(filename)
@@ -3142,22 +3240,26 @@ class Raster:
             dtype = images[0].dtype
 
         if "float" in str(dtype):
-            composite_sum = Raster(np.full(geometry.shape, 0, dtype=dtype), geometry=geometry)
-            composite_count = Raster(np.full(geometry.shape, 0, dtype=np.uint16), geometry=geometry)
+            composite_sum = np.full(geometry.shape, 0, dtype=dtype)
+            composite_count = np.full(geometry.shape, 0, dtype=np.uint16)
 
+            # accumulate each image in place instead of allocating new sums and counts for every image
             for image in images:
-                projected_image = image.to_geometry(geometry)
-                composite_sum = where(np.isnan(projected_image), composite_sum, composite_sum + projected_image)
-                projected_tile_count = where(np.isnan(projected_image), 0, 1)
-                composite_count = composite_count + projected_tile_count
+                projected_image = np.asarray(image.to_geometry(geometry).array)
+                valid = ~np.isnan(projected_image)
+                np.add(composite_sum, projected_image, out=composite_sum, where=valid)
+                composite_count += valid
 
+            composite_sum = Raster(composite_sum, geometry=geometry)
             composite_image = where(composite_count > 0, composite_sum / composite_count, np.nan)
         else:
-            composite_image = Raster(np.full(geometry.shape, 0), geometry=geometry)
+            composite_image = np.full(geometry.shape, 0)
 
             for image in images:
-                projected_image = image.to_geometry(geometry)
-                composite_image = where(np.isnan(projected_image), composite_image, projected_image)
+                projected_image = np.asarray(image.to_geometry(geometry).array)
+                np.copyto(composite_image, projected_image, where=~np.isnan(projected_image))
+
+            composite_image = Raster(composite_image, geometry=geometry)
 
         return composite_image
 
@@ -3290,6 +3392,10 @@ class Raster:
                 Raster._raise_unrecognized_key(key)
 
     def __getattr__(self, item):
+        # nothing to delegate to before the array is set, such as while unpickling
+        if "_array" not in self.__dict__:
+            raise AttributeError(item)
+
         if hasattr(self.array, item):
             result = getattr(self.array, item)
 
@@ -3655,10 +3761,6 @@ class Raster:
         src_transform = self.geometry.affine
         dst_transform = grid.affine
 
-        # define coordinate reference systems
-        src_crs = CRS(self.crs)
-        dst_crs = CRS(grid.crs)
-
         destination_dtype = self.dtype
 
         if nodata is None:
@@ -3684,6 +3786,21 @@ class Raster:
         if str(self.dtype) == "bool":
             source = source.astype(np.uint16)
 
+        # nearest neighbour warps between grids that have been seen before are a gather of precomputed indices
+        if resampling == Resampling.nearest and not kwargs and dst_nodata is not None and \
+                source.size < np.iinfo(np.int32).max and REPROJECTION_PLAN_CACHE_SIZE > 0:
+            plan = ReprojectionPlan.get(src_transform, source.shape, self.crs, dst_transform, grid.shape, grid.crs)
+            destination = plan.apply(source, dst_nodata, dtype=destination_dtype)
+
+            if self.dtype != destination.dtype:
+                destination = destination.astype(self.dtype)
+
+            return self.contain(destination, geometry=grid)
+
+        # define coordinate reference systems
+        src_crs = CRS(self.crs)
+        dst_crs = CRS(grid.crs)
+
         # resample to destination array
         with rasterio.Env():
             try:
@@ -4728,6 +4845,18 @@ def where(condition, x, y):
     else:
         return Raster(result, geometry=geometry, cmap=cmap, metadata=metadata, nodata=nodata)
 
+def fill_missing(target: Union[Raster, np.ndarray], source: Union[Raster, np.ndarray]) -> Union[Raster, np.ndarray]:
+    """
+    Fill the missing values of a float array or raster in place with the values of another of the same shape,
+    such as the next tile of a mosaic, without allocating a new array as where does. Returns the target.
+    """
+    target_array = target.array if isinstance(target, Raster) else target
+    source_array = source.array if isinstance(source, Raster) else np.asarray(source)
+    np.copyto(target_array, source_array, where=np.isnan(target_array))
+
+    return target
+
+
 def clip(a: Raster or np.ndarray, a_min, a_max, out=None, **kwargs) -> Raster or np.ndarray:
     if a_min is None and a_max is None:
         return a
@@ -4745,8 +4874,88 @@ def clip(a: Raster or np.ndarray, a_min, a_max, out=None, **kwargs) -> Raster or
         
     return result
 
+def read_cube(
+        filenames: List[str],
+        geometry: RasterGrid,
+        resampling: str = None,
+        buffer: int = None) -> np.ndarray:
+    """
+    Read single-band files on the same grid, such as the dates of one tile, into a (files, rows, cols) cube
+    on a target grid, with the same values as opening each file with Raster.open(filename, geometry=geometry).
+    Only the window covering the target grid is read from each file, and the window is found once for each source grid.
+    Nearest neighbour warps of files sharing a grid are applied to all of them at once with one reprojection plan.
+    """
+    if resampling is None:
+        resampling = "nearest"
+
+    layers = []
+    source_key = None
+    window = None
+
+    for filename in filenames:
+        with rasterio.open(filename, "r") as file:
+            if file.count != 1:
+                raise IOError(f"raster file with {file.count} bands is not single-band: {filename}")
+
+            file_key = (tuple(file.transform), file.height, file.width, str(file.crs))
+
+            if file_key != source_key:
+                source_key = file_key
+                window = RasterGrid.from_rasterio(file).window(geometry=geometry, buffer=buffer)
+
+            data = file.read(1, window=window)
+            rows, cols = data.shape
+            window_grid = RasterGrid.from_affine(file.window_transform(window), rows, cols, file.crs)
+
+            layers.append((Raster(data, window_grid, nodata=file.nodata), file_key, tuple(window.flatten())))
+
+    cube = []
+
+    for (file_key, window_key), group in groupby(layers, key=lambda layer: layer[1:]):
+        images = [image for image, _, _ in group]
+        first_image = images[0]
+        nodata = first_image.nodata
+        float_layers = first_image.dtype in (np.float32, np.float64)
+
+        if nodata is None and float_layers:
+            nodata = np.nan
+
+        shared_warp = (
+            resampling == "nearest" and
+            REPROJECTION_PLAN_CACHE_SIZE > 0 and
+            nodata is not None and
+            str(first_image.dtype) != "bool" and
+            first_image.geometry != geometry and
+            all(image.nodata is first_image.nodata or image.nodata == first_image.nodata for image in images)
+        )
+
+        if shared_warp:
+            plan = ReprojectionPlan.get(
+                first_image.geometry.affine,
+                first_image.shape,
+                first_image.crs,
+                geometry.affine,
+                geometry.shape,
+                geometry.crs
+            )
+
+            warped = plan.apply(np.stack([image.array for image in images]), nodata)
+
+            if float_layers and not np.isnan(nodata):
+                warped = np.where(warped == nodata, np.nan, warped)
+
+            cube.append(warped)
+        else:
+            cube.append(np.stack([image.to_geometry(geometry, resampling=resampling).array for image in images]))
+
+    if len(cube) == 0:
+        return np.empty((0,) + tuple(geometry.shape), dtype=np.float32)
+
+    return np.concatenate(cube)
+
+
 def mosaic(images: Iterator[Union[Raster, str]], geometry: RasterGeometry) -> Raster:
-    mosaic = Raster(np.full(geometry.shape, np.nan), geometry=geometry)
+    mosaic = np.full(geometry.shape, np.nan)
     dtype = None
     nodata = None
     metadata = None
@@ -4758,7 +4967,7 @@ def mosaic(images: Iterator[Union[Raster, str]], geometry: RasterGeometry) -> Ra
         dtype = image.dtype
         nodata = image.nodata
         metadata = image.metadata
-        mosaic = raster.where(np.isnan(mosaic), image.to_geometry(geometry), mosaic)
+        fill_missing(mosaic, image.to_geometry(geometry))
 
     mosaic = mosaic.astype(dtype)
     mosaic = Raster(mosaic, geometry=geometry, nodata=nodata, metadata=metadata)
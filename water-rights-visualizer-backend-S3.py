@@ -29,6 +29,39 @@ if not aws_profile:
 
 delete_temp_files = True
 
+# shared cache of downloaded tiles, disabled unless a directory is given
+tile_cache_directory = os.environ.get("S3_TILE_CACHE_DIRECTORY", None)
+if not tile_cache_directory:
+    tile_cache_directory = None
+
+tile_cache_size_GB = os.environ.get("S3_TILE_CACHE_SIZE_GB", None)
+tile_cache_size = int(float(tile_cache_size_GB) * 1024**3) if tile_cache_size_GB else None
+
+# read only the window around the ROI from tiled files instead of downloading whole tiles
+remote_reads = os.environ.get("S3_REMOTE_READS", "false").lower() in ("1", "true", "yes")
+
+# number of files downloaded at once before each year is processed, 0 to disable prefetching
+prefetch_concurrency = os.environ.get("S3_PREFETCH_CONCURRENCY", None)
+prefetch_concurrency = int(prefetch_concurrency) if prefetch_concurrency else None
+
+# number of processes generating the subsets of each date
+subset_workers = os.environ.get("SUBSET_WORKERS", None)
+subset_workers = int(subset_workers) if subset_workers else None
+
+# number of years processed at once, further limited by CPUs and memory
+year_workers = os.environ.get("YEAR_WORKERS", None)
+year_workers = int(year_workers) if year_workers else None
+
+# memory the stacks of each year may take before they're processed in blocks of rows
+stack_memory_budget_GB = os.environ.get("STACK_MEMORY_BUDGET_GB", None)
+stack_memory_budget = int(float(stack_memory_budget_GB) * 1024**3) if stack_memory_budget_GB else None
+
+# subset cache shared between runs and users, so a field that's been run before only processes new inputs
+subset_cache_directory = os.environ.get("SUBSET_CACHE_DIRECTORY", None)
+
+# write the subsets of each year as GeoTIFFs for debugging, instead of only keeping them in memory
+export_subsets = os.environ.get("EXPORT_SUBSETS", "false").lower() in ("1", "true", "yes")
+
 
 def build_mongo_client_and_collection():
     # todo: read from ENV vars and then use defaults if not available
@@ -102,6 +135,10 @@ def main(argv=sys.argv):
         remove_temporary_files=delete_temp_files,
         aws_profile=aws_profile,
         region_name="us-west-2",
+        tile_cache_directory=tile_cache_directory,
+        tile_cache_size=tile_cache_size,
+        remote_reads=remote_reads,
+        prefetch_concurrency=prefetch_concurrency,
     )
 
     session = boto3.Session()
@@ -110,7 +147,6 @@ def main(argv=sys.argv):
 
     start_year = int(start_year)
     end_year = int(end_year)
-    years = range(start_year, end_year + 1)
 
     start_time = time.time()
 
@@ -120,28 +156,46 @@ def main(argv=sys.argv):
         start_year = record["paused_year"]
         write_status(status_filename, f"resuming {name} from {start_year}")
 
-    for year in years:
-        # Check if the job is paused, if so stop the job
+    years = range(start_year, end_year + 1)
+    paused_year = None
+
+    def before_year(year: int) -> bool:
+        nonlocal paused_year
+
+        # Check if the job is paused, if so stop starting years and let the years already running finish
         record = report_queue.find_one({"key": key})
         if record is not None and record["status"] == "Paused":
             write_status(status_filename, f"job paused for {name} at {year}")
             # Update record to say we paused at this year and clear pid
             report_queue.update_one({"key": key}, {"$set": {"status": "Paused", "paused_year": year, "pid": None}})
-            return
+            paused_year = year
+            return False
         elif record is not None:
             report_queue.update_one({"key": key}, {"$set": {"last_generated_year": year}})
 
         write_status(status_filename, f"processing {name} for {year}")
 
-        water_rights_visualizer(
-            boundary_filename=geojson_filename,
-            input_datastore=input_datastore,
-            output_directory=output_directory,
-            figure_directory=figure_directory,
-            monthly_means_directory=monthly_means_directory,
-            start_year=year,
-            end_year=year,
-        )
+        return True
+
+    water_rights_visualizer(
+        boundary_filename=geojson_filename,
+        input_datastore=input_datastore,
+        output_directory=output_directory,
+        figure_directory=figure_directory,
+        monthly_means_directory=monthly_means_directory,
+        start_year=start_year,
+        end_year=end_year,
+        subset_workers=subset_workers,
+        year_workers=year_workers,
+        before_year=before_year,
+        stack_memory_budget=stack_memory_budget,
+        subset_cache_directory=subset_cache_directory,
+        export_subsets=export_subsets,
+    )
+
+    for year in years:
+        if paused_year is not None and year >= paused_year:
+            return
 
         # check and upload the png file to s3
         figure_output_filename = join(output_directory, "figures", name, f"{year}_{name}.png")
@@ -1,13 +1,17 @@
 import contextlib
 import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from urllib.parse import urlparse
 from os import makedirs
 from os import remove
-from os.path import join, abspath, dirname, exists, expanduser
+from os.path import join, abspath, dirname, exists, expanduser, getsize
+from typing import Callable, Tuple, Union
 
 import boto3
 
-import pandas as pd
 from dateutil import parser
 import logging
 import cl
@@ -18,6 +22,8 @@ import raster as rt
 
 from .errors import FileUnavailable
 from .data_source import DataSource
+from .file_catalog import FileCatalog
+from .tile_cache import TileCache
 from .variable_types import get_available_variable_source_for_date, get_available_variables_for_date
 
 # from .google_drive import google_drive_login
@@ -25,6 +31,19 @@ from .variable_types import get_available_variable_source_for_date, get_availabl
 logger = logging.getLogger(__name__)
 
 REMOVE_TEMPORARY_FILES = True
+PREFETCH_CONCURRENCY = 8
+# bytes of files prefetched at once into the temporary directory, which has no size limit of its own
+PREFETCH_MAX_BYTES = 4 * 1024**3
+# share of the tile cache that prefetched files may take, leaving room for the files read as they're needed
+PREFETCH_TILE_CACHE_FRACTION = 0.5
+
+# options for reading windows of remote files without listing the bucket or fetching whole files
+REMOTE_READ_OPTIONS = {
+    "GDAL_DISABLE_READDIR_ON_OPEN": "EMPTY_DIR",
+    "CPL_VSIL_CURL_ALLOWED_EXTENSIONS": ".tif,.TIF,.tiff",
+    "GDAL_HTTP_MERGE_CONSECUTIVE_RANGES": "YES",
+    "GDAL_HTTP_MULTIRANGE": "YES",
+}
 
 
 def read_geometry(S3_URL: str, session: boto3.session.Session = None) -> raster.RasterGeometry:
@@ -54,6 +73,22 @@ def read_subset(S3_URL: str, geometry: raster.RasterGeometry, session: boto3.ses
     return subset
 
 
+def connect_bucket(
+    bucket_name: str, region_name: str = None, aws_profile: str = None, endpoint_url: str = None
+) -> (boto3.Session, object):
+    """
+    Open a boto3 session and the S3 bucket resource it reads from.
+    """
+    if aws_profile is not None:
+        session = boto3.Session(profile_name=aws_profile)
+    else:
+        session = boto3.Session()
+
+    bucket = session.resource("s3", region_name=region_name, endpoint_url=endpoint_url).Bucket(bucket_name)
+
+    return session, bucket
+
+
 class S3Source(DataSource):
     def __init__(
         self,
@@ -63,6 +98,13 @@ class S3Source(DataSource):
         S3_table_filename: str = None,
         remove_temporary_files: bool = None,
         aws_profile: str = None,
+        catalog_cache_directory: str = None,
+        tile_cache_directory: str = None,
+        tile_cache_size: int = None,
+        remote_reads: bool = False,
+        endpoint_url: str = None,
+        prefetch_concurrency: int = None,
+        prefetch_max_bytes: int = None,
     ):
         if remove_temporary_files is None:
             remove_temporary_files = REMOVE_TEMPORARY_FILES
@@ -70,6 +112,9 @@ class S3Source(DataSource):
         if temporary_directory is None:
             temporary_directory = "temp"
 
+        if prefetch_concurrency is None:
+            prefetch_concurrency = PREFETCH_CONCURRENCY
+
         temporary_directory = abspath(expanduser(temporary_directory))
 
         logger.info(f"S3 temporary directory: {temporary_directory}")
@@ -79,108 +124,160 @@ class S3Source(DataSource):
         if S3_table_filename is None:
             S3_table_filename = join(abspath(dirname(__file__)), "S3_filenames.csv")
 
-        S3_table = pd.read_csv(S3_table_filename)
+        catalog = FileCatalog.from_CSV(S3_table_filename, cache_directory=catalog_cache_directory)
+
+        session, bucket = connect_bucket(bucket_name, region_name, aws_profile, endpoint_url)
 
-        if aws_profile is not None:
-            session = boto3.Session(profile_name=aws_profile)
+        if tile_cache_directory is not None:
+            tile_cache = TileCache(tile_cache_directory, max_size_bytes=tile_cache_size)
+            logger.info(f"S3 tile cache: {cl.dir(tile_cache.directory)}")
         else:
-            session = boto3.Session()
+            tile_cache = None
 
-        bucket = session.resource("s3", region_name=region_name).Bucket(bucket_name)
+        # prefetched files beyond the size of the tile cache would be evicted before they're read
+        if prefetch_max_bytes is None and tile_cache is not None:
+            prefetch_max_bytes = int(tile_cache.max_size_bytes * PREFETCH_TILE_CACHE_FRACTION)
+        elif prefetch_max_bytes is None:
+            prefetch_max_bytes = PREFETCH_MAX_BYTES
 
         self.bucket_name = bucket_name
         self.bucket = bucket
+        # boto3 clients can be shared between threads, unlike resources
+        self.client = bucket.meta.client
         self.region_name = region_name
+        self.aws_profile = aws_profile
         self.temporary_directory = temporary_directory
-        self.S3_table = S3_table
+        self.catalog = catalog
+        self.S3_table = catalog.table
         self.filenames = {}
         self.remove_temporary_files = remove_temporary_files
+        self.tile_cache = tile_cache
+        self.session = session
+        self.endpoint_url = endpoint_url
+        self.remote_reads = remote_reads
+        self.remote_tiled = {}
+        self.prefetch_concurrency = prefetch_concurrency
+        self.prefetch_max_bytes = prefetch_max_bytes
+
+    def __getstate__(self) -> dict:
+        # boto3 sessions can't be pickled, so worker processes open their own
+        state = self.__dict__.copy()
+
+        for name in ("session", "bucket", "client"):
+            state.pop(name, None)
+
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self.session, self.bucket = connect_bucket(
+            self.bucket_name, self.region_name, self.aws_profile, self.endpoint_url
+        )
+        self.client = self.bucket.meta.client
 
     def inventory(self):
         dates_available = []
-        for date in self.S3_table.date:
-            try:
-                available_date = parser.parse(str(date)).date()
-                # Check variables to see if we care about this date
-                variables = get_available_variables_for_date(available_date)
-                if len(variables) > 0:
-                    if available_date.day == 1:
-                        dates_available.append(available_date)
-                    else:
-                        # If it's not the first of the month, make sure we have a non-monthly data source
-                        for variable in variables:
-                            if not variable.monthly:
-                                dates_available.append(available_date)
-                                break
-            except Exception as e:
-                logger.warning(e)
-                logger.warning(f"unable to parse date: {date}")
+        for available_date in self.catalog.dates:
+            # Check variables to see if we care about this date
+            variables = get_available_variables_for_date(available_date)
+            if len(variables) > 0:
+                if available_date.day == 1:
+                    dates_available.append(available_date)
+                else:
+                    # If it's not the first of the month, make sure we have a non-monthly data source
+                    for variable in variables:
+                        if not variable.monthly:
+                            dates_available.append(available_date)
+                            break
         years_available = list(set(sorted([date_step.year for date_step in dates_available])))
 
         return years_available, dates_available
 
-    @contextlib.contextmanager
-    def get_filename(self, tile: str, variable_name: str, acquisition_date: str) -> str:
+    def find_file(self, tile: str, variable_name: str, acquisition_date: str) -> (str, str):
+        """
+        Find the file in the bucket for a tile, variable and date.
+
+        Returns:
+            Tuple[str, str]: The key of the file in this source and the name of the file in the bucket,
+                or (None, None) if no source of the variable covers the date.
+        """
         if isinstance(acquisition_date, str):
             acquisition_date = parser.parse(acquisition_date).date()
+        elif isinstance(acquisition_date, datetime):
+            acquisition_date = acquisition_date.date()
 
         variable_source = get_available_variable_source_for_date(variable_name, acquisition_date)
         if not variable_source:
             logger.warn(f"no variable source found for {variable_name} on {acquisition_date}")
-            return ""
+            return None, None
         mapped_variable = variable_source.mapped_variable
 
-        date_str = f"{acquisition_date:%Y-%m}-01" if variable_source.monthly else f"{acquisition_date:%Y-%m-%d}"
+        if variable_source.monthly:
+            acquisition_date = acquisition_date.replace(day=1)
+
+        date_str = f"{acquisition_date:%Y-%m-%d}"
 
         key = f"{int(tile):06d}_{str(mapped_variable)}_{date_str}"
 
-        if key in self.filenames:
-            return self.filenames[key]
+        matching_file_metadata = self.catalog.lookup(tile, mapped_variable, acquisition_date)
 
-        # acquisition_date = acquisition_date.strftime("%Y-%m-%d")
+        if matching_file_metadata is None:
+            raise FileUnavailable(f"no files found for tile {tile} variable {variable_name} date {date_str}")
 
-        filtered_table = self.S3_table[
-            self.S3_table.apply(
-                lambda row: row.tile == int(tile)
-                and row.variable == mapped_variable
-                and parser.parse(str(row.date)).date().strftime("%Y-%m-%d") == date_str,
-                axis=1,
-            )
-        ]
+        filename_base = str(matching_file_metadata["filename"])
 
-        if len(filtered_table) == 0:
-            raise FileUnavailable(f"no files found for tile {tile} variable {variable_name} date {date_str}")
+        return key, filename_base
+
+    def file_identity(self, tile: str, variable_name: str, acquisition_date: str) -> str:
+        key, filename_base = self.find_file(tile, variable_name, acquisition_date)
+
+        if filename_base is None:
+            return None
+
+        return f"s3://{self.bucket_name}/{filename_base}"
+
+    @contextlib.contextmanager
+    def get_filename(self, tile: str, variable_name: str, acquisition_date: str) -> str:
+        key, filename_base = self.find_file(tile, variable_name, acquisition_date)
+
+        if filename_base is None:
+            return ""
 
-        matching_file_metadata = filtered_table.iloc[0]
+        if self.remote_reads:
+            S3_URL = self.S3_URL(filename_base)
+
+            with self.remote_environment():
+                if self.is_tiled(S3_URL):
+                    logger.info(f"reading window of {cl.file(S3_URL)}")
+                    self.filenames[key] = S3_URL
+                    yield S3_URL
+
+                    return
+
+            logger.info(f"remote file is not tiled, downloading: {cl.file(S3_URL)}")
+
+        size, etag = self.object_metadata(filename_base)
+
+        if self.tile_cache is not None:
+            with self.tile_cache.fetch(
+                filename_base, size, etag, lambda filename: self.download(filename_base, filename)
+            ) as filename:
+                self.filenames[key] = filename
+                yield filename
+
+            return
 
-        filename_base = str(matching_file_metadata.filename)
         filename = join(self.temporary_directory, filename_base)
 
-        if exists(filename):
-            try:
-                image = rt.Raster.open(filename)
-            except Exception as e:
-                logger.warning(e)
-                logger.warning(f"removing corrupted file: {filename}")
-                remove(filename)
+        if exists(filename) and getsize(filename) != size:
+            logger.warning(f"removing corrupted file: {filename}")
+            remove(filename)
 
         if not exists(filename):
-            logger.info(
-                f"retrieving {cl.file(filename_base)} from S3 bucket {cl.name(self.bucket_name)} to file: {cl.file(filename)}"
-            )
-
-            failed_to_retrieve = False
-            start_time = time.perf_counter()
             try:
-                self.bucket.download_file(filename_base, filename)
+                self.download(filename_base, filename)
             except Exception as e:
                 logger.error(f"Failed to retrieve file from S3: {filename_base} ({filename}) - {e}")
-                failed_to_retrieve = True
-            end_time = time.perf_counter()
-            duration_seconds = end_time - start_time
-
-            if not failed_to_retrieve:
-                logger.info(f"temporary file retrieved from S3 in {cl.time(duration_seconds)} seconds: {cl.file(filename)}")
 
         self.filenames[key] = filename
 
@@ -189,3 +286,240 @@ class S3Source(DataSource):
         if self.remove_temporary_files:
             logger.info(f"removing temporary file: {filename}")
             os.remove(filename)
+
+    def S3_URL(self, filename_base: str) -> str:
+        """
+        Get the GDAL virtual file system path of a file in the bucket.
+        """
+        return f"/vsis3/{self.bucket_name}/{filename_base}"
+
+    def remote_environment(self) -> rasterio.Env:
+        """
+        Get a rasterio environment that reads from the bucket with the credentials of this source.
+        """
+        options = dict(REMOTE_READ_OPTIONS)
+        endpoint_url = None
+
+        # GDAL takes the endpoint as a host with the scheme given separately
+        if self.endpoint_url is not None:
+            endpoint = urlparse(self.endpoint_url)
+            endpoint_url = endpoint.netloc or endpoint.path
+            options["AWS_HTTPS"] = "NO" if endpoint.scheme == "http" else "YES"
+            options["AWS_VIRTUAL_HOSTING"] = "FALSE"
+
+        session = rasterio.session.AWSSession(
+            session=self.session, region_name=self.region_name, endpoint_url=endpoint_url
+        )
+
+        return rasterio.Env(session, **options)
+
+    def is_tiled(self, S3_URL: str) -> bool:
+        """
+        Check whether a remote file is internally tiled, so that a window can be read with a few range requests.
+        Striped files and files that can't be opened remotely are downloaded instead.
+        """
+        if S3_URL not in self.remote_tiled:
+            try:
+                with rasterio.open(S3_URL) as remote_file:
+                    block_rows, block_cols = remote_file.block_shapes[0]
+                    self.remote_tiled[S3_URL] = block_rows > 1 and block_cols < remote_file.width
+            except Exception as e:
+                logger.warning(e)
+                logger.warning(f"unable to open remote file: {S3_URL}")
+                self.remote_tiled[S3_URL] = False
+
+        return self.remote_tiled[S3_URL]
+
+    def object_metadata(self, filename_base: str) -> (int, str):
+        """
+        Get the size in bytes and the ETag of a file in the bucket.
+        """
+        try:
+            response = self.client.head_object(Bucket=self.bucket_name, Key=filename_base)
+        except Exception as e:
+            raise FileUnavailable(f"unable to read metadata of {filename_base} in S3 bucket {self.bucket_name}: {e}")
+
+        return response["ContentLength"], response["ETag"]
+
+    def download(self, filename_base: str, filename: str):
+        """
+        Download a file from the bucket.
+        """
+        logger.info(
+            f"retrieving {cl.file(filename_base)} from S3 bucket {cl.name(self.bucket_name)} to file: {cl.file(filename)}"
+        )
+
+        start_time = time.perf_counter()
+        self.client.download_file(self.bucket_name, filename_base, filename)
+        end_time = time.perf_counter()
+        duration_seconds = end_time - start_time
+
+        logger.info(f"file retrieved from S3 in {cl.time(duration_seconds)} seconds: {cl.file(filename)}")
+
+    def prefetch(self, files: list, concurrency: int = None) -> dict:
+        """
+        Download the files for a list of tiles, variables and dates concurrently,
+        so that the get_filename calls that read them find them on disk.
+        Files that are read remotely aren't downloaded.
+        Files are fetched in the order they're listed until they add up to prefetch_max_bytes, so that the tile cache
+        doesn't evict them before they're read, and the rest are downloaded when they're read.
+
+        Args:
+            files (list): The (tile, variable name, acquisition date) of each file.
+            concurrency (int, optional): The number of simultaneous downloads, where 0 disables prefetching.
+                Defaults to the prefetch_concurrency of this source.
+
+        Returns:
+            dict: The number of files and bytes downloaded, the elapsed time, the transfer rate in bytes per second,
+                and the mean and maximum latency per file in seconds.
+        """
+        if concurrency is None:
+            concurrency = self.prefetch_concurrency
+
+        if concurrency < 1 or len(files) == 0:
+            return {}
+
+        filenames_base = []
+
+        for tile, variable_name, acquisition_date in files:
+            try:
+                key, filename_base = self.find_file(tile, variable_name, acquisition_date)
+            except FileUnavailable as e:
+                logger.warning(e)
+                continue
+
+            if filename_base is not None:
+                filenames_base.append(filename_base)
+
+        filenames_base = list(dict.fromkeys(filenames_base))
+        logger.info(f"prefetching {cl.val(len(filenames_base))} files with {cl.val(concurrency)} concurrent downloads")
+
+        latencies = []
+        total_bytes = 0
+        start_time = time.perf_counter()
+        reserved_bytes = 0
+        skipped_files = 0
+        reserve_lock = threading.Lock()
+
+        def reserve(size: int) -> bool:
+            nonlocal reserved_bytes
+
+            with reserve_lock:
+                if reserved_bytes + size > self.prefetch_max_bytes:
+                    return False
+
+                reserved_bytes += size
+
+                return True
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = {
+                executor.submit(self.fetch, filename_base, reserve=reserve): filename_base
+                for filename_base in filenames_base
+            }
+
+            for future in as_completed(futures):
+                filename_base = futures[future]
+
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.warning(e)
+                    logger.warning(f"unable to prefetch file: {filename_base}")
+                    continue
+
+                if result is None:
+                    skipped_files += 1
+                    continue
+
+                downloaded_bytes, duration_seconds = result
+
+                if downloaded_bytes > 0:
+                    latencies.append(duration_seconds)
+                    total_bytes += downloaded_bytes
+                    logger.info(
+                        f"prefetched {cl.file(filename_base)} ({cl.val(downloaded_bytes)} bytes) in {cl.time(f'{duration_seconds:0.2f}')} seconds"
+                    )
+
+        elapsed_seconds = time.perf_counter() - start_time
+
+        if skipped_files > 0:
+            logger.info(
+                f"left {cl.val(skipped_files)} files beyond the prefetch limit of {cl.val(self.prefetch_max_bytes)} bytes "
+                "to be downloaded when they're read"
+            )
+
+        stats = {
+            "files": len(latencies),
+            "skipped_files": skipped_files,
+            "bytes": total_bytes,
+            "seconds": elapsed_seconds,
+            "bytes_per_second": total_bytes / elapsed_seconds if elapsed_seconds > 0 else 0,
+            "mean_latency_seconds": sum(latencies) / len(latencies) if latencies else 0,
+            "max_latency_seconds": max(latencies) if latencies else 0,
+        }
+
+        megabytes_per_second = stats["bytes_per_second"] / 1024**2
+        mean_latency_seconds = stats["mean_latency_seconds"]
+        max_latency_seconds = stats["max_latency_seconds"]
+
+        logger.info(
+            f"prefetched {cl.val(stats['files'])} files ({cl.val(total_bytes)} bytes) in {cl.time(f'{elapsed_seconds:0.2f}')} seconds "
+            f"at {cl.val(f'{megabytes_per_second:0.2f}')} MB/s with {cl.time(f'{mean_latency_seconds:0.2f}')} seconds mean "
+            f"and {cl.time(f'{max_latency_seconds:0.2f}')} seconds max latency per file"
+        )
+
+        return stats
+
+    def fetch(self, filename_base: str, reserve: Callable[[int], bool] = None) -> Union[Tuple[int, float], None]:
+        """
+        Download a file from the bucket to the tile cache or temporary directory unless it's already there.
+
+        Args:
+            filename_base (str): The key of the file in the bucket.
+            reserve (Callable[[int], bool], optional): Called with the size of the file before it's fetched,
+                returning whether there's room for it.
+
+        Returns:
+            Tuple[int, float]: The number of bytes downloaded and the time taken in seconds,
+                or None if there wasn't room for the file.
+        """
+        start_time = time.perf_counter()
+
+        if self.remote_reads:
+            with self.remote_environment():
+                if self.is_tiled(self.S3_URL(filename_base)):
+                    return 0, time.perf_counter() - start_time
+
+        size, etag = self.object_metadata(filename_base)
+        downloaded_bytes = 0
+
+        # files already on disk count too, since they have to stay there until they're read
+        if reserve is not None and not reserve(size):
+            return None
+
+        if self.tile_cache is not None:
+
+            def download(filename: str):
+                nonlocal downloaded_bytes
+                self.download(filename_base, filename)
+                downloaded_bytes = size
+
+            with self.tile_cache.fetch(filename_base, size, etag, download):
+                pass
+        else:
+            filename = join(self.temporary_directory, filename_base)
+
+            if not exists(filename) or getsize(filename) != size:
+                temporary_filename = f"{filename}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+                try:
+                    self.download(filename_base, temporary_filename)
+                    os.replace(temporary_filename, filename)
+                finally:
+                    if exists(temporary_filename):
+                        os.remove(temporary_filename)
+
+                downloaded_bytes = size
+
+        return downloaded_bytes, time.perf_counter() - start_time
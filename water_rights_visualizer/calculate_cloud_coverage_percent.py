@@ -7,90 +7,141 @@ import numpy as np
 import pandas as pd
 from shapely.geometry import Polygon
 import rasterio
-from rasterio.mask import mask, raster_geometry_mask
 from logging import getLogger
 import re
 import datetime
 
+from raster import Raster
+
+from .date_helpers import get_days_in_month
+from .roi_context import ROIContext
+from .subset_store import SubsetStore
+from .zonal_stats import ROI_mask, ROI_mean
+
 logger = getLogger(__name__)
 
 NUMBER_OF_MODELS = 6
 
 
-def get_days_in_month(year, month):
-    # Calculate the first day of the next month
-    if month == 12:
-        next_month = datetime.date(year + 1, 1, 1)
-    else:
-        next_month = datetime.date(year, month + 1, 1)
+def ROI_subset_mask(subset: Raster, ROI_geometry, ROI_context: ROIContext = None) -> np.ndarray:
+    """
+    Get the mask of the cells of a subset inside the ROI, which is rasterized once for each grid.
+    """
+    affine = subset.geometry.affine
+
+    if ROI_context is None:
+        return ROI_mask(ROI_geometry, affine, subset.shape)
+
+    return ROI_context.ROI_shapes_mask(affine, subset.shape)
+
+
+def nan_subset_filename(subset_filename: str, nan_subset_directory: str) -> str:
+    """
+    Get the filename of a subset masked to the ROI in the nan subset directory.
+    """
+    return splitext(nan_subset_directory + "/" + basename(subset_filename))[0] + "_nan.tif"
+
+
+def write_nan_subset(subset: Raster, inside: np.ndarray, filename: str):
+    """
+    Write a subset with the cells outside the ROI filled with its nodata value, as rasterio.mask.mask does without cropping.
+    """
+    nodata = subset.nodata if subset.nodata is not None else 0
+    masked_subset = np.where(inside, subset.array, nodata).astype(subset.dtype)
+    Raster(masked_subset, geometry=subset.geometry, nodata=subset.nodata).to_geotiff(filename)
+
+
+def get_subset_roi_average(
+    subset: Raster,
+    ROI_geometry,
+    ROI_context: ROIContext = None,
+    nan_subset_filename: str = None,
+) -> float:
+    """
+    Get the average of the non-NaN values of a subset within the ROI.
+
+    Args:
+        subset (Raster): The subset to calculate the average of non-NaN values.
+        ROI_geometry (Polygon): The region of interest polygon used for masking the subset.
+        ROI_context (ROIContext, optional): The geometry of the ROI, which keeps the ROI mask of each grid.
+        nan_subset_filename (str, optional): The file to write the masked subset to, which isn't written if None.
 
-    # Subtract one day to get the last day of the current month
-    last_day_of_month = next_month - datetime.timedelta(days=1)
+    Returns:
+        float: The average of the non-NaN values in the subset within the ROI.
+    """
+    inside = ROI_subset_mask(subset, ROI_geometry, ROI_context)
 
-    return last_day_of_month.day
+    if nan_subset_filename is not None:
+        write_nan_subset(subset, inside, nan_subset_filename)
 
+    return ROI_mean(subset.array, inside, nodata=subset.nodata)
 
-def get_nan_tiff_roi_average(tiff_file, ROI_geometry, dir) -> Union[float, None]:
+
+def get_nan_tiff_roi_average(tiff_file, ROI_geometry, dir=None, ROI_context: ROIContext = None) -> Union[float, None]:
     """
-    Get the average of the non-NaN values in the subset file within the given directory.
+    Get the average of the non-NaN values in the subset file within the ROI.
 
     Args:
         tiff_file (str): The subset file to calculate the average of non-NaN values.
         ROI_geometry (Polygon): The region of interest polygon used for masking the subset files.
-        dir (str): The directory containing the subset files.
+        dir (str, optional): The nan subset directory, which the masked subset is only written to if given.
+        ROI_context (ROIContext, optional): The geometry of the ROI, which keeps the ROI mask of each grid.
 
     Returns:
         Union[float, None]: The average of the non-NaN values in the subset file or None if an error occurs.
     """
-    filename = basename(tiff_file)
-
     if not tiff_file or not exists(tiff_file):
         logger.error(f"File '{tiff_file}' does not exist")
         return None
 
-    nan_masked_subset_file = None
-    with rasterio.open(tiff_file) as subset_tiles:
-        # Masking the ET subset file with the ROI_for_nan polygon
-        out_image, out_transform = mask(subset_tiles, ROI_geometry, crop=False)
-        out_meta = subset_tiles.meta.copy()
-        out_meta.update(
-            {
-                "driver": "GTiff",
-                "height": out_image.shape[1],
-                "width": out_image.shape[2],
-                "transform": out_transform,
-            }
-        )
-        nan_masked_subset_file = splitext(dir + "/" + basename(subset_tiles.name))[0] + "_nan.tif"
-        # Saving the masked subset as a new file in the nan_subset_directory
-        with rasterio.open(nan_masked_subset_file, "w", **out_meta) as dest:
-            dest.write(out_image)
-
-    if not nan_masked_subset_file:
-        logger.error(f"Failed to create nan masked subset file for {filename}")
-        return None
+    with rasterio.open(tiff_file) as subset_file:
+        data = subset_file.read(1)
+        affine = subset_file.transform
+        nodata = subset_file.nodata
+
+    if ROI_context is None:
+        inside = ROI_mask(ROI_geometry, affine, data.shape)
+    else:
+        inside = ROI_context.ROI_shapes_mask(affine, data.shape)
 
-    with rasterio.open(nan_masked_subset_file) as src:
-        data = src.read(1)
-        data = data[data != src.nodata]
-        data = data[~np.isnan(data)]
-        return np.mean(data)
+    if dir is not None:
+        write_nan_subset(Raster.open(tiff_file), inside, nan_subset_filename(tiff_file, dir))
+
+    return ROI_mean(data, inside, nodata=nodata)
 
 
 def calculate_cloud_coverage_percent(
-    ROI_geometry: Polygon, subset_directory: str, nan_subset_directory: str, monthly_nan_directory: str
+    ROI_geometry: Polygon,
+    subset_directory: str,
+    nan_subset_directory: str,
+    monthly_nan_directory: str,
+    ROI_context: ROIContext = None,
+    subset_store: SubsetStore = None,
+    year: int = None,
 ):
     """
     Calculate the percentage of NaN values in each subset file within the given directory based on CCOUNT data.
+    Given a year, only the subsets of that year are read and merged into its CSV file, so that processing each year
+    of a report doesn't read the subsets of every year before it again.
 
     Args:
         ROI_geometry (Polygon): The region of interest polygon used for masking the subset files.
-        year (int): The year for which to calculate the cloud coverage percentage.
+        subset_directory (str): The directory containing the subset files.
+        nan_subset_directory (str): The directory to save the masked subsets to when the subsets are exported.
         monthly_nan_directory (str): The directory to save the monthly average NaN values.
+        ROI_context (ROIContext, optional): The geometry of the ROI, which keeps the ROI mask of each grid.
+        subset_store (SubsetStore, optional): The subsets of the year kept in memory, which are used instead of the
+            subset files if there are any.
+        year (int, optional): The year for which to calculate the cloud coverage percentage.
+            Defaults to every year in the subsets.
 
     Returns:
         None
     """
+    # the year is reused below as the year of each subset
+    selected_year = year
+    subset_prefix = "*" if selected_year is None else f"{selected_year:04d}.*"
+
     if not exists(monthly_nan_directory):
         makedirs(monthly_nan_directory)
 
@@ -101,8 +152,23 @@ def calculate_cloud_coverage_percent(
 
     year_month = {}
     uncertainty_variables = ["ET_MIN", "ET_MAX", "COUNT", "PPT"]
+
+    if subset_store is not None and len(subset_store) == 0:
+        subset_store = None
+
     for variable in uncertainty_variables:
-        subset_files = glob(f"{subset_directory}/*_{variable}_subset.tif")
+        if subset_store is not None:
+            for date_step in subset_store.dates(variable, year=selected_year):
+                year = f"{date_step.year:04d}"
+                month = f"{date_step.month:02d}"
+                key = f"{year}-{month}"
+                if not year_month.get(key):
+                    year_month[key] = {"year": year, "month": month}
+                year_month[key][variable] = date_step
+
+            continue
+
+        subset_files = glob(f"{subset_directory}/{subset_prefix}_{variable}_subset.tif")
         for subset_file in subset_files:
             filename = basename(subset_file)
             match = re.match(rf"(\d{{4}})\.(\d{{2}})\.(\d{{2}}).*_{variable}_subset\.tif", filename)
@@ -117,20 +183,31 @@ def calculate_cloud_coverage_percent(
         year = variable_files["year"]
         month = variable_files["month"]
 
-        ccount_subset_file = variable_files.get("COUNT", "")
-        et_min_subset_file = variable_files.get("ET_MIN", "")
-        et_max_subset_file = variable_files.get("ET_MAX", "")
-        ppt_subset_file = variable_files.get("PPT", "")
-
         if not yearly_ccount_percentages.get(year):
             yearly_ccount_percentages[year] = {}
 
         days_in_month = get_days_in_month(int(year), int(month))
 
-        ccount_average = get_nan_tiff_roi_average(ccount_subset_file, ROI_geometry, nan_subset_directory)
-        et_min_average = get_nan_tiff_roi_average(et_min_subset_file, ROI_geometry, nan_subset_directory)
-        et_max_average = get_nan_tiff_roi_average(et_max_subset_file, ROI_geometry, nan_subset_directory)
-        ppt_average = get_nan_tiff_roi_average(ppt_subset_file, ROI_geometry, nan_subset_directory)
+        def roi_average(variable: str) -> Union[float, None]:
+            subset_file = variable_files.get(variable, "")
+
+            if isinstance(subset_file, datetime.date):
+                # the subsets in memory are only masked into files when they're exported
+                nan_filename = None
+
+                if subset_store.export_subsets:
+                    nan_filename = nan_subset_filename(subset_store.filename(variable, subset_file), nan_subset_directory)
+
+                subset = subset_store.get(variable, subset_file)
+
+                return get_subset_roi_average(subset, ROI_geometry, ROI_context, nan_filename)
+
+            return get_nan_tiff_roi_average(subset_file, ROI_geometry, ROI_context=ROI_context)
+
+        ccount_average = roi_average("COUNT")
+        et_min_average = roi_average("ET_MIN")
+        et_max_average = roi_average("ET_MAX")
+        ppt_average = roi_average("PPT")
 
         yearly_ccount_percentages[year][month] = {
             "avg_cloud_count": ccount_average,
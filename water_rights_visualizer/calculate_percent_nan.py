@@ -1,181 +1,128 @@
-from os import makedirs, listdir, remove
-from os.path import exists, isfile, join, basename, splitext
+from datetime import date, datetime
+from os import makedirs
+from os.path import exists, join, basename
 from glob import glob
-import csv
-import numpy as np
+from typing import Iterator, List, Tuple
 import pandas as pd
 from shapely.geometry import Polygon
-import rasterio
-from rasterio.mask import mask, raster_geometry_mask
 from logging import getLogger
-from .calculate_cloud_coverage_percent import get_nan_tiff_roi_average
+
+from raster import Raster
+
+from .calculate_cloud_coverage_percent import (
+    ROI_subset_mask,
+    get_subset_roi_average,
+    nan_subset_filename,
+    write_nan_subset,
+)
+from .roi_context import ROIContext
+from .subset_store import SubsetStore
+from .zonal_stats import ROI_nan_fraction
 
 logger = getLogger(__name__)
 
 
+def subset_files(subset_directory: str, variable_name: str, year: int = None) -> List[Tuple[date, str]]:
+    """
+    List the subset files of a variable in the subset directory with their dates, in date order,
+    only those of a year if one is given.
+    """
+    prefix = "*" if year is None else f"{year:04d}.*"
+    filenames = sorted(glob(join(subset_directory, f"{prefix}_{variable_name}_subset.tif")))
+
+    return [(datetime.strptime(basename(filename).split("_")[0], "%Y.%m.%d").date(), filename) for filename in filenames]
+
+
+def read_subset_files(subset_directory: str, variable_name: str, year: int = None) -> Iterator[Tuple[date, Raster]]:
+    """
+    Read the subset files of a variable in the subset directory one at a time, in date order.
+    """
+    for date_step, filename in subset_files(subset_directory, variable_name, year=year):
+        yield date_step, Raster.open(filename)
+
+
 # Defining the function calculate_percent_nan
 def calculate_percent_nan(
-    ROI_for_nan: Polygon, subset_directory: str, nan_subset_directory: str, monthly_nan_directory: str
+    ROI_for_nan: Polygon,
+    subset_directory: str,
+    nan_subset_directory: str,
+    monthly_nan_directory: str,
+    ROI_context: ROIContext = None,
+    subset_store: SubsetStore = None,
+    year: int = None,
 ):
     """
-    Calculate the percentage of NaN values in each subset file within the given directory.
+    Calculate the percentage of NaN values within the ROI of each ET subset, and write the average of each month
+    with the average PPT of the month to a CSV file for each year.
+    Each subset is read once and counted within the ROI mask of its grid, without writing any intermediate files.
+    Given a year, only the subsets of that year are read and only its CSV file is written, so that processing each year
+    of a report doesn't read the subsets of every year before it again.
 
     Args:
-        ROI_for_nan (Polygon): The region of interest polygon used for masking the subset files.
+        ROI_for_nan (Polygon): The region of interest polygon used for masking the subsets.
         subset_directory (str): The directory containing the subset files.
-        nan_subset_directory (str): The directory to save the masked subset files with NaN values.
+        nan_subset_directory (str): The directory to save the masked subsets to when the subsets are exported.
         monthly_nan_directory (str): The directory to save the monthly average NaN values.
+        ROI_context (ROIContext, optional): The geometry of the ROI, which keeps the ROI mask of each grid.
+        subset_store (SubsetStore, optional): The subsets of the year kept in memory, which are used instead of the
+            subset files if there are ET subsets among them.
+        year (int, optional): The year being processed. Defaults to every year in the subsets.
 
     Returns:
         None
     """
-    # Creating the nan_subset_directory if it doesn't exist
-    if not exists(nan_subset_directory):
+    if subset_store is not None and len(subset_store.dates("ET", year=year)) > 0:
+        ET_subsets = subset_store.items("ET", year=year)
+        PPT_subsets = subset_store.items("PPT", year=year)
+        export_subsets = subset_store.export_subsets
+    elif len(subset_files(subset_directory, "ET", year=year)) > 0:
+        ET_subsets = read_subset_files(subset_directory, "ET", year=year)
+        PPT_subsets = read_subset_files(subset_directory, "PPT", year=year)
+        export_subsets = False
+    else:
+        # the subsets are only on disk if they were exported
+        logger.warning(f"no ET subsets to calculate the percentage of NaN values from in: {subset_directory}")
+        return
+
+    if export_subsets and not exists(nan_subset_directory):
         makedirs(nan_subset_directory)
 
-    nan_subsets = nan_subset_directory
-
-    # Looping through the files in the subset_directory
-    for items in listdir(subset_directory):
-        # Checking if the file is a valid ET subset file
-        if items.endswith("_ET_subset.tif") and isfile(join(subset_directory, items)):
-            # Opening the ET subset file
-            with rasterio.open(join(subset_directory, items)) as p:
-                # Masking the ET subset file with the ROI_for_nan polygon
-                out_image, out_transform = mask(p, ROI_for_nan, crop=False)
-                out_meta = p.meta.copy()
-                out_meta.update(
-                    {
-                        "driver": "GTiff",
-                        "height": out_image.shape[1],
-                        "width": out_image.shape[2],
-                        "transform": out_transform,
-                    }
-                )
-                # Saving the masked subset as a new file in the nan_subset_directory
-                with rasterio.open(splitext(nan_subsets + "/" + basename(p.name))[0] + "_nan.tif", "w", **out_meta) as dest:
-                    dest.write(out_image)
-
-    # Opening the first ET subset file in the subset_directory
-    subset_filenames = sorted(glob(join(subset_directory, "*.tif")))
-    first_subset_filename = subset_filenames[0]
-    a_subset = rasterio.open(first_subset_filename)
-
-    # Masking the area outside the ROI_for_nan polygon
-    out_image, out_transform = mask(a_subset, ROI_for_nan, invert=True)
-    out_meta = a_subset.meta.copy()
-    out_meta.update(
-        {"driver": "GTiff", "height": out_image.shape[1], "width": out_image.shape[2], "transform": out_transform}
-    )
-    # Saving the masked area as a new file in the subset_directory
-    with rasterio.open(subset_directory + "/masked_area.tif", "w", **out_meta) as dest2:
-        dest2.write(out_image)
-
-    # Creating a mask for the ROI_for_nan polygon
-    roi_mask = raster_geometry_mask(a_subset, ROI_for_nan, invert=True)
-    open_mask = rasterio.open(subset_directory + "/masked_area.tif")
-    area_mask = open_mask.read()
-    # Counting the number of pixels with value 0 (outside the ROI_for_nan polygon)
-    area = np.count_nonzero(((area_mask[0][roi_mask[0]])) == 0)
-    ET_subset = rasterio.open(nan_subsets + "/" + listdir(nan_subsets)[0])
-    base_name = basename(ET_subset.name)
-    file_name = splitext(base_name)[0]
-    subset_in_mskdir = rasterio.open(nan_subsets + "/" + file_name + ".tif")
     percent_nan = []
-    msk_subsets = glob(join(nan_subsets, "*.tif"))
-
-    # Function to read a raster file
-    def read_file(file):
-        with rasterio.open(file) as src:
-            return src.read()
-
-    # Creating a list of arrays, each representing a masked subset
-    array_list = [read_file(x) for x in msk_subsets]
-
-    # Looping through the array_list and calculating the percentage of NaN values
-    for subsets in array_list:
-        counted_nans = np.count_nonzero((np.isnan(subsets[0][roi_mask[0]])))
-        cell_count = len(subsets[0][roi_mask[0]].flatten())
-        count_nan = []
-        count_nan.append(counted_nans)
-
-        for nans in count_nan:
-            # if area == 0:
-            #     ratio_of_nan = (nans / 1)
-            #     percent_of_nan = ratio_of_nan * 100
-            #     percent_nan.append(percent_of_nan)
-            # else:
-            #     ratio_of_nan = (nans / area)
-            #     percent_of_nan = ratio_of_nan * 100
-            #     percent_nan.append(percent_of_nan)
-            percent_nan.append(nans / cell_count * 100)
-
-            # print(f"nans: {nans}")
-            # print(f"percent_nan: {percent_nan}")
-
-    # Extracting the dates from the file names
-    dates = []
-
-    for msk_subset in msk_subsets:
-        with rasterio.open(msk_subset) as t:
-            paths = basename(t.name)
-            date_split = paths.split("_")[0]
-            dates.append(date_split)
-
-    years = []
-    months = []
-    days = []
-
-    # Splitting the dates into year, month, and day
-    for date_time in dates:
-        msk_year = date_time.split(".")[0]
-        years.append(msk_year)
-        msk_month = date_time.split(".")[1]
-        months.append(msk_month)
-        msk_day = date_time.split(".")[2]
-        days.append(msk_day)
+
+    # Counting the NaN values of each ET subset within the ROI, which is rasterized once for each grid
+    for date_step, subset in ET_subsets:
+        roi_mask = ROI_subset_mask(subset, ROI_for_nan, ROI_context)
+
+        if export_subsets:
+            filename = nan_subset_filename(subset_store.filename("ET", date_step), nan_subset_directory)
+            write_nan_subset(subset, roi_mask, filename)
+
+        percent_nan.append(
+            {"percent_nan": ROI_nan_fraction(subset.array, roi_mask) * 100, "year": date_step.year, "month": date_step.month}
+        )
+
+    ppt_values = []
+
+    for date_step, subset in PPT_subsets:
+        nan_filename = None
+
+        if export_subsets:
+            nan_filename = nan_subset_filename(subset_store.filename("PPT", date_step), nan_subset_directory)
+
+        ppt_average = get_subset_roi_average(subset, ROI_for_nan, ROI_context, nan_filename) or 0
+        ppt_values.append({"ppt_avg": ppt_average, "month": date_step.month, "year": date_step.year})
 
     # Creating the monthly_nan_directory if it doesn't exist
     if not exists(monthly_nan_directory):
         makedirs(monthly_nan_directory)
 
-    nan_csv = "nan_avg.csv"
-    nan_monthly_csv = "nan_monthly_avg.csv"
-    nan_folder = join(monthly_nan_directory, nan_csv)
-    nan_monthly_folder = join(monthly_nan_directory, nan_monthly_csv)
-
-    # Writing the percent_nan, year, and month to a CSV file
-    with open(nan_folder, "w", newline="") as f:
-        writer = csv.writer(f)
-        writer.writerow(["percent_nan", "year", "month"])
-        rows = zip(percent_nan, years, months)
-
-        for row in rows:
-            writer.writerow(row)
-
-    nan_avg = list()
-    nanavg = pd.read_csv(nan_folder)
-    group = nanavg.groupby(["year", "month"])
-    monthavg = group.aggregate({"percent_nan": np.mean})
-    nan_avg.append(monthavg)
-    conavg = pd.concat(nan_avg, ignore_index=False)
-    conavg.to_csv(nan_monthly_folder)
-    sort_order = pd.read_csv(nan_monthly_folder)
-    sort_ascend = sort_order.sort_values("year", ascending=False)
-    nan_monthly_avg = pd.read_csv(nan_monthly_folder)
+    # Averaging the percentage of NaN values of each month
+    nan_monthly_avg = pd.DataFrame(percent_nan).groupby(["year", "month"]).aggregate({"percent_nan": "mean"})
+    nan_monthly_avg = nan_monthly_avg.reset_index()
     nan_monthly_avg["Year"] = nan_monthly_avg["year"]
 
-    ppt_values = []
-    ppt_subset_files = sorted(glob(join(subset_directory, "*_PPT_subset.tif")))
-
-    for ppt_subset_file in ppt_subset_files:
-        filename = basename(ppt_subset_file)
-        year, month = map(int, filename.split("_")[0].split(".")[:2])
-        ppt_average = get_nan_tiff_roi_average(ppt_subset_file, ROI_for_nan, nan_subset_directory) or 0
-        ppt_values.append({"ppt_avg": ppt_average, "month": month, "year": year})
-
     # Convert PPT values to DataFrame and merge with monthly averages
-    month_ppt_df = pd.DataFrame(ppt_values)
+    month_ppt_df = pd.DataFrame(ppt_values, columns=["ppt_avg", "month", "year"])
     nan_monthly_avg = pd.merge(nan_monthly_avg, month_ppt_df, on=["year", "month"], how="left")
 
     cols_nan = nan_monthly_avg.columns
@@ -183,7 +130,3 @@ def calculate_percent_nan(
     for year in set(nan_monthly_avg["Year"]):
         new_csv_by_year = monthly_nan_directory + "/" + str(year) + ".csv"
         nan_monthly_avg.loc[nan_monthly_avg["Year"] == year].to_csv(new_csv_by_year, index=False, columns=cols_nan)
-
-    # # Removing the temporary CSV files
-    remove(nan_monthly_folder)
-    remove(nan_folder)
@@ -0,0 +1,101 @@
+import os
+import tempfile
+from logging import getLogger
+from typing import Callable
+
+import numpy as np
+
+from .constants import MONTHS_IN_YEAR, STACK_MEMORY_FACTOR
+from .date_helpers import get_one_month_slice
+from .interpolate_stack import interpolate_stack
+
+logger = getLogger(__name__)
+
+BYTES_PER_VALUE = np.dtype(np.float32).itemsize
+
+
+def stack_fits_in_memory(layers: int, rows: int, cols: int, memory_budget: int = None) -> bool:
+    """
+    Check whether the sparse and interpolated stacks of a year fit in a memory budget in bytes.
+    Everything fits if there's no budget.
+    """
+    if memory_budget is None:
+        return True
+
+    return layers * rows * cols * BYTES_PER_VALUE * STACK_MEMORY_FACTOR <= memory_budget
+
+
+def generate_disk_stack(total_date_steps: int, x_rows: int, y_cols: int, directory: str = None) -> np.memmap:
+    """
+    Generate an empty stack with NaN values backed by a temporary file instead of memory.
+    The file is unlinked as soon as it's mapped, so it's removed when the stack is released.
+    """
+    if directory is not None:
+        os.makedirs(directory, exist_ok=True)
+
+    file_descriptor, filename = tempfile.mkstemp(suffix=".stack", dir=directory)
+    os.close(file_descriptor)
+
+    try:
+        stack = np.memmap(filename, dtype=np.float32, mode="w+", shape=(total_date_steps, x_rows, y_cols))
+    finally:
+        os.remove(filename)
+
+    for layer in range(total_date_steps):
+        stack[layer] = np.nan
+
+    return stack
+
+
+def block_rows_for_budget(layers: int, rows: int, cols: int, memory_budget: int) -> int:
+    """
+    Get the number of rows of the stack that can be interpolated at once within a memory budget in bytes.
+    """
+    row_bytes = layers * cols * BYTES_PER_VALUE * STACK_MEMORY_FACTOR
+
+    return int(min(max(memory_budget // row_bytes, 1), rows))
+
+
+def sum_months_by_block(
+    read_block: Callable[[slice], np.ndarray],
+    layers: int,
+    rows: int,
+    cols: int,
+    year: int,
+    method: str,
+    memory_budget: int,
+) -> np.ndarray:
+    """
+    Interpolate a sparse stack one block of rows at a time and sum each block into months,
+    so that only the 12 monthly sums of the whole ROI are held in memory.
+    Each pixel is interpolated and summed independently, so the sums are the same as those of the whole stack.
+
+    Args:
+        read_block (Callable[[slice], np.ndarray]): Function returning the sparse stack for a slice of rows.
+        layers (int): The number of layers in the sparse stack, one per day or one per month.
+        rows (int): The number of rows in the stack.
+        cols (int): The number of columns in the stack.
+        year (int): The year covered by the stack.
+        method (str): The interpolation method.
+        memory_budget (int): The memory budget in bytes.
+
+    Returns:
+        np.ndarray: A 12-layer stack of monthly sums.
+    """
+    block_rows = block_rows_for_budget(layers, rows, cols, memory_budget)
+    logger.info(f"interpolating {rows} rows in blocks of {block_rows} rows with {method} interpolation")
+    monthly_sums = np.full((MONTHS_IN_YEAR, rows, cols), np.nan, dtype=np.float32)
+
+    for start_row in range(0, rows, block_rows):
+        block_slice = slice(start_row, min(start_row + block_rows, rows))
+        block = interpolate_stack(np.asarray(read_block(block_slice)), method=method, year=year)
+
+        for month in range(1, MONTHS_IN_YEAR + 1):
+            if layers == MONTHS_IN_YEAR:
+                start_index, end_index = month - 1, month
+            else:
+                start_index, end_index = get_one_month_slice(year, month)
+
+            monthly_sums[month - 1, block_slice, :] = np.nansum(block[start_index:end_index], axis=0)
+
+    return monthly_sums
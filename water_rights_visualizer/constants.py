@@ -7,6 +7,7 @@ END_YEAR = 2020
 
 START_MONTH = 1
 END_MONTH = 12
+MONTHS_IN_YEAR = 12
 
 TILE_SELECTION_BUFFER_RADIUS_DEGREES = 0.01
 BUFFER_METERS = 2000
@@ -14,6 +15,37 @@ BUFFER_DEGREES = 0.001
 CELL_SIZE_DEGREES = 0.0003
 CELL_SIZE_METERS = 30
 
+DEFAULT_INTERPOLATION = "nearest"
+
+# monthly layers only used to get the error percentage of ET
+UNCERTAINTY_VARIABLES = ["ET_MIN", "ET_MAX", "COUNT"]
+
+# worker processes generating the subsets of each date, 1 generates them serially
+SUBSET_WORKERS = 1
+
+# worker processes processing separate years, limited by CPUs and by the memory each year is expected to need
+YEAR_WORKERS = 1
+YEAR_MEMORY_BYTES = 4 * 1024**3
+
+# memory budget in bytes for the stacks of a year, beyond which they're kept on disk and interpolated in row blocks
+STACK_MEMORY_BUDGET = None
+# float32 stack-sized arrays held at once by the sparse stacks, interpolation and monthly sums
+STACK_MEMORY_FACTOR = 8
+
+# number of dates whose daily subsets are read from each tile at once, 1 to read one date at a time
+SUBSET_BATCH_DATES = 32
+
+# directory of the subset cache shared between runs, disabled if None
+SUBSET_CACHE_DIRECTORY = None
+
+# write every subset to the subset directory as a GeoTIFF, instead of only keeping them in memory for the year
+EXPORT_SUBSETS = False
+# bytes of subsets kept in memory for a year, beyond which the rest are written to the subset directory
+SUBSET_STORE_MEMORY_BUDGET = 2 * 1024**3
+
+# padding around the polygons of each tile cluster in batch runs, relative to the longest side of the cluster
+BATCH_OUTPUT_PADDING_PERCENTAGE = 0.01
+
 CANVAS_HEIGHT_TK = 600
 CANVAS_WIDTH_TK = 700
 
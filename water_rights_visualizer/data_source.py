@@ -31,3 +31,33 @@ class DataSource:
         """
 
         pass
+
+    def file_identity(self, tile: str, variable_name: str, acquisition_date: str) -> str:
+        """
+        Returns a string that identifies the contents of the file for the given tile, variable name, and acquisition date,
+        so that results derived from the file can be cached. Sources that can't identify their files return None.
+
+        Args:
+            tile (str): The tile identifier.
+            variable_name (str): The name of the variable.
+            acquisition_date (str): The acquisition date of the data.
+
+        Returns:
+            str: The identity of the file.
+        """
+
+        return None
+
+    def prefetch(self, files: list) -> dict:
+        """
+        Fetches files ahead of the get_filename calls that read them.
+        Sources with local files have nothing to fetch.
+
+        Args:
+            files (list): The (tile, variable name, acquisition date) of each file.
+
+        Returns:
+            dict: Statistics of the files fetched.
+        """
+
+        return {}
@@ -0,0 +1,185 @@
+import logging
+import os
+import pickle
+from datetime import date
+from hashlib import md5
+from os import makedirs
+from os.path import abspath, basename, dirname, exists, expanduser, getmtime, getsize, join
+from typing import List, Union
+
+import pandas as pd
+from dateutil import parser
+
+import cl
+
+logger = logging.getLogger(__name__)
+
+CATALOG_CACHE_DIRECTORY = "~/.cache/water_rights_visualizer/catalogs"
+CATALOG_CACHE_VERSION = 1
+
+
+def parse_table_dates(dates: pd.Series) -> pd.Series:
+    """
+    Parse a column of dates once, falling back to dateutil for any value that pandas can't parse on its own.
+    Values that can't be parsed at all are left as None.
+    """
+    parsed = pd.to_datetime(dates.astype(str), errors="coerce").dt.date
+    parsed = parsed.astype(object).where(parsed.notna(), None)
+
+    for index in parsed.index[parsed.isna()]:
+        try:
+            parsed[index] = parser.parse(str(dates[index])).date()
+        except Exception as e:
+            logger.warning(e)
+            logger.warning(f"unable to parse date: {dates[index]}")
+
+    return parsed
+
+
+class FileCatalog:
+    """
+    Index of the files available to a data source, keyed by (tile, variable, date).
+    The table is parsed once and every lookup after that is a dictionary hit.
+    """
+
+    def __init__(self, table: pd.DataFrame):
+        """
+        Initialize the FileCatalog object.
+
+        Args:
+            table (pd.DataFrame): Table of files with at least tile, variable and date columns.
+                Any other columns are returned with each record.
+        """
+        table = table.reset_index(drop=True)
+        table["date"] = parse_table_dates(table["date"])
+        table = table[table["date"].notna()]
+
+        index = {}
+
+        # keep the first listed file for each key
+        for record in table.to_dict("records"):
+            key = (int(record["tile"]), str(record["variable"]), record["date"])
+            index.setdefault(key, record)
+
+        self.table = table
+        self.index = index
+        self.dates = sorted(set(table["date"]))
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __contains__(self, key: tuple) -> bool:
+        return key in self.index
+
+    @classmethod
+    def from_CSV(cls, CSV_filename: str, cache_directory: str = None, use_cache: bool = True) -> "FileCatalog":
+        """
+        Load a catalog from a CSV table, using a cached copy when the table hasn't changed since it was cached.
+
+        Args:
+            CSV_filename (str): The CSV table of files.
+            cache_directory (str, optional): The directory where parsed catalogs are cached.
+                Defaults to CATALOG_CACHE_DIRECTORY.
+            use_cache (bool, optional): Whether to read and write the cache. Defaults to True.
+
+        Returns:
+            FileCatalog: The catalog of the files listed in the table.
+        """
+        CSV_filename = abspath(expanduser(CSV_filename))
+
+        if not use_cache:
+            return cls(pd.read_csv(CSV_filename))
+
+        if cache_directory is None:
+            cache_directory = CATALOG_CACHE_DIRECTORY
+
+        cache_directory = abspath(expanduser(cache_directory))
+        fingerprint = (CATALOG_CACHE_VERSION, getmtime(CSV_filename), getsize(CSV_filename))
+        path_hash = md5(CSV_filename.encode()).hexdigest()[:12]
+        cache_filename = join(cache_directory, f"{basename(CSV_filename)}.{path_hash}.pkl")
+
+        catalog = cls.load(cache_filename, fingerprint)
+
+        if catalog is not None:
+            logger.info(f"loaded cached catalog of {cl.file(CSV_filename)}: {cl.file(cache_filename)}")
+            return catalog
+
+        logger.info(f"building catalog of {cl.file(CSV_filename)}")
+        catalog = cls(pd.read_csv(CSV_filename))
+        catalog.save(cache_filename, fingerprint)
+
+        return catalog
+
+    @classmethod
+    def read_cache(cls, cache_filename: str) -> (Union[object, None], Union["FileCatalog", None]):
+        """
+        Read a cached catalog along with the fingerprint of the source it was made from.
+        Returns (None, None) if there isn't a readable cache.
+        """
+        if not exists(cache_filename):
+            return None, None
+
+        try:
+            with open(cache_filename, "rb") as file:
+                fingerprint, catalog = pickle.load(file)
+        except Exception as e:
+            logger.warning(e)
+            logger.warning(f"unable to read cached catalog: {cache_filename}")
+            return None, None
+
+        if not isinstance(catalog, cls):
+            return None, None
+
+        return fingerprint, catalog
+
+    @classmethod
+    def load(cls, cache_filename: str, fingerprint: object) -> Union["FileCatalog", None]:
+        """
+        Load a cached catalog, returning None if there isn't one or it was made from a different source.
+        """
+        cached_fingerprint, catalog = cls.read_cache(cache_filename)
+
+        if catalog is None:
+            return None
+
+        if cached_fingerprint != fingerprint:
+            logger.info(f"cached catalog is stale: {cl.file(cache_filename)}")
+            return None
+
+        return catalog
+
+    def save(self, cache_filename: str, fingerprint: object):
+        """
+        Cache the catalog with the fingerprint of its source, replacing any existing cache atomically.
+        """
+        temporary_filename = f"{cache_filename}.{os.getpid()}.tmp"
+
+        try:
+            makedirs(dirname(abspath(cache_filename)), exist_ok=True)
+
+            with open(temporary_filename, "wb") as file:
+                pickle.dump((fingerprint, self), file, protocol=pickle.HIGHEST_PROTOCOL)
+
+            os.replace(temporary_filename, cache_filename)
+            logger.info(f"cached catalog: {cl.file(cache_filename)}")
+        except Exception as e:
+            logger.warning(e)
+            logger.warning(f"unable to cache catalog: {cache_filename}")
+
+            if exists(temporary_filename):
+                os.remove(temporary_filename)
+
+    def lookup(self, tile: Union[str, int], variable: str, acquisition_date: date) -> Union[dict, None]:
+        """
+        Get the record of the file for a tile, variable and date, or None if there isn't one.
+        """
+        return self.index.get((int(tile), str(variable), acquisition_date))
+
+    def inventory(self) -> (List[int], List[date]):
+        """
+        Get the years and dates available in the catalog.
+        """
+        dates_available = list(self.dates)
+        years_available = sorted(set([date_step.year for date_step in dates_available]))
+
+        return years_available, dates_available
@@ -1,26 +1,49 @@
 import contextlib
+import os
+import re
 from datetime import date, datetime
-from glob import glob
-from os.path import abspath, expanduser, exists, join, isdir, basename
+from os.path import abspath, expanduser, exists, join, isdir, basename, getmtime, getsize
 from typing import Union
 
+import pandas as pd
 from dateutil import parser
 import logging
 import cl
 from .errors import FileUnavailable
 from .data_source import DataSource
-from .variable_types import get_sources_for_variable, get_available_variable_source_for_date
+from .file_catalog import FileCatalog
+from .variable_types import VARIABLE_TYPES, get_sources_for_variable, get_available_variable_source_for_date
 
 logger = logging.getLogger(__name__)
 
+DATE_DIRECTORY_PATTERN = re.compile(r"^\d{4}\.\d{2}\.\d{2}$")
+MONTHLY_TILE_DATE_PATTERN = re.compile(r"(?=_(\d+)_(\d{6}01)_)")
+
+
+def directory_mtimes(directories: list) -> dict:
+    """
+    Get the modification time of each directory, or None for directories that no longer exist.
+    """
+    mtimes = {}
+
+    for directory in directories:
+        try:
+            mtimes[directory] = getmtime(directory)
+        except OSError:
+            mtimes[directory] = None
+
+    return mtimes
+
 
 class FilepathSource(DataSource):
-    def __init__(self, directory: str, monthly: bool = False):
+    def __init__(self, directory: str, monthly: bool = False, index_filename: str = None):
         """
         Initialize the FilepathSource object.
 
         Args:
             directory (str): The directory path where the files are located.
+            index_filename (str, optional): File to persist the index of the directory in between runs.
+                The index is rebuilt whenever any of the indexed directories has been modified. Defaults to None.
 
         Raises:
             IOError: If the directory does not exist.
@@ -30,8 +53,125 @@ class FilepathSource(DataSource):
         if not exists(directory):
             raise IOError(f"directory not found: {directory}")
 
+        if index_filename is not None:
+            index_filename = abspath(expanduser(index_filename))
+
         self.directory = directory
         self.monthly = monthly
+        self.index_filename = index_filename
+        self._catalog = None
+
+    @property
+    def catalog(self) -> FileCatalog:
+        """
+        The index of the files in the directory by (tile, mapped variable, date), built on first use.
+        """
+        if self._catalog is None:
+            self._catalog = self.load_catalog()
+
+        return self._catalog
+
+    def load_catalog(self) -> FileCatalog:
+        """
+        Load the persisted index of the directory if none of the indexed directories have changed,
+        otherwise scan the directory and persist the new index.
+        """
+        if self.index_filename is not None:
+            fingerprint, catalog = FileCatalog.read_cache(self.index_filename)
+
+            if catalog is not None and fingerprint == directory_mtimes(list(fingerprint.keys())):
+                logger.info(f"loaded index of {cl.dir(self.directory)} from {cl.file(self.index_filename)}")
+                return catalog
+
+        catalog, fingerprint = self.scan()
+
+        if self.index_filename is not None:
+            catalog.save(self.index_filename, fingerprint)
+
+        return catalog
+
+    def scan(self) -> (FileCatalog, dict):
+        """
+        Walk the directory once and index every daily and monthly file by (tile, mapped variable, date).
+
+        Returns:
+            tuple: The index of the files and the modification times of the directories that were scanned.
+        """
+        logger.info(f"indexing files under {cl.dir(self.directory)}")
+        scanned_directories = [self.directory]
+        records = []
+
+        monthly_variables = {}
+
+        for variable_type in VARIABLE_TYPES:
+            if variable_type.monthly:
+                monthly_directory = join(self.directory, variable_type.parent_dir)
+                monthly_variables.setdefault(monthly_directory, set()).add(variable_type.mapped_variable)
+
+        # {parent_dir}/*_{tile}_{YYYYMM}01_*_{variable}.tif
+        for monthly_directory, variables in sorted(monthly_variables.items()):
+            # missing directories are tracked too so that creating them invalidates the index
+            scanned_directories.append(monthly_directory)
+
+            if not isdir(monthly_directory):
+                continue
+
+            for filename in sorted(os.listdir(monthly_directory)):
+                for variable in variables:
+                    suffix = f"_{variable}.tif"
+
+                    if not filename.endswith(suffix):
+                        continue
+
+                    for tile, month_date in MONTHLY_TILE_DATE_PATTERN.findall(filename[: -len(suffix)] + "_"):
+                        records.append(
+                            {
+                                "tile": tile,
+                                "variable": variable,
+                                "date": datetime.strptime(month_date, "%Y%m%d").date(),
+                                "filename": join(monthly_directory, filename),
+                            }
+                        )
+
+        daily_variables = sorted(
+            set(variable_type.mapped_variable for variable_type in VARIABLE_TYPES if not variable_type.monthly)
+        )
+
+        # YYYY.MM.DD/**/*_{tile}_*_{variable}.tif
+        for date_directory_name in sorted(os.listdir(self.directory)):
+            date_directory = join(self.directory, date_directory_name)
+
+            if not DATE_DIRECTORY_PATTERN.match(date_directory_name) or not isdir(date_directory):
+                continue
+
+            acquisition_date = datetime.strptime(date_directory_name, "%Y.%m.%d").date()
+            filenames = []
+
+            for directory, subdirectories, directory_filenames in os.walk(date_directory):
+                scanned_directories.append(directory)
+                filenames.extend(join(directory, filename) for filename in directory_filenames)
+
+            for filename in sorted(filenames):
+                for variable in daily_variables:
+                    suffix = f"_{variable}.tif"
+
+                    if not filename.endswith(suffix):
+                        continue
+
+                    # every underscore-separated part that is followed by another part could be the tile
+                    parts = basename(filename)[: -len(suffix)].split("_")
+
+                    for tile in parts[1:-1]:
+                        if tile.isdigit():
+                            records.append(
+                                {"tile": tile, "variable": variable, "date": acquisition_date, "filename": filename}
+                            )
+
+        logger.info(f"indexed {cl.val(len(records))} files in {cl.val(len(scanned_directories))} directories")
+        catalog = FileCatalog(pd.DataFrame(records, columns=["tile", "variable", "date", "filename"]))
+        fingerprint = directory_mtimes(scanned_directories)
+
+        return catalog, fingerprint
 
     def date_directory(self, acquisition_date: Union[date, str]) -> str:
         """
@@ -57,84 +197,71 @@ class FilepathSource(DataSource):
         Returns:
             tuple: A tuple containing the list of available years and dates.
         """
-        years_available = []
-        dates_available = []
+        ET_variables = set(variable_type.mapped_variable for variable_type in get_sources_for_variable("ET"))
+        dates_available = sorted(
+            set(record_date for tile, variable, record_date in self.catalog.index.keys() if variable in ET_variables)
+        )
+        years_available = sorted(set(date_step.year for date_step in dates_available))
 
-        for variable_type in get_sources_for_variable("ET"):
-            if variable_type.monthly:
-                # Monthly data is in a single directory
-                path = join(self.directory, variable_type.parent_dir, f"*_{variable_type.mapped_variable}.tif")
-                et_files = sorted(glob(path))
-
-                for file in et_files:
-                    filename = basename(file)
-                    parts = filename.split("_")
-                    start_date = datetime.strptime(parts[-3], "%Y%m%d").date()
-                    if start_date not in dates_available:
-                        dates_available.append(start_date)
-                    if start_date.year not in years_available:
-                        years_available.append(start_date.year)
-            else:
-                # date_directory_pattern = join(self.directory, "*")
-                # YYYY.MM.DD
-                date_directory_pattern = join(self.directory, "[0-9]{4,4}.[0-9]{2,2}.[0-9]{2,2}")
-                logger.info(f"searching for date directories with pattern: {cl.val(date_directory_pattern)}")
-                date_directories = sorted(glob(date_directory_pattern))
-                date_directories = [directory for directory in date_directories if isdir(directory)]
-                logger.info(f"found {cl.val(len(date_directories))} date directories under {cl.dir(self.directory)}")
-                for directory in date_directories:
-                    date = datetime.strptime(basename(directory), "%Y.%m.%d").date()
-                    if date not in dates_available:
-                        dates_available.append(date)
-                    if date.year not in years_available:
-                        years_available.append(date.year)
-
-                logger.info(f"counted {cl.val(len(years_available))} year available in date directories")
+        logger.info(f"counted {cl.val(len(years_available))} years available under {cl.dir(self.directory)}")
 
         return years_available, dates_available
 
-    @contextlib.contextmanager
-    def get_filename(self, tile: str, variable_name: str, acquisition_date: str) -> str:
+    def find_file(self, tile: str, variable_name: str, acquisition_date: str) -> str:
         """
-        Get the filename for a specific tile, variable, and acquisition date.
-
-        Args:
-            tile (str): The tile name.
-            variable_name (str): The variable name.
-            acquisition_date (str): The acquisition date in string format.
-
-        Yields:
-            str: The filename for the tile, variable, and acquisition date.
+        Find the file in the archive for a tile, variable and date.
 
         Raises:
             FileUnavailable: If no files are found for the given parameters.
         """
+        if isinstance(acquisition_date, str):
+            acquisition_date = parser.parse(acquisition_date).date()
+        elif isinstance(acquisition_date, datetime):
+            acquisition_date = acquisition_date.date()
 
         variable_source = get_available_variable_source_for_date(variable_name, acquisition_date)
         mapped_variable = variable_source.mapped_variable
 
         if variable_source.monthly:
-            pattern = join(
-                self.directory,
-                variable_source.parent_dir,
-                f"*_{tile}_{acquisition_date:%Y%m}01_*_{mapped_variable}.tif",
-            )
-            logger.info(f"searching monthly pattern: {cl.val(pattern)}")
-            matches = sorted(glob(pattern))
+            file_date = acquisition_date.replace(day=1)
         else:
-            raster_directory = self.date_directory(acquisition_date)
-            pattern = join(raster_directory, "**", f"*_{tile}_*_{mapped_variable}.tif")
-            logger.info(f"searching daily pattern: {cl.val(pattern)}")
-            matches = sorted(glob(pattern, recursive=True))
+            file_date = acquisition_date
 
-        if len(matches) == 0:
+        match = self.catalog.lookup(tile, mapped_variable, file_date)
+
+        if match is None:
             raise FileUnavailable(
                 f"no {'month' if self.monthly else 'day'} files found for tile {tile} variable {mapped_variable} date {acquisition_date}"
             )
 
-        input_filename = matches[0]
+        input_filename = match["filename"]
         logger.info(
             f"file for tile {cl.place(tile)} variable {cl.name(mapped_variable)} date {cl.time(acquisition_date)}: {cl.file(input_filename)}"
         )
 
+        return input_filename
+
+    def file_identity(self, tile: str, variable_name: str, acquisition_date: str) -> str:
+        input_filename = self.find_file(tile, variable_name, acquisition_date)
+
+        return f"{input_filename}:{getmtime(input_filename)}:{getsize(input_filename)}"
+
+    @contextlib.contextmanager
+    def get_filename(self, tile: str, variable_name: str, acquisition_date: str) -> str:
+        """
+        Get the filename for a specific tile, variable, and acquisition date.
+
+        Args:
+            tile (str): The tile name.
+            variable_name (str): The variable name.
+            acquisition_date (str): The acquisition date in string format.
+
+        Yields:
+            str: The filename for the tile, variable, and acquisition date.
+
+        Raises:
+            FileUnavailable: If no files are found for the given parameters.
+        """
+
+        input_filename = self.find_file(tile, variable_name, acquisition_date)
         yield input_filename
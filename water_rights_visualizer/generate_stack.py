@@ -1,22 +1,36 @@
+import pickle
+from concurrent.futures import ProcessPoolExecutor
 from datetime import date, datetime
+from functools import partial
 from logging import getLogger
 from os import makedirs
-from os.path import exists, join, dirname
-from typing import List
+from os.path import exists, dirname
+from typing import Iterable, List, Tuple
 
-import h5py
 import numpy as np
 from affine import Affine
-from shapely import Polygon
 
-from .constants import WGS84
+from raster import Raster
+
+from .chunked_stack import generate_disk_stack, stack_fits_in_memory, sum_months_by_block
+from .constants import (
+    WGS84,
+    MONTHS_IN_YEAR,
+    STACK_MEMORY_BUDGET,
+    SUBSET_BATCH_DATES,
+    SUBSET_WORKERS,
+    UNCERTAINTY_VARIABLES,
+)
 from .data_source import DataSource
 from .errors import BlankOutput, FileUnavailable
-from .generate_subset import generate_subset
+from .generate_subset import generate_subset, generate_subset_batch
 from .interpolate_stack import interpolate_stack
-from datetime import timedelta
+from .prefetch import required_files
+from .roi_context import ROIContext
+from .stack_cache import read_stack_cache, stack_fingerprint, write_stack_cache
+from .subset_store import SubsetStore, subset_filename
 from .date_helpers import get_days_in_year, get_day_of_year, get_one_month_slice, get_days_in_month
-from .variable_types import get_available_variable_source_for_date
+from .variable_types import get_available_variable_source_for_date, get_interpolation_for_year
 
 logger = getLogger(__name__)
 
@@ -28,6 +42,340 @@ def generate_sparse_stack(total_date_steps: int, x_rows: int, y_cols: int) -> np
     return np.full((total_date_steps, x_rows, y_cols), np.nan, dtype=np.float32)
 
 
+def fill_layers(stack: np.ndarray, layers: List[Tuple[int, np.ndarray]]):
+    """
+    Fill the missing values of several layers of a sparse stack at once, then empty the list of layers.
+    Images are given in date order, and the same layer may be filled by several of them.
+    """
+    if len(layers) == 0:
+        return
+
+    merged = {}
+
+    for index, image in layers:
+        image = np.asarray(image)
+
+        if index in merged:
+            # earlier dates take precedence within a layer, as when they're filled one at a time
+            merged[index] = np.where(np.isnan(merged[index]), image, merged[index])
+        else:
+            merged[index] = image
+
+    indices = list(merged)
+    images = np.stack(list(merged.values()))
+    existing = stack[indices]
+    stack[indices] = np.where(np.isnan(existing), images, existing)
+    layers.clear()
+
+
+def generate_variable_subset(
+    input_datastore: DataSource,
+    variable_name: str,
+    date_step: date,
+    ROI_name: str,
+    ROI_latlon,
+    ROI_acres: float,
+    subset_directory: str,
+    target_CRS: str,
+    subset_cache_directory: str = None,
+    ROI_context: ROIContext = None,
+    write_subsets: bool = True,
+):
+    """
+    Generate the subset of a variable for a date.
+    """
+    filename = subset_filename(subset_directory, date_step, ROI_name, variable_name)
+    logger.info(f"{variable_name.replace('_', ' ')} subset file: {filename}")
+
+    return generate_subset(
+        input_datastore=input_datastore,
+        acquisition_date=date_step,
+        ROI_name=ROI_name,
+        ROI_latlon=ROI_latlon,
+        ROI_acres=ROI_acres,
+        variable_name=variable_name,
+        subset_filename=filename,
+        target_CRS=target_CRS,
+        subset_cache_directory=subset_cache_directory,
+        ROI_context=ROI_context,
+        write_subset=write_subsets,
+    )
+
+
+def try_subset(function, **kwargs):
+    """
+    Call a subset function, returning the exception it raises instead of raising it,
+    so that the outcome can be passed back from a worker process and raised where the subset is used.
+    """
+    try:
+        return function(**kwargs)
+    except Exception as e:
+        try:
+            pickle.dumps(e)
+        except Exception:
+            e = RuntimeError(f"{type(e).__name__}: {e}")
+
+        return e
+
+
+def subset_result(outcome):
+    """
+    Return a subset generated by try_subset, raising the exception it returned instead if there was one.
+    """
+    if isinstance(outcome, Exception):
+        raise outcome
+
+    return outcome
+
+
+def generate_uncertainty_subsets(**kwargs) -> dict:
+    """
+    Generate the ET_MIN, ET_MAX and COUNT subsets of a date, which are only used to get the error percentage.
+    The variables after the first one that fails aren't generated.
+
+    Returns:
+        dict: The subset or exception of each uncertainty variable, keyed by variable name.
+    """
+    subsets = {}
+
+    for variable_name in UNCERTAINTY_VARIABLES:
+        subsets[variable_name] = try_subset(generate_variable_subset, variable_name=variable_name, **kwargs)
+
+        if isinstance(subsets[variable_name], Exception):
+            break
+
+    return subsets
+
+
+def generate_date_subsets(
+    date_step: date,
+    input_datastore: DataSource,
+    ROI_name: str,
+    ROI_latlon,
+    ROI_acres: float,
+    subset_directory: str,
+    target_CRS: str,
+    subset_cache_directory: str = None,
+    ROI_context: ROIContext = None,
+    batch_subsets: dict = None,
+    write_subsets: bool = True,
+) -> dict:
+    """
+    Generate the subsets of a date, independently of any other date, so that dates can be processed in parallel.
+
+    Args:
+        date_step (date): The date of the subsets.
+        input_datastore (DataSource): The data source.
+        ROI_name (str): The name of the region of interest.
+        ROI_latlon (Polygon): The polygon representing the latitude and longitude coordinates of the ROI.
+        ROI_acres (float): The area of the ROI in acres.
+        subset_directory (str): The directory where the generated subsets will be saved.
+        target_CRS (str): The target coordinate reference system (CRS) for the subsets.
+        subset_cache_directory (str, optional): The directory of the subset cache shared between runs.
+        ROI_context (ROIContext, optional): The target grid and tiles of the ROI.
+        batch_subsets (dict, optional): Subsets or exceptions already generated for a batch of dates,
+            keyed by variable name and date.
+        write_subsets (bool, optional): Whether to write each subset to the subset directory. Defaults to True.
+
+    Returns:
+        dict: The subset or exception of ET, PET and ESI if the PET subset failed, and a dict of the subset or exception
+            of each uncertainty variable. Nothing else is generated if the ET subset failed.
+    """
+    logger.info(f"date: {date_step.strftime('%Y-%m-%d')}")
+
+    if not exists(subset_directory):
+        logger.info(f"creating subset directory: {subset_directory}")
+        makedirs(subset_directory, exist_ok=True)
+
+    kwargs = dict(
+        input_datastore=input_datastore,
+        date_step=date_step,
+        ROI_name=ROI_name,
+        ROI_latlon=ROI_latlon,
+        ROI_acres=ROI_acres,
+        subset_directory=subset_directory,
+        target_CRS=target_CRS,
+        subset_cache_directory=subset_cache_directory,
+        ROI_context=ROI_context,
+        write_subsets=write_subsets,
+    )
+
+    def variable_subset(variable_name: str):
+        if batch_subsets is not None and (variable_name, date_step) in batch_subsets:
+            return batch_subsets[(variable_name, date_step)]
+
+        return try_subset(generate_variable_subset, variable_name=variable_name, **kwargs)
+
+    subsets = {"ET": variable_subset("ET")}
+
+    if isinstance(subsets["ET"], Exception):
+        return subsets
+
+    count_source = get_available_variable_source_for_date("COUNT", date_step)
+
+    if count_source and count_source.monthly:
+        subsets["uncertainty"] = generate_uncertainty_subsets(**kwargs)
+
+    if get_available_variable_source_for_date("PET", date_step):
+        subsets["PET"] = variable_subset("PET")
+    else:
+        subsets["PET"] = FileUnavailable(f"no PET source available for date {date_step.strftime('%Y-%m-%d')}")
+
+    if isinstance(subsets["PET"], Exception):
+        subsets["ESI"] = try_subset(generate_variable_subset, variable_name="ESI", **kwargs)
+
+    return subsets
+
+
+def generate_batch_subsets(
+    dates: List[date],
+    input_datastore: DataSource,
+    ROI_name: str,
+    ROI_latlon,
+    subset_directory: str,
+    target_CRS: str,
+    subset_cache_directory: str = None,
+    ROI_context: ROIContext = None,
+    write_subsets: bool = True,
+) -> dict:
+    """
+    Generate the daily ET and PET subsets of a batch of dates together, reading the files of each tile as one cube.
+    Monthly sources are left to be generated one date at a time, and so is PET for dates whose ET subset failed.
+
+    Returns:
+        dict: The subset or exception of each variable and date that was generated, keyed by variable name and date.
+    """
+    if not exists(subset_directory):
+        logger.info(f"creating subset directory: {subset_directory}")
+        makedirs(subset_directory, exist_ok=True)
+
+    batch_subsets = {}
+
+    for variable_name in ("ET", "PET"):
+        variable_dates = []
+
+        for date_step in dates:
+            source = get_available_variable_source_for_date(variable_name, date_step)
+
+            if source is None or source.monthly:
+                continue
+
+            if variable_name == "PET" and not isinstance(batch_subsets.get(("ET", date_step)), Raster):
+                continue
+
+            variable_dates.append(date_step)
+
+        if len(variable_dates) == 0:
+            continue
+
+        try:
+            subsets = generate_subset_batch(
+                input_datastore=input_datastore,
+                variable_name=variable_name,
+                dates=variable_dates,
+                ROI_name=ROI_name,
+                ROI_latlon=ROI_latlon,
+                subset_filenames=[
+                    subset_filename(subset_directory, date_step, ROI_name, variable_name) for date_step in variable_dates
+                ],
+                target_CRS=target_CRS,
+                subset_cache_directory=subset_cache_directory,
+                ROI_context=ROI_context,
+                write_subsets=write_subsets,
+            )
+        except Exception as e:
+            logger.exception(e)
+            logger.warning(f"unable to generate batch of {variable_name} subsets, generating one date at a time")
+            continue
+
+        for date_step, subset in subsets.items():
+            batch_subsets[(variable_name, date_step)] = subset
+
+    return batch_subsets
+
+
+def generate_subsets_for_dates(
+    input_datastore: DataSource,
+    dates: List[date],
+    ROI_name: str,
+    ROI_latlon,
+    ROI_acres: float,
+    subset_directory: str,
+    target_CRS: str,
+    subset_workers: int = None,
+    subset_cache_directory: str = None,
+    ROI_context: ROIContext = None,
+    batch_dates: int = None,
+    write_subsets: bool = True,
+) -> Iterable[dict]:
+    """
+    Generate the subsets of each date, in a pool of worker processes if more than one worker is given.
+    Serially, the daily ET and PET subsets of each batch of dates are read from each tile at once.
+
+    Returns:
+        Iterable[dict]: The subsets of each date in the order of the dates.
+    """
+    if subset_workers is None:
+        subset_workers = SUBSET_WORKERS
+
+    if batch_dates is None:
+        batch_dates = SUBSET_BATCH_DATES
+
+    generate = partial(
+        generate_date_subsets,
+        input_datastore=input_datastore,
+        ROI_name=ROI_name,
+        ROI_latlon=ROI_latlon,
+        ROI_acres=ROI_acres,
+        subset_directory=subset_directory,
+        target_CRS=target_CRS,
+        subset_cache_directory=subset_cache_directory,
+        ROI_context=ROI_context,
+        write_subsets=write_subsets,
+    )
+
+    if subset_workers > 1 and len(dates) > 1:
+        try:
+            pickle.dumps(input_datastore)
+        except Exception as e:
+            logger.warning(e)
+            logger.warning(f"data source can't be passed to worker processes, generating subsets serially")
+            subset_workers = 1
+
+    if (subset_workers <= 1 or len(dates) <= 1) and batch_dates > 1 and len(dates) > 1:
+        generate_batch = partial(
+            generate_batch_subsets,
+            input_datastore=input_datastore,
+            ROI_name=ROI_name,
+            ROI_latlon=ROI_latlon,
+            subset_directory=subset_directory,
+            target_CRS=target_CRS,
+            subset_cache_directory=subset_cache_directory,
+            ROI_context=ROI_context,
+            write_subsets=write_subsets,
+        )
+
+        def generate_batches():
+            # generate each batch as its first date is assembled
+            for start in range(0, len(dates), batch_dates):
+                batch = dates[start : start + batch_dates]
+                batch_subsets = generate_batch(batch)
+
+                for date_step in batch:
+                    yield generate(date_step, batch_subsets=batch_subsets)
+
+        return generate_batches()
+
+    if subset_workers <= 1 or len(dates) <= 1:
+        # generate each date as it's assembled
+        return map(generate, dates)
+
+    logger.info(f"generating subsets for {len(dates)} dates with {subset_workers} worker processes")
+
+    with ProcessPoolExecutor(max_workers=subset_workers) as executor:
+        return list(executor.map(generate, dates))
+
+
 def generate_stack(
     ROI_name: str,
     ROI_latlon,
@@ -38,6 +386,14 @@ def generate_stack(
     dates_available: List[date],
     stack_filename: str,
     target_CRS: str = None,
+    interpolation: str = None,
+    monthly_native: bool = True,
+    subset_workers: int = None,
+    memory_budget: int = None,
+    subset_cache_directory: str = None,
+    ROI_context: ROIContext = None,
+    subset_store: SubsetStore = None,
+    use_stack_cache: bool = True,
 ) -> (np.ndarray, np.ndarray, Affine):
     """
     Generates a stack of data for a given region of interest (ROI) and year.
@@ -52,35 +408,123 @@ def generate_stack(
         dates_available (List[date]): A list of available dates for the data.
         stack_filename (str): The filename of the generated stack.
         target_CRS (str, optional): The target coordinate reference system (CRS) for the stack. Defaults to None.
+        interpolation (str, optional): The interpolation method used to fill both stacks, overriding the method of
+            each variable's source ("nearest", "linear", "previous" or "monthly"). Defaults to None.
+        monthly_native (bool, optional): Whether years where both ET and PET come from monthly sources produce
+            12-layer monthly stacks instead of daily stacks. Defaults to True.
+        subset_workers (int, optional): The number of worker processes that generate the subsets of each date,
+            where 1 generates them serially. Defaults to SUBSET_WORKERS.
+        memory_budget (int, optional): The memory in bytes that the stacks may take. Larger ROIs keep their sparse stacks
+            on disk and are interpolated in blocks of rows, returning 12-layer monthly sums. Defaults to STACK_MEMORY_BUDGET.
+        subset_cache_directory (str, optional): The directory of the subset cache shared between runs, so that subsets
+            already generated for the same ROI and inputs are reused. Defaults to SUBSET_CACHE_DIRECTORY.
+        ROI_context (ROIContext, optional): The target grid and tiles of the ROI, computed once per ROI.
+            Defaults to the context of ROI_latlon and target_CRS.
+        subset_store (SubsetStore, optional): Where the ET, PPT and uncertainty subsets of the year are kept for the
+            uncertainty, which also exports every subset to the subset directory if requested.
+            Defaults to a store of the subset directory that keeps them in memory.
+        use_stack_cache (bool, optional): Whether a cached stack is loaded instead of generating the stack.
+            A cached stack doesn't fill the subset store, so callers that need the subsets skip the cache.
+            The generated stack is cached either way. Defaults to True.
 
     Returns:
-        Tuple[np.ndarray, np.ndarray, Affine]: A tuple containing the generated stack, the interpolated stack, and the affine transformation.
+        Tuple[np.ndarray, np.ndarray, Affine]: A tuple containing the ET stack, the PET stack, and the affine transformation.
+            The stacks have one layer per day of the year, or one layer per month for monthly-native years
+            and for stacks processed in blocks to fit the memory budget.
+            Stacks loaded from the stack cache keep its file open until they're closed with close_stack.
     """
     if target_CRS is None:
         target_CRS = WGS84
 
-    if exists(stack_filename):
-        logger.info(f"loading existing stack: {stack_filename}")
+    if memory_budget is None:
+        memory_budget = STACK_MEMORY_BUDGET
 
-        with h5py.File(stack_filename, "r") as stack_file:
-            logger.info(f"loading ET: {stack_filename}")
-            ET_stack = np.array(stack_file["ET"])
-            logger.info(f"loading PET: {stack_filename}")
-            PET_stack = np.array(stack_file["PET"])
-            affine = Affine(*list(stack_file["affine"]))
+    if ROI_context is None:
+        ROI_context = ROIContext(ROI_latlon=ROI_latlon, target_CRS=target_CRS)
 
-        return ET_stack, PET_stack, affine
+    if subset_store is None:
+        subset_store = SubsetStore(subset_directory, ROI_name)
 
-    logger.info(f"generating stack")
+    ET_interpolation = interpolation or get_interpolation_for_year("ET", year)
+    PET_interpolation = interpolation or get_interpolation_for_year("PET", year)
+
+    # Monthly sources are summed back into months anyway, so keep them as months instead of spreading them over days
+    monthly_native = monthly_native and ET_interpolation == "monthly" and PET_interpolation == "monthly"
+
+    if monthly_native:
+        stack_layers = MONTHS_IN_YEAR
+    else:
+        stack_layers = get_days_in_year(year)
 
     ET_sparse_stack = None
     ESI_sparse_stack = None
     PET_sparse_stack = None
+    in_memory = None
+    # daily layers are filled in batches instead of one date at a time
+    ET_layers = []
+    PET_layers = []
+
+    def sparse_stack(rows: int, cols: int) -> np.ndarray:
+        nonlocal in_memory
+
+        # decide once, from the shape of the first subset, where the stacks are kept
+        if in_memory is None:
+            in_memory = stack_fits_in_memory(stack_layers, rows, cols, memory_budget)
+
+            if not in_memory:
+                logger.info(f"stacks of {stack_layers} x {rows} x {cols} exceed memory budget, keeping them on disk")
+
+        if in_memory:
+            return generate_sparse_stack(stack_layers, rows, cols)
+        else:
+            return generate_disk_stack(stack_layers, rows, cols, directory=dirname(stack_filename) or None)
 
     dates_in_year = [date_step for date_step in dates_available if date_step.year == year]
 
     dates_in_year = sorted(set(dates_in_year))
 
+    fingerprint = stack_fingerprint(
+        ROI_latlon=ROI_latlon,
+        year=year,
+        dates=dates_in_year,
+        target_CRS=target_CRS,
+        ET_interpolation=ET_interpolation,
+        PET_interpolation=PET_interpolation,
+        monthly_native=monthly_native,
+        input_datastore=input_datastore,
+        tiles=ROI_context.tiles,
+    )
+
+    cached_stack = read_stack_cache(stack_filename, fingerprint) if use_stack_cache else None
+
+    if cached_stack is not None:
+        logger.info(f"loading existing stack: {stack_filename}")
+        return cached_stack
+
+    logger.info(f"generating stack")
+
+    if monthly_native:
+        logger.info(f"generating monthly stack for year: {year}")
+
+    # Fetch the files for every subset of the year up front, so the subsets below only read local files
+    try:
+        input_datastore.prefetch(
+            required_files(
+                ROI_name=ROI_name,
+                ROI_latlon=ROI_latlon,
+                year=year,
+                dates_available=dates_in_year,
+                subset_directory=subset_directory,
+                tiles=ROI_context.tiles,
+                input_datastore=input_datastore,
+                target_geometry=ROI_context.target_geometry,
+                subset_cache_directory=subset_cache_directory,
+            )
+        )
+    except Exception as e:
+        logger.exception(e)
+        logger.info(f"problem prefetching files for year: {year}, continuing...")
+
     # Process monthly PPT data first
     for month in range(1, 13):
         if not exists(subset_directory):
@@ -90,12 +534,12 @@ def generate_stack(
         date_step = datetime(year, month, 1).date()
         ppt_source = get_available_variable_source_for_date("PPT", date_step)
 
-        PPT_subset_filename = join(subset_directory, f"{date_step.strftime('%Y.%m.%d')}_{ROI_name}_PPT_subset.tif")
+        PPT_subset_filename = subset_filename(subset_directory, date_step, ROI_name, "PPT")
         logger.info(f"PPT subset file: {PPT_subset_filename}")
 
         try:
             if ppt_source and ppt_source.monthly:
-                generate_subset(
+                PPT_subset = generate_subset(
                     input_datastore=input_datastore,
                     acquisition_date=date_step,
                     ROI_name=ROI_name,
@@ -104,7 +548,12 @@ def generate_stack(
                     variable_name="PPT",
                     subset_filename=PPT_subset_filename,
                     target_CRS=target_CRS,
+                    subset_cache_directory=subset_cache_directory,
+                    ROI_context=ROI_context,
+                    write_subset=False,
                 )
+
+                subset_store.put("PPT", date_step, PPT_subset)
         # Just keep processing as this only causes issues with showing uncertainty on the report
         except Exception as e:
             logger.exception(e)
@@ -113,45 +562,24 @@ def generate_stack(
     if len(dates_in_year) == 0:
         raise ValueError(f"no dates for year: {year}")
 
-    for date_step in dates_in_year:
-        logger.info(f"date: {date_step.strftime('%Y-%m-%d')}")
-
-        if not exists(subset_directory):
-            logger.info(f"creating subset directory: {subset_directory}")
-            makedirs(subset_directory)
-
-        ET_subset_filename = join(subset_directory, f"{date_step.strftime('%Y.%m.%d')}_{ROI_name}_ET_subset.tif")
-        logger.info(f"ET subset file: {ET_subset_filename}")
-
-        count_source = get_available_variable_source_for_date("COUNT", date_step)
-
-        if count_source and count_source.monthly:
-            count_subset_filename = join(subset_directory, f"{date_step.strftime('%Y.%m.%d')}_{ROI_name}_COUNT_subset.tif")
-            logger.info(f"COUNT subset file: {count_subset_filename}")
-
-            et_min_subset_filename = join(subset_directory, f"{date_step.strftime('%Y.%m.%d')}_{ROI_name}_ET_MIN_subset.tif")
-            logger.info(f"ET MIN subset file: {et_min_subset_filename}")
-
-            et_max_subset_filename = join(subset_directory, f"{date_step.strftime('%Y.%m.%d')}_{ROI_name}_ET_MAX_subset.tif")
-            logger.info(f"ET MAX subset file: {et_max_subset_filename}")
-
-        ESI_subset_filename = join(subset_directory, f"{date_step.strftime('%Y.%m.%d')}_{ROI_name}_ESI_subset.tif")
-        logger.info(f"ESI subset file: {ESI_subset_filename}")
-
-        PET_subset_filename = join(subset_directory, f"{date_step.strftime('%Y.%m.%d')}_{ROI_name}_PET_subset.tif")
-        logger.info(f"PET subset file: {PET_subset_filename}")
-
+    date_subsets = generate_subsets_for_dates(
+        input_datastore=input_datastore,
+        dates=dates_in_year,
+        ROI_name=ROI_name,
+        ROI_latlon=ROI_latlon,
+        ROI_acres=ROI_acres,
+        subset_directory=subset_directory,
+        target_CRS=target_CRS,
+        subset_workers=subset_workers,
+        subset_cache_directory=subset_cache_directory,
+        ROI_context=ROI_context,
+        write_subsets=False,
+    )
+
+    # Assemble the stacks in date order, whether the subsets were generated serially or in parallel
+    for date_step, subsets in zip(dates_in_year, date_subsets):
         try:
-            ET_subset = generate_subset(
-                input_datastore=input_datastore,
-                acquisition_date=date_step,
-                ROI_name=ROI_name,
-                ROI_latlon=ROI_latlon,
-                ROI_acres=ROI_acres,
-                variable_name="ET",
-                subset_filename=ET_subset_filename,
-                target_CRS=target_CRS,
-            )
+            ET_subset = subset_result(subsets["ET"])
 
             affine = ET_subset.geometry.affine
         except BlankOutput as e:
@@ -165,30 +593,17 @@ def generate_stack(
             logger.info(f"problem generating ET subset for date: {date_step.strftime('%Y-%m-%d')}")
             continue
 
-        try:
-            if count_source and count_source.monthly:
-                # These are just used to get error percentage
-                uncertainty_variables = {
-                    "ET_MIN": et_min_subset_filename,
-                    "ET_MAX": et_max_subset_filename,
-                    "COUNT": count_subset_filename,
-                }
-
-                for variable_name, subset_filename in uncertainty_variables.items():
-                    generate_subset(
-                        input_datastore=input_datastore,
-                        acquisition_date=date_step,
-                        ROI_name=ROI_name,
-                        ROI_latlon=ROI_latlon,
-                        ROI_acres=ROI_acres,
-                        variable_name=variable_name,
-                        subset_filename=subset_filename,
-                        target_CRS=target_CRS,
-                    )
-        # Just keep processing as this only causes issues with showing uncertainty on the report
-        except Exception as e:
-            logger.exception(e)
-            logger.info(f"problem generating uncertainty subset for date: {date_step.strftime('%Y-%m-%d')}, continuing...")
+        subset_store.put("ET", date_step, ET_subset)
+
+        for variable_name, uncertainty_subset in subsets.get("uncertainty", {}).items():
+            try:
+                subset_store.put(variable_name, date_step, subset_result(uncertainty_subset))
+            # Just keep processing as this only causes issues with showing uncertainty on the report
+            except Exception as e:
+                logger.exception(e)
+                logger.info(
+                    f"problem generating uncertainty subset for date: {date_step.strftime('%Y-%m-%d')}, continuing..."
+                )
 
         subset_shape = ET_subset.shape
 
@@ -196,20 +611,8 @@ def generate_stack(
 
         # Check for PET layers first, then use ESI if not available
         try:
-            pet_source = get_available_variable_source_for_date("PET", date_step)
-            if not pet_source:
-                raise FileUnavailable(f"no PET source available for date {date_step.strftime('%Y-%m-%d')}")
-
-            PET_subset = generate_subset(
-                input_datastore=input_datastore,
-                acquisition_date=date_step,
-                ROI_name=ROI_name,
-                ROI_latlon=ROI_latlon,
-                ROI_acres=ROI_acres,
-                variable_name="PET",
-                subset_filename=PET_subset_filename,
-                target_CRS=target_CRS,
-            )
+            PET_subset = subset_result(subsets["PET"])
+            subset_store.export("PET", date_step, PET_subset)
 
             affine = PET_subset.geometry.affine
             subset_shape = PET_subset.shape
@@ -219,35 +622,47 @@ def generate_stack(
             day = date_step.day
 
             if PET_sparse_stack is None:
-                days_in_year = get_days_in_year(year)
-                PET_sparse_stack = generate_sparse_stack(days_in_year, rows, cols)
+                PET_sparse_stack = sparse_stack(rows, cols)
 
             source = get_available_variable_source_for_date("PET", date_step)
 
-            if source.monthly:
+            if monthly_native:
+                PET_sparse_stack[month - 1, :, :] = PET_subset
+            elif source.monthly:
+                fill_layers(PET_sparse_stack, PET_layers)
                 # # Fill in the rest of the month
                 day_of_year, last_doy = get_one_month_slice(year, month)
                 days_in_month = get_days_in_month(year, month)
                 PET_sparse_stack[day_of_year:last_doy, :, :] = PET_subset / days_in_month
             else:
                 day_of_year = get_day_of_year(year, month, day)
+                PET_layers.append((day_of_year, PET_subset))
 
-                PET_doy_image = PET_sparse_stack[day_of_year, :, :]
-                PET_sparse_stack[day_of_year, :, :] = np.where(np.isnan(PET_doy_image), PET_subset, PET_doy_image)
+                if len(PET_layers) >= SUBSET_BATCH_DATES:
+                    fill_layers(PET_sparse_stack, PET_layers)
 
         except Exception as e:
-            try:
-                ESI_subset = generate_subset(
+            # the ESI subset was only generated up front if the PET subset failed
+            if "ESI" not in subsets:
+                subsets["ESI"] = try_subset(
+                    generate_variable_subset,
                     input_datastore=input_datastore,
-                    acquisition_date=date_step,
+                    variable_name="ESI",
+                    date_step=date_step,
                     ROI_name=ROI_name,
                     ROI_latlon=ROI_latlon,
                     ROI_acres=ROI_acres,
-                    variable_name="ESI",
-                    subset_filename=ESI_subset_filename,
+                    subset_directory=subset_directory,
                     target_CRS=target_CRS,
+                    subset_cache_directory=subset_cache_directory,
+                    ROI_context=ROI_context,
+                    write_subsets=False,
                 )
 
+            try:
+                ESI_subset = subset_result(subsets["ESI"])
+                subset_store.export("ESI", date_step, ESI_subset)
+
                 affine = ESI_subset.geometry.affine
                 subset_shape = ESI_subset.shape
             except BlankOutput as e:
@@ -263,22 +678,36 @@ def generate_stack(
         day = date_step.day
 
         if ET_sparse_stack is None:
-            days_in_year = get_days_in_year(year)
-            ET_sparse_stack = generate_sparse_stack(days_in_year, rows, cols)
+            ET_sparse_stack = sparse_stack(rows, cols)
 
         if ESI_sparse_stack is None:
-            days_in_year = get_days_in_year(year)
-            ESI_sparse_stack = generate_sparse_stack(days_in_year, rows, cols)
+            ESI_sparse_stack = sparse_stack(rows, cols)
+
+        if monthly_native:
+            ET_month_image = ET_sparse_stack[month - 1, :, :]
+            ET_sparse_stack[month - 1, :, :] = np.where(np.isnan(ET_month_image), ET_subset, ET_month_image)
+
+            if not PET_subset and PET_sparse_stack is None and ESI_subset:
+                ESI_month_image = ESI_sparse_stack[month - 1, :, :]
+                ESI_sparse_stack[month - 1, :, :] = np.where(np.isnan(ESI_month_image), ESI_subset, ESI_month_image)
+
+            continue
 
         day_of_year, last_doy = get_one_month_slice(year, month)
         days_in_month = get_days_in_month(year, month)
 
-        ET_doy_image = ET_sparse_stack[day_of_year, :, :]
-        ET_sparse_stack[day_of_year, :, :] = np.where(np.isnan(ET_doy_image), ET_subset, ET_doy_image)
         source = get_available_variable_source_for_date("PET", date_step)
         if source and source.monthly:
+            fill_layers(ET_sparse_stack, ET_layers)
+            ET_doy_image = ET_sparse_stack[day_of_year, :, :]
+            ET_sparse_stack[day_of_year, :, :] = np.where(np.isnan(ET_doy_image), ET_subset, ET_doy_image)
             # Fill in the rest of the month
             ET_sparse_stack[day_of_year:last_doy, :, :] = ET_subset / days_in_month
+        else:
+            ET_layers.append((day_of_year, ET_subset))
+
+            if len(ET_layers) >= SUBSET_BATCH_DATES:
+                fill_layers(ET_sparse_stack, ET_layers)
 
         if not PET_subset and PET_sparse_stack is None and ESI_subset:
             ESI_doy_image = ESI_sparse_stack[day_of_year, :, :]
@@ -288,35 +717,61 @@ def generate_stack(
                 # Fill in the rest of the month
                 ESI_sparse_stack[day_of_year:last_doy, :, :] = ESI_subset / days_in_month
 
+    if ET_sparse_stack is not None:
+        fill_layers(ET_sparse_stack, ET_layers)
+
+    if PET_sparse_stack is not None:
+        fill_layers(PET_sparse_stack, PET_layers)
+
     if ET_sparse_stack is None:
         raise ValueError("no ET stack generated")
 
     if PET_sparse_stack is None and ESI_sparse_stack is None:
         raise ValueError("no PET or ESI stack generated")
 
-    PET_sparse_stack = PET_sparse_stack if PET_sparse_stack is not None else ET_sparse_stack / ESI_sparse_stack
-
-    logger.info(f"interpolating ET stack for year: {year}")
-    ET_stack = interpolate_stack(ET_sparse_stack)
-    PET_stack = interpolate_stack(PET_sparse_stack)
-
-    stack_directory = dirname(stack_filename)
-
-    if not exists(stack_directory):
-        makedirs(stack_directory)
+    if PET_sparse_stack is None:
+        if not monthly_native:
+            PET_interpolation = interpolation or get_interpolation_for_year("ESI", year)
+
+        if in_memory:
+            PET_sparse_stack = ET_sparse_stack / ESI_sparse_stack
+
+    if in_memory:
+        logger.info(f"interpolating ET stack for year {year} with {ET_interpolation} interpolation")
+        ET_stack = interpolate_stack(ET_sparse_stack, method=ET_interpolation, year=year)
+        logger.info(f"interpolating PET stack for year {year} with {PET_interpolation} interpolation")
+        PET_stack = interpolate_stack(PET_sparse_stack, method=PET_interpolation, year=year)
+    else:
+        rows, cols = ET_sparse_stack.shape[1:]
+
+        if PET_sparse_stack is None:
+            # derive PET from ESI one block at a time instead of as a whole stack
+            read_PET_block = lambda block_slice: ET_sparse_stack[:, block_slice] / ESI_sparse_stack[:, block_slice]
+        else:
+            read_PET_block = lambda block_slice: PET_sparse_stack[:, block_slice]
+
+        logger.info(f"summing ET stack for year {year} into months in blocks")
+        ET_stack = sum_months_by_block(
+            lambda block_slice: ET_sparse_stack[:, block_slice],
+            stack_layers,
+            rows,
+            cols,
+            year=year,
+            method=ET_interpolation,
+            memory_budget=memory_budget,
+        )
+        logger.info(f"summing PET stack for year {year} into months in blocks")
+        PET_stack = sum_months_by_block(
+            read_PET_block,
+            stack_layers,
+            rows,
+            cols,
+            year=year,
+            method=PET_interpolation,
+            memory_budget=memory_budget,
+        )
 
     logger.info(f"writing stack: {stack_filename}")
-    # with h5py.File(stack_filename, "w") as stack_file:
-    #     stack_file["ET"] = ET_stack
-    #     stack_file["PET"] = PET_stack
-
-    #     stack_file["affine"] = (
-    #         affine.a,
-    #         affine.b,
-    #         affine.c,
-    #         affine.d,
-    #         affine.e,
-    #         affine.f
-    #     )
+    write_stack_cache(stack_filename, ET_stack, PET_stack, affine, fingerprint)
 
     return ET_stack, PET_stack, affine
@@ -1,12 +1,12 @@
+from contextlib import ExitStack
 from datetime import date
 from logging import getLogger
-from os.path import exists
-from typing import Union
+from os import makedirs
+from os.path import abspath, dirname, exists
+from typing import Dict, List, Union
 
-import geopandas as gpd
 import numpy as np
 import rasterio
-from affine import Affine
 from rasterio.warp import reproject
 from rasterio.windows import Window
 from rasterio.windows import transform as window_transform
@@ -16,15 +16,49 @@ import raster as rt
 from raster import Raster, RasterGrid
 
 import cl
-from .constants import WGS84, CELL_SIZE_DEGREES
+from .constants import WGS84, CELL_SIZE_DEGREES, SUBSET_CACHE_DIRECTORY
 from .data_source import DataSource
 from .errors import BlankOutput
-from .select_tiles import select_tiles
+from .roi_context import ROIContext
+from .subset_cache import SubsetCache, subset_key
 from .colors import ET_COLORMAP
 
 logger = getLogger(__name__)
 
 
+def cached_subset_key(
+    input_datastore: DataSource,
+    tiles: List[str],
+    ROI_latlon,
+    target_geometry: RasterGrid,
+    variable_name: str,
+    acquisition_date: Union[date, str],
+) -> (str, dict):
+    """
+    Address a subset in the subset cache by its inputs.
+    Returns (None, None) if the data source can't identify every file the subset is made from.
+    """
+    try:
+        source_files = [
+            (tile, input_datastore.file_identity(tile=tile, variable_name=variable_name, acquisition_date=acquisition_date))
+            for tile in tiles
+        ]
+    except Exception as e:
+        logger.warning(e)
+        return None, None
+
+    if len(source_files) == 0 or any(identity is None for tile, identity in source_files):
+        return None, None
+
+    return subset_key(
+        ROI_latlon=ROI_latlon,
+        target_geometry=target_geometry,
+        variable_name=variable_name,
+        acquisition_date=acquisition_date,
+        source_files=source_files,
+    )
+
+
 def generate_subset(
     input_datastore: DataSource,
     acquisition_date: Union[date, str],
@@ -39,6 +73,9 @@ def generate_subset(
     # allow_blank: bool = True) -> (np.ndarray, Affine):
     allow_blank: bool = True,
     output_padding_percentage: float = 0.25,
+    subset_cache_directory: str = None,
+    ROI_context: ROIContext = None,
+    write_subset: bool = True,
 ) -> Raster:
     """
     This function generates a subset of a raster based on a region of interest (ROI).
@@ -54,6 +91,12 @@ def generate_subset(
     target_CRS (str, optional): The coordinate reference system for the output raster. Defaults to None.
     allow_blank (bool, optional): Whether to allow blank output. Defaults to True.
     output_padding_percentage (float, optional): Percentage of padding around the ROI relative to max side length to add to the output raster. Defaults to 0.25.
+    subset_cache_directory (str, optional): Directory of the subset cache shared between runs, where subsets are found by
+        the contents of their inputs instead of by file name. Defaults to SUBSET_CACHE_DIRECTORY.
+    ROI_context (ROIContext, optional): The target grid and tiles of the ROI, computed once per ROI.
+        Defaults to the context of ROI_latlon, target_CRS, cell_size and output_padding_percentage.
+    write_subset (bool, optional): Whether to write the subset to subset_filename, rather than leaving it to the caller
+        to keep in memory. Defaults to True.
 
     Returns:
     np.ndarray: The subsetted raster.
@@ -89,7 +132,10 @@ def generate_subset(
     if target_CRS is None:
         target_CRS = WGS84
 
-    if exists(subset_filename):
+    if subset_cache_directory is None:
+        subset_cache_directory = SUBSET_CACHE_DIRECTORY
+
+    if subset_cache_directory is None and exists(subset_filename):
         logger.info(f"loading existing {cl.name(variable_name)} subset file: {cl.file(subset_filename)}")
         subset = Raster.open(subset_filename)
 
@@ -101,7 +147,15 @@ def generate_subset(
 
         # return subset, affine
 
-    tiles = select_tiles(ROI_latlon)
+    if ROI_context is None:
+        ROI_context = ROIContext(
+            ROI_latlon=ROI_latlon,
+            target_CRS=target_CRS,
+            cell_size=cell_size,
+            output_padding_percentage=output_padding_percentage,
+        )
+
+    tiles = ROI_context.tiles
 
     if len(tiles) == 0:
         logger.warning(f"no tiles found for date {acquisition_date} variable {variable_name} ROI {ROI_name}")
@@ -109,36 +163,43 @@ def generate_subset(
     logger.info(
         f"generating subset for date {cl.time(acquisition_date)} variable {cl.name(variable_name)} ROI {cl.name(ROI_name)} from tiles: {', '.join(tiles)}"
     )
-    ROI_projected = gpd.GeoDataFrame({}, geometry=[ROI_latlon], crs=WGS84).to_crs(target_CRS).geometry[0]
-    # centroid = ROI_projected.centroid
-    # x_min = centroid.x - buffer_size
-    # x_max = centroid.x + buffer_size
-    # y_min = centroid.y - buffer_size
-    # y_max = centroid.y + buffer_size
 
-    centroid = ROI_projected.centroid
-    x_min, y_min, x_max, y_max = ROI_projected.bounds
-    width = x_max - x_min
-    height = y_max - y_min
+    target_geometry = ROI_context.target_geometry
+
+    subset_cache = None
+    key = None
 
-    max_side = max(width, height)
+    if subset_cache_directory is not None:
+        subset_cache = SubsetCache(subset_cache_directory)
+        key, metadata = cached_subset_key(
+            input_datastore=input_datastore,
+            tiles=tiles,
+            ROI_latlon=ROI_latlon,
+            target_geometry=target_geometry,
+            variable_name=variable_name,
+            acquisition_date=acquisition_date,
+        )
+
+        if key is None and exists(subset_filename):
+            logger.info(f"loading existing {cl.name(variable_name)} subset file: {cl.file(subset_filename)}")
+            return Raster.open(subset_filename)
 
-    zoom_padding = max_side * output_padding_percentage
-    padding = max_side / 2 + zoom_padding
+    if key is not None:
+        target_raster = subset_cache.get(key, metadata, cmap=ET_COLORMAP)
 
-    x_min = centroid.x - padding
-    x_max = centroid.x + padding
-    y_min = centroid.y - padding
-    y_max = centroid.y + padding
+        if target_raster is not None:
+            logger.info(f"loading cached {cl.name(variable_name)} subset for date {cl.time(acquisition_date)}: {cl.name(key)}")
 
-    target_affine = Affine(cell_size, 0, x_min, 0, -cell_size, y_max)
+            if not allow_blank and np.all(np.isnan(target_raster)):
+                raise BlankOutput(
+                    f"blank output raster for date {acquisition_date} variable {variable_name} ROI {ROI_name} from tiles: {', '.join(tiles)}"
+                )
 
-    width_meters = x_max - x_min
-    target_cols = int(width_meters / cell_size)
-    height_meters = y_max - y_min
-    target_rows = int(height_meters / cell_size)
+            if write_subset:
+                makedirs(dirname(abspath(subset_filename)), exist_ok=True)
+                subset_cache.copy(key, subset_filename)
 
-    target_geometry = RasterGrid.from_affine(affine=target_affine, rows=target_rows, cols=target_cols, crs=target_CRS)
+            return target_raster
 
     target_raster = None
 
@@ -151,15 +212,173 @@ def generate_subset(
         if target_raster is None:
             target_raster = tile_raster
         else:
-            target_raster = rt.where(np.isnan(target_raster), tile_raster, target_raster)
+            # fill the gaps of the earlier tiles in place rather than allocating a new raster for every tile
+            rt.fill_missing(target_raster, tile_raster)
 
     if not allow_blank and np.all(np.isnan(target_raster)):
         raise BlankOutput(
             f"blank output raster for date {acquisition_date} variable {variable_name} ROI {ROI_name} from tiles: {', '.join(tiles)}"
         )
 
-    if not exists(subset_filename):
+    if key is not None:
+        subset_cache.put(key, metadata, target_raster)
+
+    if write_subset and (not exists(subset_filename) or subset_cache is not None):
         logger.info("writing subset: {}".format(subset_filename))
         target_raster.to_geotiff(subset_filename)
 
     return target_raster
+
+
+def generate_subset_batch(
+    input_datastore: DataSource,
+    variable_name: str,
+    dates: List[date],
+    ROI_name: str,
+    ROI_latlon,
+    subset_filenames: List[str],
+    target_CRS: str = None,
+    subset_cache_directory: str = None,
+    ROI_context: ROIContext = None,
+    write_subsets: bool = True,
+) -> Dict[date, Union[Raster, Exception]]:
+    """
+    Generate the subsets of a variable for several dates at once, reading the dates of each tile into one cube
+    instead of opening and warping each file separately.
+
+    Args:
+        input_datastore (DataSource): The data source.
+        variable_name (str): The name of the variable to be subsetted.
+        dates (List[date]): The dates of the subsets.
+        ROI_name (str): The name of the region of interest.
+        ROI_latlon (Polygon): The region of interest in latitude and longitude coordinates.
+        subset_filenames (List[str]): The filename of the subset of each date.
+        target_CRS (str, optional): The coordinate reference system for the output rasters. Defaults to WGS84.
+        subset_cache_directory (str, optional): Directory of the subset cache shared between runs.
+            Defaults to SUBSET_CACHE_DIRECTORY.
+        ROI_context (ROIContext, optional): The target grid and tiles of the ROI.
+        write_subsets (bool, optional): Whether to write each subset to its filename. Defaults to True.
+
+    Returns:
+        Dict[date, Union[Raster, Exception]]: The subset of each date, or the exception raised generating it.
+            Dates are left out if there are no tiles for the ROI, so they can be generated one at a time.
+    """
+    if target_CRS is None:
+        target_CRS = WGS84
+
+    if subset_cache_directory is None:
+        subset_cache_directory = SUBSET_CACHE_DIRECTORY
+
+    if ROI_context is None:
+        ROI_context = ROIContext(ROI_latlon=ROI_latlon, target_CRS=target_CRS)
+
+    tiles = ROI_context.tiles
+    target_geometry = ROI_context.target_geometry
+    subset_cache = None if subset_cache_directory is None else SubsetCache(subset_cache_directory)
+    subsets = {}
+    pending = []
+
+    for date_step, subset_filename in zip(dates, subset_filenames):
+        key = metadata = None
+
+        if subset_cache is not None:
+            key, metadata = cached_subset_key(
+                input_datastore=input_datastore,
+                tiles=tiles,
+                ROI_latlon=ROI_latlon,
+                target_geometry=target_geometry,
+                variable_name=variable_name,
+                acquisition_date=date_step,
+            )
+
+        if key is not None:
+            cached_subset = subset_cache.get(key, metadata, cmap=ET_COLORMAP)
+
+            if cached_subset is not None:
+                logger.info(f"loading cached {cl.name(variable_name)} subset for date {cl.time(date_step)}: {cl.name(key)}")
+                if write_subsets:
+                    makedirs(dirname(abspath(subset_filename)), exist_ok=True)
+                    subset_cache.copy(key, subset_filename)
+
+                subsets[date_step] = cached_subset
+                continue
+        elif exists(subset_filename):
+            logger.info(f"loading existing {cl.name(variable_name)} subset file: {cl.file(subset_filename)}")
+            subsets[date_step] = Raster.open(subset_filename)
+            continue
+
+        pending.append((date_step, subset_filename, key, metadata))
+
+    if len(pending) == 0 or len(tiles) == 0:
+        return subsets
+
+    logger.info(
+        f"generating {cl.name(variable_name)} subsets for {len(pending)} dates from "
+        f"{cl.time(pending[0][0])} to {cl.time(pending[-1][0])} ROI {cl.name(ROI_name)} from tiles: {', '.join(tiles)}"
+    )
+
+    mosaic = None
+    failures = {}
+
+    for tile in tiles:
+        indices = []
+        filenames = []
+
+        # keep every file of the batch available until the cube is read
+        with ExitStack() as files:
+            for index, (date_step, _, _, _) in enumerate(pending):
+                if date_step in failures:
+                    continue
+
+                try:
+                    filenames.append(
+                        files.enter_context(
+                            input_datastore.get_filename(
+                                tile=tile, variable_name=variable_name, acquisition_date=date_step
+                            )
+                        )
+                    )
+                except Exception as e:
+                    failures[date_step] = e
+                    continue
+
+                indices.append(index)
+
+            if len(filenames) == 0:
+                continue
+
+            try:
+                cube = rt.read_cube(filenames, geometry=target_geometry)
+            except Exception as e:
+                for index in indices:
+                    failures[pending[index][0]] = e
+
+                continue
+
+        if mosaic is None:
+            mosaic = np.full((len(pending),) + tuple(target_geometry.shape), np.nan, dtype=np.result_type(cube.dtype, np.float32))
+
+        # fill the gaps of the earlier tiles with this tile, for every date at once
+        if len(indices) == len(pending):
+            rt.fill_missing(mosaic, cube)
+        else:
+            existing = mosaic[indices]
+            mosaic[indices] = np.where(np.isnan(existing), cube, existing)
+
+    for index, (date_step, subset_filename, key, metadata) in enumerate(pending):
+        if date_step in failures:
+            subsets[date_step] = failures[date_step]
+            continue
+
+        subset = Raster(mosaic[index], geometry=target_geometry, cmap=ET_COLORMAP)
+
+        if key is not None:
+            subset_cache.put(key, metadata, subset)
+
+        if write_subsets and (not exists(subset_filename) or subset_cache is not None):
+            logger.info("writing subset: {}".format(subset_filename))
+            subset.to_geotiff(subset_filename)
+
+        subsets[date_step] = subset
+
+    return subsets
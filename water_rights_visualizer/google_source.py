@@ -1,11 +1,11 @@
 import contextlib
 import os
 import time
+from datetime import datetime
 from os import makedirs
 from os import remove
 from os.path import join, abspath, dirname, exists, expanduser
 
-import pandas as pd
 from dateutil import parser
 from pydrive2.drive import GoogleDrive
 import logging
@@ -15,6 +15,7 @@ import raster as rt
 
 from .errors import FileUnavailable
 from .data_source import DataSource
+from .file_catalog import FileCatalog
 from .google_drive import google_drive_login
 
 logger = logging.getLogger(__name__)
@@ -32,6 +33,7 @@ class GoogleSource(DataSource):
         client_secrets_filename: str = None,
         remove_temporary_files: bool = None,
         monthly: bool = False,
+        catalog_cache_directory: str = None,
     ):
         if remove_temporary_files is None:
             remove_temporary_files = REMOVE_TEMPORARY_FILES
@@ -51,51 +53,51 @@ class GoogleSource(DataSource):
         if ID_table_filename is None:
             ID_table_filename = join(abspath(dirname(__file__)), "google_drive_file_IDs.csv")
 
-        ID_table = pd.read_csv(ID_table_filename)
+        catalog = FileCatalog.from_CSV(ID_table_filename, cache_directory=catalog_cache_directory)
 
         self.drive = drive
         self.temporary_directory = temporary_directory
-        self.ID_table = ID_table
+        self.catalog = catalog
+        self.ID_table = catalog.table
         self.filenames = {}
         self.remove_temporary_files = remove_temporary_files
         self.monthly = monthly
 
     def inventory(self):
+        return self.catalog.inventory()
 
-        dates_available = [parser.parse(str(d)).date() for d in self.ID_table.date]
-        years_available = list(set(sorted([date_step.year for date_step in dates_available])))
+    def file_identity(self, tile: str, variable_name: str, acquisition_date: str) -> str:
+        if isinstance(acquisition_date, str):
+            acquisition_date = parser.parse(acquisition_date).date()
+        elif isinstance(acquisition_date, datetime):
+            acquisition_date = acquisition_date.date()
+
+        matching_file_metadata = self.catalog.lookup(tile, variable_name, acquisition_date)
 
-        return years_available, dates_available
+        if matching_file_metadata is None:
+            raise FileUnavailable(f"no files found for tile {tile} variable {variable_name} date {acquisition_date:%Y-%m-%d}")
+
+        return f"google-drive:{matching_file_metadata['file_ID']}"
 
     @contextlib.contextmanager
     def get_filename(self, tile: str, variable_name: str, acquisition_date: str) -> str:
         if isinstance(acquisition_date, str):
             acquisition_date = parser.parse(acquisition_date).date()
+        elif isinstance(acquisition_date, datetime):
+            acquisition_date = acquisition_date.date()
 
         key = f"{int(tile):06d}_{str(variable_name)}_{acquisition_date:%Y-%m-%d}"
 
         if key in self.filenames:
             return self.filenames[key]
 
-        if isinstance(acquisition_date, str):
-            acquisition_date = parser.parse(acquisition_date).date()
-
-        acquisition_date = acquisition_date.strftime("%Y-%m-%d")
-
-        filtered_table = self.ID_table[
-            self.ID_table.apply(
-                lambda row: row.tile == int(tile)
-                and row.variable == variable_name
-                and parser.parse(str(row.date)).date().strftime("%Y-%m-%d") == acquisition_date,
-                axis=1,
-            )
-        ]
+        matching_file_metadata = self.catalog.lookup(tile, variable_name, acquisition_date)
 
-        if len(filtered_table) == 0:
-            raise FileUnavailable(f"no files found for tile {tile} variable {variable_name} date {acquisition_date}")
+        if matching_file_metadata is None:
+            raise FileUnavailable(f"no files found for tile {tile} variable {variable_name} date {acquisition_date:%Y-%m-%d}")
 
-        filename_base = str(filtered_table.iloc[0].filename)
-        file_ID = str(filtered_table.iloc[0].file_ID)
+        filename_base = str(matching_file_metadata["filename"])
+        file_ID = str(matching_file_metadata["file_ID"])
         filename = join(self.temporary_directory, filename_base)
 
         if exists(filename):
@@ -1,51 +1,193 @@
 import numpy as np
-from scipy.interpolate import interp1d
 
-def interpolate_stack(stack: np.ndarray) -> np.ndarray:
+from .constants import DEFAULT_INTERPOLATION, MONTHS_IN_YEAR
+from .date_helpers import get_days_in_month
+
+# pixels with fewer valid observations than this are left as NaN
+MINIMUM_OBSERVATIONS = 3
+
+INTERPOLATION_METHODS = ["nearest", "linear", "previous", "monthly"]
+
+
+def observation_indices(valid: np.ndarray) -> (np.ndarray, np.ndarray):
     """
-    This function interpolates a 3D numpy array along the time axis (0th axis).
-    It uses nearest interpolation to fill in missing values in the time series data for each pixel.
+    This function finds, for every position along the time axis (0th axis), the index of the closest valid
+    observation at or before that position and at or after that position.
 
     Parameters:
-    stack (np.ndarray): A 3D numpy array representing a stack of 2D images over time.
+    valid (np.ndarray): A 3D boolean array marking the valid (non-NaN) values in the stack.
 
     Returns:
-    np.ndarray: The interpolated stack.
+    np.ndarray: The index of the previous valid observation, -1 where there is none.
+    np.ndarray: The index of the next valid observation, the length of the time axis where there is none.
     """
-    # Get the shape of the stack
-    days, rows, cols = stack.shape
+    days = valid.shape[0]
+    index_dtype = np.int16 if days < np.iinfo(np.int16).max else np.int32
+    day_index = np.arange(days, dtype=index_dtype).reshape((days, 1, 1))
 
-    # Initialize an array to hold the interpolated stack
-    filled_stack = np.full((days, rows, cols), np.nan, dtype=np.float32)
+    # carry the index of the last valid day forward along the time axis
+    previous_index = np.where(valid, day_index, np.array(-1, dtype=index_dtype))
+    np.maximum.accumulate(previous_index, axis=0, out=previous_index)
 
-    # Loop over each pixel in the image_panel
-    for row in range(rows):
-        for col in range(cols):
-            # Get the time series for the current pixel
-            pixel_timeseries = stack[:, row, col]
+    # carry the index of the next valid day backward along the time axis
+    next_index = np.where(valid, day_index, np.array(days, dtype=index_dtype))
+    next_index = np.minimum.accumulate(next_index[::-1], axis=0)[::-1]
 
-            # Create an array representing the time axis
-            x = np.arange(days)
+    return previous_index, next_index
 
-            # Find the indices of known (non-NaN) values
-            known_indices = ~np.isnan(pixel_timeseries)
-            known_days = x[known_indices]
 
-            # If there are less than 3 known values, skip this pixel
-            if len(known_days) < 3:
-                continue
+def take_observations(stack: np.ndarray, index: np.ndarray) -> np.ndarray:
+    """
+    This function gathers the value at the given time index for every pixel, clamping the index to the stack.
+    """
+    index = np.clip(index, 0, stack.shape[0] - 1)
 
-            # Get the known values from the time series
-            pixel_timeseries = pixel_timeseries[known_indices]
+    return np.take_along_axis(stack, index, axis=0).astype(np.float32, copy=False)
 
-            # Create an interpolation function for the known values
-            f = interp1d(known_days, pixel_timeseries, axis=0, kind="nearest", fill_value="extrapolate")
 
-            # Use the interpolation function to fill in the missing values
-            y = f(x)
+def fill_nearest(stack: np.ndarray, minimum_observations: int = MINIMUM_OBSERVATIONS) -> np.ndarray:
+    """
+    This function fills gaps along the time axis with the nearest observation.
+    Gaps at the start and end of the time series are filled with the first and last observations,
+    and ties between two equally distant observations go to the earlier one.
+    """
+    days = stack.shape[0]
+    valid = ~np.isnan(stack)
+    previous_index, next_index = observation_indices(valid)
 
-            # Store the interpolated time series in the filled stack
-            filled_stack[:, row, col] = y
+    # Measure the distance to the observations on either side of each day
+    day_index = np.arange(days, dtype=previous_index.dtype).reshape((days, 1, 1))
+    no_observation = np.array(days + 1, dtype=previous_index.dtype)
+    previous_distance = np.where(previous_index >= 0, day_index - previous_index, no_observation)
+    next_distance = np.where(next_index < days, next_index - day_index, no_observation)
+
+    # Take the nearest observation, preferring the earlier one on a tie
+    nearest_index = np.where(previous_distance <= next_distance, previous_index, next_index)
+    filled_stack = take_observations(stack, nearest_index)
+    filled_stack[:, np.count_nonzero(valid, axis=0) < minimum_observations] = np.nan
 
-    # Return the filled stack
     return filled_stack
+
+
+def fill_previous(stack: np.ndarray, minimum_observations: int = MINIMUM_OBSERVATIONS) -> np.ndarray:
+    """
+    This function fills gaps along the time axis by carrying the previous observation forward.
+    A gap at the start of the time series is filled with the first observation.
+    """
+    valid = ~np.isnan(stack)
+    previous_index, next_index = observation_indices(valid)
+
+    filled_stack = take_observations(stack, np.where(previous_index >= 0, previous_index, next_index))
+    filled_stack[:, np.count_nonzero(valid, axis=0) < minimum_observations] = np.nan
+
+    return filled_stack
+
+
+def fill_linear(stack: np.ndarray, minimum_observations: int = MINIMUM_OBSERVATIONS) -> np.ndarray:
+    """
+    This function fills gaps along the time axis by linear interpolation between the observations on either side.
+    Gaps at the start and end of the time series are held at the first and last observations.
+    """
+    days = stack.shape[0]
+    valid = ~np.isnan(stack)
+    previous_index, next_index = observation_indices(valid)
+
+    # Hold the edges by pointing the missing side at the observation that does exist
+    previous_index = np.where(previous_index >= 0, previous_index, next_index)
+    next_index = np.where(next_index < days, next_index, previous_index)
+
+    previous_values = take_observations(stack, previous_index)
+    next_values = take_observations(stack, next_index)
+
+    day_index = np.arange(days, dtype=np.float32).reshape((days, 1, 1))
+    span = (next_index - previous_index).astype(np.float32)
+    weight = np.divide(day_index - previous_index, span, out=np.zeros_like(span), where=span > 0)
+
+    filled_stack = previous_values + (next_values - previous_values) * weight
+    filled_stack[:, np.count_nonzero(valid, axis=0) < minimum_observations] = np.nan
+
+    return filled_stack
+
+
+def fill_monthly(stack: np.ndarray, year: int) -> np.ndarray:
+    """
+    This function fills a stack produced from monthly sources, either a 12-layer stack of monthly totals
+    or a daily stack whose values are constant within each month.
+    Only one layer per month is examined, so the gap filling runs over 12 layers instead of every day.
+    The days of a month without data are split between the nearest months that have data, exactly as
+    nearest interpolation of the daily stack would split them, so the monthly totals are unchanged.
+    """
+    if year is None:
+        raise ValueError("year is required for monthly interpolation")
+
+    days_in_month = np.array([get_days_in_month(year, month) for month in range(1, 13)]).reshape((MONTHS_IN_YEAR, 1, 1))
+    month_start = np.cumsum(days_in_month, axis=0) - days_in_month
+    month_end = month_start + days_in_month - 1
+    daily = stack.shape[0] == np.sum(days_in_month)
+
+    if daily:
+        monthly_totals = stack[month_start.ravel()] * days_in_month
+    elif stack.shape[0] == MONTHS_IN_YEAR:
+        monthly_totals = stack
+    else:
+        raise ValueError(f"stack with {stack.shape[0]} layers does not cover year {year}")
+
+    valid = ~np.isnan(monthly_totals)
+    previous_month, next_month = observation_indices(valid)
+    has_previous = previous_month >= 0
+    has_next = next_month < MONTHS_IN_YEAR
+    previous_month = np.clip(previous_month, 0, MONTHS_IN_YEAR - 1)
+    next_month = np.clip(next_month, 0, MONTHS_IN_YEAR - 1)
+
+    # count the days of each month that are at least as close to the last day of the previous month with data
+    # as to the first day of the next month with data, ties going to the previous month
+    midpoint = (month_end.ravel()[previous_month] + month_start.ravel()[next_month]) // 2
+    previous_days = np.clip(midpoint - month_start + 1, 0, days_in_month)
+    previous_days = np.where(has_next, np.where(has_previous, previous_days, 0), days_in_month)
+
+    daily_rate = monthly_totals / days_in_month
+    previous_rate = np.take_along_axis(daily_rate, previous_month, axis=0)
+    next_rate = np.take_along_axis(daily_rate, next_month, axis=0)
+    next_days = days_in_month - previous_days
+    filled_totals = np.where(previous_days > 0, previous_days * previous_rate, 0) + np.where(
+        next_days > 0, next_days * next_rate, 0
+    )
+    filled_totals = np.where(valid, monthly_totals, filled_totals).astype(np.float32)
+
+    # a single month of monthly data is a full month of daily observations
+    filled_totals[:, ~np.any(valid, axis=0)] = np.nan
+
+    if daily:
+        return np.repeat((filled_totals / days_in_month).astype(np.float32), days_in_month.ravel(), axis=0)
+
+    return filled_totals
+
+
+def interpolate_stack(stack: np.ndarray, method: str = None, year: int = None) -> np.ndarray:
+    """
+    This function interpolates a 3D numpy array along the time axis (0th axis).
+    It fills in missing values in the time series data for each pixel using the given method:
+    "nearest", "linear" or "previous" for daily sources, or "monthly" for stacks spread from monthly sources.
+    Pixels with less than 3 known values are left blank.
+
+    Parameters:
+    stack (np.ndarray): A 3D numpy array representing a stack of 2D images over time.
+    method (str, optional): The interpolation method. Defaults to "nearest".
+    year (int, optional): The year covered by the stack, required for the "monthly" method.
+
+    Returns:
+    np.ndarray: The interpolated stack.
+    """
+    if method is None:
+        method = DEFAULT_INTERPOLATION
+
+    if method == "nearest":
+        return fill_nearest(stack)
+    elif method == "linear":
+        return fill_linear(stack)
+    elif method == "previous":
+        return fill_previous(stack)
+    elif method == "monthly":
+        return fill_monthly(stack, year)
+    else:
+        raise ValueError(f"unrecognized interpolation method: {method}")
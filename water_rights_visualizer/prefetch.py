@@ -0,0 +1,119 @@
+from datetime import date
+from logging import getLogger
+from os.path import exists, join
+from typing import List, Tuple
+
+from shapely import Polygon
+
+from raster import RasterGrid
+
+from .constants import UNCERTAINTY_VARIABLES, SUBSET_CACHE_DIRECTORY
+from .data_source import DataSource
+from .generate_subset import cached_subset_key
+from .select_tiles import select_tiles
+from .subset_cache import SubsetCache
+from .variable_types import get_available_variable_source_for_date
+
+logger = getLogger(__name__)
+
+
+def required_files(
+    ROI_name: str,
+    ROI_latlon: Polygon,
+    year: int,
+    dates_available: List[date],
+    subset_directory: str,
+    tiles: List[str] = None,
+    input_datastore: DataSource = None,
+    target_geometry: RasterGrid = None,
+    subset_cache_directory: str = None,
+) -> List[Tuple[str, str, date]]:
+    """
+    List the files that generate_stack will read for a year, so that they can be fetched before the subsets are made.
+    Dates whose subsets already exist, in the subset directory or in the subset cache, are skipped,
+    and dates of monthly sources are moved to the first of the month.
+
+    Args:
+        ROI_name (str): The name of the region of interest.
+        ROI_latlon (Polygon): The polygon representing the latitude and longitude coordinates of the ROI.
+        year (int): The year for which the stack is generated.
+        dates_available (List[date]): A list of available dates for the data.
+        subset_directory (str): The directory where the subsets are saved.
+        tiles (List[str], optional): The tiles covering the ROI. Defaults to the tiles selected for ROI_latlon.
+        input_datastore (DataSource, optional): The data source identifying the files of each subset in the cache.
+        target_geometry (RasterGrid, optional): The grid of the subsets, which addresses them in the cache.
+        subset_cache_directory (str, optional): The directory of the subset cache shared between runs.
+            Defaults to SUBSET_CACHE_DIRECTORY. The cache is only checked given a data source and a grid.
+
+    Returns:
+        List[Tuple[str, str, date]]: The (tile, variable, date) of each file, without duplicates.
+    """
+    if tiles is None:
+        tiles = select_tiles(ROI_latlon)
+
+    if subset_cache_directory is None:
+        subset_cache_directory = SUBSET_CACHE_DIRECTORY
+
+    subset_cache = None
+
+    if subset_cache_directory is not None and input_datastore is not None and target_geometry is not None:
+        subset_cache = SubsetCache(subset_cache_directory)
+
+    requests = []
+
+    # monthly PPT is subset for every month of the year
+    for month in range(1, 13):
+        date_step = date(year, month, 1)
+        PPT_source = get_available_variable_source_for_date("PPT", date_step)
+
+        if PPT_source and PPT_source.monthly:
+            requests.append(("PPT", date_step))
+
+    for date_step in sorted(set([date_step for date_step in dates_available if date_step.year == year])):
+        requests.append(("ET", date_step))
+
+        count_source = get_available_variable_source_for_date("COUNT", date_step)
+
+        if count_source and count_source.monthly:
+            requests.extend([(variable_name, date_step) for variable_name in UNCERTAINTY_VARIABLES])
+
+        # ESI is only read when there is no PET source for the date
+        if get_available_variable_source_for_date("PET", date_step):
+            requests.append(("PET", date_step))
+        else:
+            requests.append(("ESI", date_step))
+
+    files = []
+
+    for variable_name, date_step in requests:
+        subset_filename = join(subset_directory, f"{date_step.strftime('%Y.%m.%d')}_{ROI_name}_{variable_name}_subset.tif")
+
+        if exists(subset_filename):
+            continue
+
+        # subsets in the cache are loaded without reading their files
+        if subset_cache is not None:
+            key, metadata = cached_subset_key(
+                input_datastore=input_datastore,
+                tiles=tiles,
+                ROI_latlon=ROI_latlon,
+                target_geometry=target_geometry,
+                variable_name=variable_name,
+                acquisition_date=date_step,
+            )
+
+            if key is not None and key in subset_cache:
+                continue
+
+        variable_source = get_available_variable_source_for_date(variable_name, date_step)
+
+        if variable_source is None:
+            continue
+
+        if variable_source.monthly:
+            date_step = date_step.replace(day=1)
+
+        for tile in tiles:
+            files.append((tile, variable_name, date_step))
+
+    return list(dict.fromkeys(files))
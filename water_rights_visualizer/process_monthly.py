@@ -7,13 +7,14 @@ from shapely.geometry import Polygon
 import pandas as pd
 from affine import Affine
 import rasterio
-from rasterio.features import geometry_mask
 from dateutil.relativedelta import relativedelta
 from .date_helpers import get_one_month_slice
 
 import raster as rt
 
-from .constants import START_MONTH, END_MONTH
+from .constants import START_MONTH, END_MONTH, MONTHS_IN_YEAR
+from .roi_context import ROIContext
+from .zonal_stats import ROI_mask, labelled_monthly_stats
 
 logger = logging.getLogger(__name__)
 
@@ -30,13 +31,14 @@ def process_monthly(
     monthly_means_directory: str,
     start_month: int = START_MONTH,
     end_month: int = END_MONTH,
+    ROI_context: ROIContext = None,
 ) -> pd.DataFrame:
     """
     Process monthly values for a given year and generate monthly means.
 
     Args:
-        ET_stack (np.ndarray): Array of ET values for each day of the year.
-        PET_stack (np.ndarray): Array of PET values for each day of the year.
+        ET_stack (np.ndarray): Array of ET values for each day of the year, or for each month of the year.
+        PET_stack (np.ndarray): Array of PET values for each day of the year, or for each month of the year.
         ROI_latlon (Polygon): Polygon representing the region of interest.
         ROI_name (str): Name of the region of interest.
         subset_affine (Affine): Affine transformation for the subset.
@@ -44,6 +46,7 @@ def process_monthly(
         year (int): Year for which to process the monthly values.
         monthly_sums_directory (str): Directory to store monthly sum files.
         monthly_means_directory (str): Directory to store monthly means files.
+        ROI_context (ROIContext, optional): The geometry of the ROI, which keeps the ROI mask of each grid.
 
     Returns:
         pd.DataFrame: DataFrame containing the monthly means.
@@ -57,25 +60,37 @@ def process_monthly(
     else:
         days, rows, cols = ET_stack.shape
         subset_shape = (rows, cols)
-        logger.info("rasterizing ROI")
-        mask = geometry_mask([ROI_latlon], subset_shape, subset_affine, invert=True)
+        # monthly stacks already hold the monthly sums
+        monthly_stack = days == MONTHS_IN_YEAR
+
+        if ROI_context is None:
+            mask = ROI_mask(ROI_latlon, subset_affine, subset_shape)
+        else:
+            mask = ROI_context.ROI_mask(subset_affine, subset_shape)
+
+        subset_geometry = rt.RasterGrid.from_affine(subset_affine, rows, cols, CRS)
 
         logger.info(f"processing monthly values for year: {year}")
-        monthly_means = []
+        months = list(range(start_month, end_month + 1))
+        ET_monthly_sums = []
+        PET_monthly_sums = []
 
-        for j, month in enumerate(range(start_month, end_month + 1)):
+        for j, month in enumerate(months):
             logger.info(f"processing monthly values for month {month} year {year}")
             if not exists(monthly_sums_directory):
                 makedirs(monthly_sums_directory)
 
             ET_monthly_filename = join(monthly_sums_directory, f"{year:04d}_{month:02d}_{ROI_name}_ET_monthly_sum.tif")
 
-            start_index, end_index = get_one_month_slice(year, month)
+            if monthly_stack:
+                start_index, end_index = month - 1, month
+            else:
+                start_index, end_index = get_one_month_slice(year, month)
+
             ET_month_stack = ET_stack[start_index:end_index, :, :]
             ET_monthly = np.nansum(ET_month_stack, axis=0)
 
             logger.info(f"writing monthly ET: {ET_monthly_filename}")
-            subset_geometry = rt.RasterGrid.from_affine(subset_affine, rows, cols, CRS)
             ET_monthly_raster = rt.Raster(array=ET_monthly, geometry=subset_geometry)
             ET_monthly_raster.to_geotiff(ET_monthly_filename)
 
@@ -86,22 +101,25 @@ def process_monthly(
             PET_monthly = np.nansum(PET_month_stack, axis=0)
 
             logger.info(f"writing monthly PET: {PET_monthly_filename}")
-            subset_geometry = rt.RasterGrid.from_affine(subset_affine, rows, cols, CRS)
             PET_monthly_raster = rt.Raster(array=PET_monthly, geometry=subset_geometry)
             PET_monthly_raster.to_geotiff(PET_monthly_filename)
 
-            ET_values = np.array(ET_monthly[mask]).flatten()
-            PET_values = np.array(PET_monthly[mask]).flatten()
-
-            ET_monthly_mean = np.nanmean(ET_values) if len(ET_values) > 0 else 0
-            PET_monthly_mean = np.nanmean(PET_values) if len(PET_values) > 0 else 0
-
-            monthly_means.append([year, month, ET_monthly_mean, PET_monthly_mean])
+            ET_monthly_sums.append(ET_monthly)
+            PET_monthly_sums.append(PET_monthly)
 
         if not exists(monthly_means_directory):
             makedirs(monthly_means_directory)
 
-        monthly_means_df = pd.DataFrame(monthly_means, columns=["Year", "Month", "ET", "PET"])
+        # the ROI is the only label, aggregated the same way as each polygon of a batch
+        monthly_stats = labelled_monthly_stats(
+            monthly_sums={"ET": ET_monthly_sums, "PET": PET_monthly_sums},
+            labels=mask.astype(np.uint8),
+            year=year,
+            months=months,
+            ROI_names=[ROI_name],
+        )
+
+        monthly_means_df = monthly_stats[["Year", "Month", "ET", "PET"]]
         logger.info(f"writing monthly means: {monthly_means_filename}")
         monthly_means_df.to_csv(monthly_means_filename)
 
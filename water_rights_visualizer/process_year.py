@@ -24,6 +24,9 @@ from .display_image_tk import display_image_tk
 from .generate_figure import generate_figure
 from .generate_stack import generate_stack
 from .process_monthly import process_monthly
+from .stack_cache import close_stack
+from .roi_context import ROIContext
+from .subset_store import SubsetStore
 from .write_status import write_status
 from .variable_types import get_available_variable_source_for_date
 
@@ -67,6 +70,11 @@ def process_year(
     text_panel: ScrolledText = None,
     status_filename: str = None,
     debug: bool = False,
+    subset_workers: int = None,
+    stack_memory_budget: int = None,
+    subset_cache_directory: str = None,
+    ROI_context: ROIContext = None,
+    export_subsets: bool = None,
 ):
     logger.info(f"processing year {cl.time(year)} at ROI {cl.name(ROI_name)}")
     message = f"processing: {year}"
@@ -89,6 +97,15 @@ def process_year(
 
     stack_filename = join(stack_directory, f"{year:04d}_{ROI_name}_stack.h5")
 
+    if ROI_context is None:
+        ROI_context = ROIContext(ROI_latlon=ROI_latlon, ROI_shapes=ROI_for_nan, target_CRS=target_CRS)
+
+    # the subsets of the year are kept in memory for the uncertainty, and only written out when debugging or requested
+    subset_store = SubsetStore(subset_directory, ROI_name, export_subsets=True if debug else export_subsets)
+    # a cached stack comes without the subsets of the uncertainty, so it's only used once the uncertainty is written
+    uncertainty_filename = join(monthly_nan_directory, f"{year}.csv")
+    uncertainty_written = exists(uncertainty_filename)
+
     try:
         write_status(
             message == f"loading stack: {stack_filename}\n",
@@ -107,6 +124,12 @@ def process_year(
             dates_available=dates_available,
             stack_filename=stack_filename,
             target_CRS=target_CRS,
+            subset_workers=subset_workers,
+            memory_budget=stack_memory_budget,
+            subset_cache_directory=subset_cache_directory,
+            ROI_context=ROI_context,
+            subset_store=subset_store,
+            use_stack_cache=uncertainty_written,
         )
     except Exception as e:
         logger.exception(e)
@@ -117,36 +140,61 @@ def process_year(
 
         return None
 
-    monthly_means_df = process_monthly(
-        ET_stack=ET_stack,
-        PET_stack=PET_stack,
-        ROI_latlon=ROI_latlon,
-        ROI_name=ROI_name,
-        subset_affine=affine,
-        CRS=target_CRS,
-        year=year,
-        start_month=start_month,
-        end_month=end_month,
-        monthly_sums_directory=monthly_sums_directory,
-        monthly_means_directory=monthly_means_directory,
-    )
+    try:
+        monthly_means_df = process_monthly(
+            ET_stack=ET_stack,
+            PET_stack=PET_stack,
+            ROI_latlon=ROI_latlon,
+            ROI_name=ROI_name,
+            subset_affine=affine,
+            CRS=target_CRS,
+            year=year,
+            start_month=start_month,
+            end_month=end_month,
+            monthly_sums_directory=monthly_sums_directory,
+            monthly_means_directory=monthly_means_directory,
+            ROI_context=ROI_context,
+        )
+    finally:
+        # the stacks aren't needed after the monthly means, so a cached stack's file is closed
+        close_stack(ET_stack, PET_stack)
 
     # monthly_means.append(monthly_means_df)
 
     write_status(message="Calculating uncertainty\n", status_filename=status_filename, text_panel=text_panel, root=root)
 
-    # Check the variable to see if it's monthly
-    variable_source = get_available_variable_source_for_date("ET", datetime(year, 1, 1).date())
-    if variable_source and variable_source.monthly:
-        calculate_cloud_coverage_percent(ROI_for_nan, subset_directory, nan_subset_directory, monthly_nan_directory)
+    if uncertainty_written and len(subset_store.dates("ET", year=year)) == 0:
+        # the stack was loaded from the stack cache, so the uncertainty written with it is kept
+        logger.info(f"using existing uncertainty: {cl.file(uncertainty_filename)}")
     else:
-        calculate_percent_nan(ROI_for_nan, subset_directory, nan_subset_directory, monthly_nan_directory)
+        # Check the variable to see if it's monthly
+        variable_source = get_available_variable_source_for_date("ET", datetime(year, 1, 1).date())
+        if variable_source and variable_source.monthly:
+            calculate_cloud_coverage_percent(
+                ROI_for_nan,
+                subset_directory,
+                nan_subset_directory,
+                monthly_nan_directory,
+                ROI_context=ROI_context,
+                subset_store=subset_store,
+                year=year,
+            )
+        else:
+            calculate_percent_nan(
+                ROI_for_nan,
+                subset_directory,
+                nan_subset_directory,
+                monthly_nan_directory,
+                ROI_context=ROI_context,
+                subset_store=subset_store,
+                year=year,
+            )
 
     write_status(message == "Generating figure\n", status_filename=status_filename, text_panel=text_panel, root=root)
 
     # nan_means = []
-    if exists(f"{monthly_nan_directory}/{year}.csv"):
-        nd = pd.read_csv(f"{monthly_nan_directory}/{year}.csv")
+    if exists(uncertainty_filename):
+        nd = pd.read_csv(uncertainty_filename)
     else:
         nd = pd.DataFrame(columns=["year", "month", "percent_nan"])
     # nan_means.append(nd)
@@ -0,0 +1,163 @@
+import logging
+import os
+import pickle
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Callable, List
+
+import pandas as pd
+
+import cl
+from .constants import YEAR_MEMORY_BYTES, YEAR_WORKERS
+from .process_year import process_year
+from .write_status import write_status
+
+logger = logging.getLogger(__name__)
+
+
+def available_memory_bytes() -> int:
+    """
+    Get the memory available for new processes in bytes, or None if it can't be determined.
+    """
+    try:
+        import psutil
+
+        return psutil.virtual_memory().available
+    except ImportError:
+        pass
+
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def year_worker_limit(year_workers: int, year_memory_bytes: int = YEAR_MEMORY_BYTES) -> int:
+    """
+    Limit the number of years processed at once by the number of CPUs and the memory available for each year.
+    """
+    limit = min(year_workers, os.cpu_count() or 1)
+    memory = available_memory_bytes()
+
+    if memory is not None:
+        limit = min(limit, memory // year_memory_bytes)
+
+    return max(int(limit), 1)
+
+
+def timed_process_year(**kwargs) -> (pd.DataFrame, float):
+    """
+    Process a year, returning its monthly means along with the run time in minutes.
+    """
+    year_start_time = time.time()
+    monthly_means_df = process_year(**kwargs)
+    year_end_time = time.time()
+
+    return monthly_means_df, (year_end_time - year_start_time) / 60
+
+
+def process_years(
+    years: List[int],
+    year_workers: int = None,
+    before_year: Callable[[int], bool] = None,
+    **kwargs,
+) -> List[pd.DataFrame]:
+    """
+    Process a sequence of years, running several years at once in worker processes if more than one worker is given.
+
+    Years are started in order, and before each year is started before_year is called with the year.
+    If it returns False, no more years are started, and the years already running are finished,
+    so every year before the first one that wasn't started is complete.
+
+    Args:
+        years (List[int]): The years to process in order.
+        year_workers (int, optional): The most years processed at once, which is further limited by the number of CPUs
+            and the memory available. Defaults to YEAR_WORKERS.
+        before_year (Callable[[int], bool], optional): Called before each year is started, returning whether to start it.
+        **kwargs: The remaining arguments of process_year.
+
+    Returns:
+        List[pd.DataFrame]: The monthly means of each year that was started, in the order of the years.
+    """
+    if year_workers is None:
+        year_workers = YEAR_WORKERS
+
+    status_filename = kwargs.get("status_filename")
+    text_panel = kwargs.get("text_panel")
+    root = kwargs.get("root")
+
+    def report_run_time(total_year_time: float):
+        write_status(
+            message=f"Process Year Run Time: {total_year_time} minutes\n\n",
+            status_filename=status_filename,
+            text_panel=text_panel,
+            root=root,
+        )
+
+    if year_workers > 1 and len(years) > 1:
+        year_workers = year_worker_limit(year_workers)
+
+    # the Tk interface lives in this process, and debugging exits on the first failure
+    if year_workers > 1 and (root is not None or kwargs.get("debug")):
+        year_workers = 1
+
+    if year_workers > 1 and len(years) > 1:
+        try:
+            pickle.dumps(kwargs.get("input_datastore"))
+        except Exception as e:
+            logger.warning(e)
+            logger.warning("data source can't be passed to worker processes, processing years serially")
+            year_workers = 1
+
+    if year_workers <= 1 or len(years) <= 1:
+        monthly_means = []
+
+        for year in years:
+            if before_year is not None and not before_year(year):
+                break
+
+            monthly_means_df, total_year_time = timed_process_year(year=year, **kwargs)
+            monthly_means.append(monthly_means_df)
+            report_run_time(total_year_time)
+
+        return monthly_means
+
+    logger.info(f"processing {cl.val(len(years))} years with {cl.val(year_workers)} worker processes")
+
+    monthly_means_by_year = {}
+    running = {}
+    remaining_years = list(years)
+
+    with ProcessPoolExecutor(max_workers=year_workers) as executor:
+        while remaining_years or running:
+            # keep every worker busy with the next years in order until told to stop
+            while remaining_years and len(running) < year_workers:
+                year = remaining_years[0]
+
+                if before_year is not None and not before_year(year):
+                    remaining_years = []
+                    break
+
+                remaining_years.pop(0)
+                running[executor.submit(timed_process_year, year=year, **kwargs)] = year
+
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+
+            for future in finished:
+                year = running.pop(future)
+
+                try:
+                    monthly_means_df, total_year_time = future.result()
+                except Exception as e:
+                    logger.exception(e)
+                    logger.warning(f"unable to process year {cl.time(year)}")
+                    monthly_means_by_year[year] = None
+                    continue
+
+                monthly_means_by_year[year] = monthly_means_df
+                report_run_time(total_year_time)
+
+    return [monthly_means_by_year[year] for year in years if year in monthly_means_by_year]
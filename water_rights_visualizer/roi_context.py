@@ -0,0 +1,144 @@
+from logging import getLogger
+from typing import List, Tuple
+
+import geopandas as gpd
+import numpy as np
+from affine import Affine
+from shapely.geometry import Polygon
+
+from raster import RasterGrid
+
+from .constants import WGS84, CELL_SIZE_DEGREES
+from .select_tiles import select_tiles
+from .zonal_stats import ROI_mask
+
+logger = getLogger(__name__)
+
+DEFAULT_OUTPUT_PADDING_PERCENTAGE = 0.25
+
+
+def generate_target_geometry(
+    ROI_projected: Polygon,
+    cell_size: float,
+    target_CRS: str,
+    output_padding_percentage: float = DEFAULT_OUTPUT_PADDING_PERCENTAGE,
+) -> RasterGrid:
+    """
+    Generate the grid of the subsets of a ROI, a square around its centroid with even size that treats
+    the ROI as its bounding box to compensate for weird polygons.
+
+    Args:
+        ROI_projected (Polygon): The ROI in the target coordinate reference system.
+        cell_size (float): The cell size of the grid.
+        target_CRS (str): The coordinate reference system of the grid.
+        output_padding_percentage (float, optional): Percentage of padding around the ROI relative to max side length
+            to add to the grid. Defaults to 0.25.
+
+    Returns:
+        RasterGrid: The target grid.
+    """
+    centroid = ROI_projected.centroid
+    x_min, y_min, x_max, y_max = ROI_projected.bounds
+    width = x_max - x_min
+    height = y_max - y_min
+
+    max_side = max(width, height)
+
+    zoom_padding = max_side * output_padding_percentage
+    padding = max_side / 2 + zoom_padding
+
+    x_min = centroid.x - padding
+    x_max = centroid.x + padding
+    y_min = centroid.y - padding
+    y_max = centroid.y + padding
+
+    target_affine = Affine(cell_size, 0, x_min, 0, -cell_size, y_max)
+
+    width_meters = x_max - x_min
+    target_cols = int(width_meters / cell_size)
+    height_meters = y_max - y_min
+    target_rows = int(height_meters / cell_size)
+
+    return RasterGrid.from_affine(affine=target_affine, rows=target_rows, cols=target_cols, crs=target_CRS)
+
+
+class ROIContext:
+    """
+    Geometry of a region of interest that depends only on the ROI, the cell size and the CRS,
+    computed once per ROI and shared by every subset, stack and aggregation of the ROI.
+
+    Attributes:
+        ROI_latlon (Polygon): The ROI in latitude and longitude.
+        ROI_shapes (List[Polygon]): Every shape of the ROI file in latitude and longitude, used for the uncertainty.
+        target_CRS (str): The coordinate reference system of the subsets.
+        cell_size (float): The cell size of the subsets.
+        ROI_projected (Polygon): The ROI in the target CRS.
+        target_geometry (RasterGrid): The grid of the subsets.
+        tiles (List[str]): The ARD tiles covering the ROI.
+    """
+
+    def __init__(
+        self,
+        ROI_latlon: Polygon,
+        ROI_shapes: List[Polygon] = None,
+        target_CRS: str = None,
+        cell_size: float = None,
+        output_padding_percentage: float = DEFAULT_OUTPUT_PADDING_PERCENTAGE,
+    ):
+        if ROI_shapes is None:
+            ROI_shapes = [ROI_latlon]
+
+        if target_CRS is None:
+            target_CRS = WGS84
+
+        if cell_size is None:
+            cell_size = CELL_SIZE_DEGREES
+
+        self.ROI_latlon = ROI_latlon
+        self.ROI_shapes = list(ROI_shapes)
+        self.target_CRS = target_CRS
+        self.cell_size = cell_size
+        self.ROI_projected = gpd.GeoDataFrame({}, geometry=[ROI_latlon], crs=WGS84).to_crs(target_CRS).geometry[0]
+
+        self.target_geometry = generate_target_geometry(
+            ROI_projected=self.ROI_projected,
+            cell_size=cell_size,
+            target_CRS=target_CRS,
+            output_padding_percentage=output_padding_percentage,
+        )
+
+        self.tiles = select_tiles(ROI_latlon)
+        self._masks = {}
+
+    def __repr__(self) -> str:
+        return (
+            f"ROIContext(target_CRS={self.target_CRS!r}, cell_size={self.cell_size}, "
+            f"shape={self.target_geometry.shape}, tiles={self.tiles})"
+        )
+
+    def _rasterize(self, name: str, shapes: List[Polygon], affine: Affine, shape: Tuple[int, int]) -> np.ndarray:
+        key = (name, tuple(affine), tuple(shape))
+
+        if key not in self._masks:
+            self._masks[key] = ROI_mask(shapes, affine, shape)
+
+        return self._masks[key]
+
+    def ROI_mask(self, affine: Affine, shape: Tuple[int, int]) -> np.ndarray:
+        """
+        Get the mask of the pixels inside the ROI on a grid, rasterizing it once per grid.
+        """
+        return self._rasterize("ROI", [self.ROI_latlon], affine, shape)
+
+    def ROI_shapes_mask(self, affine: Affine, shape: Tuple[int, int]) -> np.ndarray:
+        """
+        Get the mask of the pixels inside any shape of the ROI on a grid, rasterizing it once per grid.
+        """
+        return self._rasterize("shapes", self.ROI_shapes, affine, shape)
+
+    @property
+    def mask(self) -> np.ndarray:
+        """
+        The mask of the pixels inside the ROI on the target grid.
+        """
+        return self.ROI_mask(self.target_geometry.affine, self.target_geometry.shape)
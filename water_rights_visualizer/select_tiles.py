@@ -1,14 +1,51 @@
+from functools import lru_cache
 from typing import List
-from os.path import join, abspath, dirname
 import geopandas as gpd
+import numpy as np
+import shapely
+from shapely import STRtree
 from shapely.geometry import Polygon
 
-from .constants import WGS84
+from .constants import WGS84, ARD_TILES_FILENAME
 from .constants import TILE_SELECTION_BUFFER_RADIUS_DEGREES
 
+# number of distinct ROI geometries whose tiles are remembered in each process
+SELECT_TILES_CACHE_SIZE = 1024
+
+
+@lru_cache(maxsize=None)
+def load_tile_index() -> (List[str], STRtree):
+    """
+    Load the ARD tiles once per process as a spatial index.
+
+    Returns:
+        Tuple[List[str], STRtree]: The tile names in the order of the GeoJSON file, and an STRtree of their
+            footprints in latlon coordinates.
+    """
+    # Read the ARD tiles GeoJSON file and convert it to WGS84 coordinate system
+    tiles_df = gpd.read_file(ARD_TILES_FILENAME).to_crs(WGS84)
+    tile_names = [item[2:] for item in list(tiles_df["name"])]
+    tree = STRtree(np.array(tiles_df.geometry))
+
+    return tile_names, tree
+
+
+@lru_cache(maxsize=SELECT_TILES_CACHE_SIZE)
+def select_tiles_for_WKB(target_geometry_WKB: bytes) -> tuple:
+    target_geometry_latlon = shapely.from_wkb(target_geometry_WKB)
+    tile_names, tree = load_tile_index()
+
+    # Perform tile selection based on the intersection with the target geometry buffer
+    indices = tree.query(target_geometry_latlon.buffer(TILE_SELECTION_BUFFER_RADIUS_DEGREES), predicate="intersects")
+
+    # keep the order of the tiles in the file
+    return tuple(tile_names[index] for index in sorted(indices))
+
+
 def select_tiles(target_geometry_latlon: Polygon) -> List[str]:
     """
     Selects tiles based on the target geometry.
+    The selection is remembered for each geometry, since every subset of a ROI covers the same tiles.
 
     Args:
         target_geometry_latlon (Polygon): The target geometry in latlon coordinates.
@@ -16,14 +53,4 @@ def select_tiles(target_geometry_latlon: Polygon) -> List[str]:
     Returns:
         List[str]: A list of selected tiles.
     """
-    # Read the ARD tiles GeoJSON file and convert it to WGS84 coordinate system
-    tiles_df = gpd.read_file(join(abspath(dirname(__file__)), "ARD_tiles.geojson")).to_crs(WGS84)
-    
-    # Perform tile selection based on the intersection with the target geometry buffer
-    selection = tiles_df.intersects(target_geometry_latlon.buffer(TILE_SELECTION_BUFFER_RADIUS_DEGREES))
-    selected_tiles_df = tiles_df[selection]
-    
-    # Extract the tile names from the selected tiles dataframe
-    tiles = [item[2:] for item in list(selected_tiles_df["name"])]
-    
-    return tiles
+    return list(select_tiles_for_WKB(target_geometry_latlon.wkb))
@@ -0,0 +1,208 @@
+import hashlib
+import json
+import os
+from datetime import date
+from logging import getLogger
+from os import makedirs
+from os.path import abspath, dirname, exists
+from typing import Dict, List, Union
+
+import h5py
+import numpy as np
+from affine import Affine
+from shapely import Polygon
+
+import cl
+from .data_source import DataSource
+from .variable_types import get_available_variable_source_for_date
+
+logger = getLogger(__name__)
+
+STACK_CACHE_VERSION = 1
+STACK_COMPRESSION = "gzip"
+STACK_COMPRESSION_LEVEL = 4
+# rows and columns in each chunk, which spans every layer so a pixel's time series is read from one chunk
+STACK_CHUNK_SIZE = 32
+STACK_VARIABLES = ["ET", "PET", "ESI"]
+
+
+def source_file_identities(input_datastore: DataSource, tiles: List[str], dates: List[date]) -> Dict[str, str]:
+    """
+    Identify the file of each tile that each variable of a stack is read from on each date,
+    so that a stack made from files that have since been replaced is found to be stale.
+    Files the data source can't identify are recorded as None.
+    """
+    identities = {}
+
+    for date_step in dates:
+        for variable_name in STACK_VARIABLES:
+            source = get_available_variable_source_for_date(variable_name, date_step)
+
+            if source is None:
+                continue
+
+            # monthly files are read for the first of the month
+            source_date = date_step.replace(day=1) if source.monthly else date_step
+
+            for tile in tiles:
+                try:
+                    identity = input_datastore.file_identity(
+                        tile=tile, variable_name=variable_name, acquisition_date=source_date
+                    )
+                except Exception:
+                    identity = None
+
+                identities[f"{date_step:%Y-%m-%d}_{variable_name}_{tile}"] = identity
+
+    return identities
+
+
+def stack_fingerprint(
+    ROI_latlon: Polygon,
+    year: int,
+    dates: List[date],
+    target_CRS: str,
+    ET_interpolation: str,
+    PET_interpolation: str,
+    monthly_native: bool,
+    input_datastore: DataSource = None,
+    tiles: List[str] = None,
+) -> str:
+    """
+    Fingerprint the inputs of a stack, so that a cached stack can be checked against the inputs it was made from.
+
+    Args:
+        ROI_latlon (Polygon): The polygon representing the latitude and longitude coordinates of the ROI.
+        year (int): The year of the stack.
+        dates (List[date]): The dates available for the year.
+        target_CRS (str): The coordinate reference system of the stack.
+        ET_interpolation (str): The interpolation method of the ET stack.
+        PET_interpolation (str): The interpolation method of the PET stack.
+        monthly_native (bool): Whether the stack has one layer per month.
+        input_datastore (DataSource, optional): The data source of the files the stack is made from,
+            whose identities are included given the tiles of the stack.
+        tiles (List[str], optional): The tiles covering the ROI.
+
+    Returns:
+        str: The SHA-256 hex digest of the inputs.
+    """
+    sources = {}
+
+    for date_step in dates:
+        for variable_name in STACK_VARIABLES:
+            source = get_available_variable_source_for_date(variable_name, date_step)
+            sources[f"{date_step:%Y-%m-%d}_{variable_name}"] = source.name if source else None
+
+    inputs = {
+        "version": STACK_CACHE_VERSION,
+        "ROI": hashlib.sha256(ROI_latlon.wkb).hexdigest(),
+        "year": year,
+        "CRS": str(target_CRS),
+        "interpolation": [ET_interpolation, PET_interpolation],
+        "monthly_native": monthly_native,
+        "sources": sources,
+    }
+
+    if input_datastore is not None and tiles is not None:
+        inputs["files"] = source_file_identities(input_datastore, tiles, dates)
+
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+def read_stack_cache(stack_filename: str, fingerprint: str) -> Union[tuple, None]:
+    """
+    Open a cached stack without reading it into memory.
+
+    Args:
+        stack_filename (str): The HDF5 file of the cached stack.
+        fingerprint (str): The fingerprint of the inputs the stack is expected to be made from.
+
+    Returns:
+        Tuple[h5py.Dataset, h5py.Dataset, Affine]: The ET and PET stacks as datasets, which are read as they're
+            sliced and keep the file open until it's closed with close_stack, and the affine transformation.
+            None if there's no cache or it's unreadable, from another version, or made from other inputs.
+    """
+    if not exists(stack_filename):
+        return None
+
+    try:
+        stack_file = h5py.File(stack_filename, "r")
+    except Exception as e:
+        logger.warning(e)
+        logger.warning(f"unable to read cached stack: {cl.file(stack_filename)}")
+        return None
+
+    try:
+        if stack_file.attrs.get("version") != STACK_CACHE_VERSION:
+            logger.info(f"cached stack is from another version: {cl.file(stack_filename)}")
+            stack_file.close()
+            return None
+
+        if stack_file.attrs.get("fingerprint") != fingerprint:
+            logger.info(f"cached stack is stale: {cl.file(stack_filename)}")
+            stack_file.close()
+            return None
+
+        ET_stack = stack_file["ET"]
+        PET_stack = stack_file["PET"]
+        affine = Affine(*list(stack_file["affine"]))
+    except Exception as e:
+        logger.warning(e)
+        logger.warning(f"invalid cached stack: {cl.file(stack_filename)}")
+        stack_file.close()
+        return None
+
+    if ET_stack.shape != PET_stack.shape:
+        logger.warning(f"cached ET and PET stacks have different shapes: {cl.file(stack_filename)}")
+        stack_file.close()
+        return None
+
+    return ET_stack, PET_stack, affine
+
+
+def close_stack(*stacks):
+    """
+    Close the files of stacks loaded from the stack cache, leaving stacks that aren't backed by a cache file alone.
+    """
+    for stack in stacks:
+        if isinstance(stack, h5py.Dataset) and stack.id.valid:
+            stack.file.close()
+
+
+def write_stack_cache(
+    stack_filename: str, ET_stack: np.ndarray, PET_stack: np.ndarray, affine: Affine, fingerprint: str
+):
+    """
+    Cache a stack in a chunked, compressed HDF5 file, replacing any existing cache atomically.
+    """
+    stack_directory = dirname(abspath(stack_filename))
+    temporary_filename = f"{stack_filename}.{os.getpid()}.tmp"
+
+    try:
+        makedirs(stack_directory, exist_ok=True)
+
+        with h5py.File(temporary_filename, "w") as stack_file:
+            layers, rows, cols = ET_stack.shape
+            chunks = (layers, min(rows, STACK_CHUNK_SIZE), min(cols, STACK_CHUNK_SIZE))
+
+            for variable_name, stack in (("ET", ET_stack), ("PET", PET_stack)):
+                stack_file.create_dataset(
+                    variable_name,
+                    data=np.asarray(stack, dtype=np.float32),
+                    chunks=chunks,
+                    compression=STACK_COMPRESSION,
+                    compression_opts=STACK_COMPRESSION_LEVEL,
+                    shuffle=True,
+                )
+
+            stack_file["affine"] = (affine.a, affine.b, affine.c, affine.d, affine.e, affine.f)
+            stack_file.attrs["version"] = STACK_CACHE_VERSION
+            stack_file.attrs["fingerprint"] = fingerprint
+
+        os.replace(temporary_filename, stack_filename)
+    except Exception as e:
+        logger.warning(e)
+        logger.warning(f"unable to cache stack: {cl.file(stack_filename)}")
+
+        if exists(temporary_filename):
+            os.remove(temporary_filename)
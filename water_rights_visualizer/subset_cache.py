@@ -0,0 +1,255 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+from glob import glob
+from logging import getLogger
+from os import makedirs
+from os.path import abspath, exists, expanduser, getsize, join
+from typing import List, Tuple, Union
+
+from shapely import Polygon
+
+import cl
+from raster import Raster, RasterGrid
+
+logger = getLogger(__name__)
+
+SUBSET_CACHE_VERSION = 1
+SUBSET_CACHE_MAX_SIZE_BYTES = 20 * 1024**3
+# once the cache grows past its maximum size, it's trimmed to this share of it,
+# so that the next few subsets cached don't each trigger another scan of the cache
+SUBSET_CACHE_LOW_WATER_FRACTION = 0.8
+SUBSET_EXTENSION = ".tif"
+METADATA_EXTENSION = ".json"
+
+# running total of the size of each cache directory in this process, seeded by one scan of the directory
+CACHE_SIZES = {}
+CACHE_SIZES_LOCK = threading.Lock()
+
+
+def subset_key(
+    ROI_latlon: Polygon,
+    target_geometry: RasterGrid,
+    variable_name: str,
+    acquisition_date: str,
+    source_files: List[Tuple[str, str]],
+) -> (str, dict):
+    """
+    Address a subset by its contents: the ROI geometry, the target grid, the variable, the date,
+    and the identity of each source file it's mosaicked from.
+
+    Returns:
+        Tuple[str, dict]: The SHA-256 hex digest of the inputs, and the inputs recorded alongside a cached subset.
+    """
+    affine = target_geometry.affine
+
+    metadata = {
+        "version": SUBSET_CACHE_VERSION,
+        "ROI": hashlib.sha256(ROI_latlon.wkb).hexdigest(),
+        "grid": [affine.a, affine.b, affine.c, affine.d, affine.e, affine.f, target_geometry.rows, target_geometry.cols],
+        "CRS": str(target_geometry.crs),
+        "variable": variable_name,
+        "date": str(acquisition_date),
+        "sources": [list(source_file) for source_file in source_files],
+    }
+
+    key = hashlib.sha256(json.dumps(metadata, sort_keys=True).encode()).hexdigest()
+
+    return key, metadata
+
+
+class SubsetCache:
+    """
+    Content-addressed cache of subsets that can be shared by runs and users.
+    Each subset is a GeoTIFF named by the hash of its inputs, with a JSON file of the inputs used to validate hits.
+    The size of the cache is kept as a running total, and only once it grows past the maximum size is the cache
+    scanned and the least recently used subsets evicted.
+    """
+
+    def __init__(self, directory: str, max_size_bytes: int = None):
+        """
+        Initialize the SubsetCache object.
+
+        Args:
+            directory (str): The directory where cached subsets are kept.
+            max_size_bytes (int, optional): The size past which the least recently used subsets are evicted.
+                Defaults to SUBSET_CACHE_MAX_SIZE_BYTES.
+        """
+        if max_size_bytes is None:
+            max_size_bytes = SUBSET_CACHE_MAX_SIZE_BYTES
+
+        self.directory = abspath(expanduser(directory))
+        self.max_size_bytes = int(max_size_bytes)
+
+    def __repr__(self) -> str:
+        return f"SubsetCache(directory={self.directory!r}, max_size_bytes={self.max_size_bytes})"
+
+    def filenames(self, key: str) -> (str, str):
+        subdirectory = join(self.directory, key[:2])
+
+        return join(subdirectory, f"{key}{SUBSET_EXTENSION}"), join(subdirectory, f"{key}{METADATA_EXTENSION}")
+
+    def __contains__(self, key: str) -> bool:
+        return all(exists(filename) for filename in self.filenames(key))
+
+    def get(self, key: str, metadata: dict, **kwargs) -> Union[Raster, None]:
+        """
+        Load a cached subset, returning None if there isn't one or it wasn't made from the same inputs.
+        """
+        subset_filename, metadata_filename = self.filenames(key)
+
+        if not exists(subset_filename) or not exists(metadata_filename):
+            return None
+
+        try:
+            with open(metadata_filename, "r") as file:
+                cached_metadata = json.load(file)
+
+            if cached_metadata != metadata:
+                logger.warning(f"cached subset doesn't match its inputs: {cl.file(subset_filename)}")
+                return None
+
+            subset = Raster.open(subset_filename, **kwargs)
+        except Exception as e:
+            logger.warning(e)
+            logger.warning(f"unable to read cached subset: {cl.file(subset_filename)}")
+            return None
+
+        rows, cols = metadata["grid"][-2:]
+
+        if subset.shape != (rows, cols):
+            logger.warning(f"cached subset doesn't match its grid: {cl.file(subset_filename)}")
+            return None
+
+        # mark the entry as recently used, so that it's evicted last
+        try:
+            os.utime(subset_filename)
+        except OSError:
+            pass
+
+        return subset
+
+    def put(self, key: str, metadata: dict, subset: Raster):
+        """
+        Cache a subset, writing it to temporary files first so that other processes never see a partial entry,
+        then evict the least recently used subsets if the cache has grown past its maximum size.
+        """
+        subset_filename, metadata_filename = self.filenames(key)
+        suffix = f".{os.getpid()}.tmp"
+
+        try:
+            makedirs(os.path.dirname(subset_filename), exist_ok=True)
+            # without a preview, the GeoTIFF is the only file written for the subset
+            subset.to_geotiff(subset_filename + suffix, include_preview=False)
+            added_size = getsize(subset_filename + suffix)
+
+            # a subset cached again replaces the existing one
+            if exists(subset_filename):
+                try:
+                    added_size -= getsize(subset_filename)
+                except FileNotFoundError:
+                    pass
+
+            with open(metadata_filename + suffix, "w") as file:
+                json.dump(metadata, file)
+
+            # the metadata goes in last, since a hit requires both files
+            os.replace(subset_filename + suffix, subset_filename)
+            os.replace(metadata_filename + suffix, metadata_filename)
+        except Exception as e:
+            logger.warning(e)
+            logger.warning(f"unable to cache subset: {cl.file(subset_filename)}")
+
+            # remove the temporary files along with any sidecar files written next to them
+            for filename in glob(f"{subset_filename}.{os.getpid()}.*") + [metadata_filename + suffix]:
+                if exists(filename):
+                    os.remove(filename)
+
+            return
+
+        with CACHE_SIZES_LOCK:
+            if self.directory in CACHE_SIZES:
+                CACHE_SIZES[self.directory] += added_size
+            else:
+                CACHE_SIZES[self.directory] = self.size()
+
+            total_size = CACHE_SIZES[self.directory]
+
+        if total_size > self.max_size_bytes:
+            self.evict(keep=key)
+
+    def copy(self, key: str, filename: str):
+        """
+        Copy a cached subset to a file.
+        """
+        subset_filename, _ = self.filenames(key)
+        shutil.copyfile(subset_filename, filename)
+
+    def entries(self) -> list:
+        """
+        List the (access time, size, key) of each cached subset.
+        """
+        entries = []
+
+        if not exists(self.directory):
+            return entries
+
+        with os.scandir(self.directory) as subdirectories:
+            for subdirectory in subdirectories:
+                if not subdirectory.is_dir():
+                    continue
+
+                with os.scandir(subdirectory.path) as scan:
+                    for entry in scan:
+                        if not entry.is_file() or not entry.name.endswith(SUBSET_EXTENSION):
+                            continue
+
+                        key = entry.name[: -len(SUBSET_EXTENSION)]
+
+                        try:
+                            stat = entry.stat()
+                        except FileNotFoundError:
+                            continue
+
+                        entries.append((stat.st_mtime, stat.st_size, key))
+
+        return entries
+
+    def size(self) -> int:
+        """
+        Get the total size of the cached subsets in bytes.
+        """
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, keep: str = None):
+        """
+        Remove the least recently used subsets until the cache fits in its low-water mark below the maximum size,
+        and reset the running total of its size from the scan.
+        """
+        low_water_bytes = int(self.max_size_bytes * SUBSET_CACHE_LOW_WATER_FRACTION)
+        entries = self.entries()
+        total_size = sum(size for _, size, _ in entries)
+
+        for _, size, key in sorted(entries):
+            if total_size <= low_water_bytes:
+                break
+
+            if key == keep:
+                continue
+
+            subset_filename, metadata_filename = self.filenames(key)
+            logger.info(f"evicting cached subset: {cl.file(subset_filename)}")
+
+            # the metadata goes first, since a hit requires both files
+            for filename in (metadata_filename, subset_filename):
+                try:
+                    os.remove(filename)
+                except FileNotFoundError:
+                    pass
+
+            total_size -= size
+
+        with CACHE_SIZES_LOCK:
+            CACHE_SIZES[self.directory] = total_size
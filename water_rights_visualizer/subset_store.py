@@ -0,0 +1,152 @@
+from datetime import date
+from logging import getLogger
+from os import makedirs
+from os.path import exists, join
+from typing import Iterator, List, Tuple, Union
+
+import cl
+from raster import Raster
+
+from .constants import EXPORT_SUBSETS, SUBSET_STORE_MEMORY_BUDGET
+
+logger = getLogger(__name__)
+
+
+def subset_filename(subset_directory: str, date_step: date, ROI_name: str, variable_name: str) -> str:
+    """
+    Get the filename of the subset of a variable for a date.
+    """
+    return join(subset_directory, f"{date_step.strftime('%Y.%m.%d')}_{ROI_name}_{variable_name}_subset.tif")
+
+
+class SubsetStore:
+    """
+    The subsets of a year, kept in memory by variable and date so that the stacks and the uncertainty use them
+    directly instead of writing each one to a GeoTIFF and reading it back.
+    Subsets are written to the subset directory when exporting is requested, and once the subsets kept in memory
+    exceed the memory budget.
+
+    Attributes:
+        subset_directory (str): The directory the subsets are exported to.
+        ROI_name (str): The name of the region of interest, used in the names of the exported subsets.
+        export_subsets (bool): Whether every subset is also written to the subset directory.
+        memory_budget (int): The bytes of subsets kept in memory before the rest are written to the subset directory.
+        spill_subsets (bool): Whether the subsets beyond the memory budget are written to the subset directory,
+            instead of being dropped by runs that don't need them after the stacks.
+    """
+
+    def __init__(
+        self,
+        subset_directory: str,
+        ROI_name: str,
+        export_subsets: bool = None,
+        memory_budget: int = None,
+        spill_subsets: bool = True,
+    ):
+        if export_subsets is None:
+            export_subsets = EXPORT_SUBSETS
+
+        if memory_budget is None:
+            memory_budget = SUBSET_STORE_MEMORY_BUDGET
+
+        self.subset_directory = subset_directory
+        self.ROI_name = ROI_name
+        self.export_subsets = export_subsets
+        self.memory_budget = memory_budget
+        self.spill_subsets = spill_subsets
+        self.memory_bytes = 0
+        self._subsets = {}
+        self._filenames = {}
+
+    def __repr__(self) -> str:
+        return (
+            f"SubsetStore(subset_directory={self.subset_directory!r}, subsets={len(self)}, "
+            f"memory_bytes={self.memory_bytes}, export_subsets={self.export_subsets})"
+        )
+
+    def __len__(self) -> int:
+        return len(set(self._subsets) | set(self._filenames))
+
+    def __contains__(self, key: Tuple[str, date]) -> bool:
+        return key in self._subsets or key in self._filenames
+
+    def filename(self, variable_name: str, date_step: date) -> str:
+        """
+        Get the filename a subset is exported to.
+        """
+        return subset_filename(self.subset_directory, date_step, self.ROI_name, variable_name)
+
+    def write(self, variable_name: str, date_step: date, subset: Raster) -> str:
+        """
+        Write a subset to the subset directory, returning its filename.
+        """
+        filename = self.filename(variable_name, date_step)
+
+        if not exists(self.subset_directory):
+            logger.info(f"creating subset directory: {self.subset_directory}")
+            makedirs(self.subset_directory, exist_ok=True)
+
+        logger.info(f"writing subset: {cl.file(filename)}")
+        subset.to_geotiff(filename)
+
+        return filename
+
+    def export(self, variable_name: str, date_step: date, subset: Raster):
+        """
+        Write a subset that isn't kept to the subset directory if exporting is requested.
+        """
+        if self.export_subsets:
+            self.write(variable_name, date_step, subset)
+
+    def put(self, variable_name: str, date_step: date, subset: Raster):
+        """
+        Keep a subset, in memory unless the memory budget is used up, dropping it then if spilling is disabled.
+        """
+        key = (variable_name, date_step)
+
+        if key in self._subsets:
+            self.memory_bytes -= self._subsets.pop(key).array.nbytes
+
+        self._filenames.pop(key, None)
+        in_memory = self.memory_bytes + subset.array.nbytes <= self.memory_budget
+        spill = not in_memory and self.spill_subsets
+
+        if self.export_subsets or spill:
+            filename = self.write(variable_name, date_step, subset)
+
+        if in_memory:
+            self._subsets[key] = subset
+            self.memory_bytes += subset.array.nbytes
+        elif spill:
+            self._filenames[key] = filename
+
+    def get(self, variable_name: str, date_step: date) -> Union[Raster, None]:
+        """
+        Get the subset of a variable for a date, or None if there isn't one.
+        """
+        key = (variable_name, date_step)
+
+        if key in self._subsets:
+            return self._subsets[key]
+
+        if key in self._filenames:
+            return Raster.open(self._filenames[key])
+
+        return None
+
+    def dates(self, variable_name: str, year: int = None) -> List[date]:
+        """
+        Get the dates of the subsets of a variable in order, only those of a year if one is given.
+        """
+        return sorted(
+            date_step
+            for name, date_step in set(self._subsets) | set(self._filenames)
+            if name == variable_name and (year is None or date_step.year == year)
+        )
+
+    def items(self, variable_name: str, year: int = None) -> Iterator[Tuple[date, Raster]]:
+        """
+        Iterate over the subsets of a variable in date order, reading the ones beyond the memory budget one at a time.
+        """
+        for date_step in self.dates(variable_name, year=year):
+            yield date_step, self.get(variable_name, date_step)
@@ -0,0 +1,222 @@
+import contextlib
+import fcntl
+import hashlib
+import logging
+import os
+from os import makedirs
+from os.path import abspath, basename, exists, expanduser, getsize, join
+from typing import Callable, Union
+
+import cl
+
+logger = logging.getLogger(__name__)
+
+TILE_CACHE_MAX_SIZE_BYTES = 20 * 1024**3
+LOCK_DIRECTORY_NAME = ".locks"
+ETAG_EXTENSION = ".etag"
+TEMPORARY_EXTENSION = ".tmp"
+
+
+def normalize_etag(etag: Union[str, None]) -> Union[str, None]:
+    """
+    Strip the quotes that S3 wraps around ETags.
+    """
+    if etag is None:
+        return None
+
+    return str(etag).strip('"')
+
+
+def file_MD5(filename: str, block_size: int = 8 * 1024**2) -> str:
+    """
+    Calculate the MD5 checksum of a file.
+    """
+    checksum = hashlib.md5()
+
+    with open(filename, "rb") as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            checksum.update(block)
+
+    return checksum.hexdigest()
+
+
+class TileCache:
+    """
+    Size-bounded on-disk cache of downloaded tiles that can be shared by several processes.
+
+    Each entry is validated against the size and ETag of its S3 object instead of being opened as a raster.
+    Entries are written to a temporary file and renamed into place, and a lock file per entry keeps one process
+    from evicting or replacing a file while another is downloading or reading it.
+    The least recently used entries are evicted once the cache grows past its maximum size.
+    """
+
+    def __init__(self, directory: str, max_size_bytes: int = None):
+        """
+        Initialize the TileCache object.
+
+        Args:
+            directory (str): The directory where cached tiles are kept.
+            max_size_bytes (int, optional): The size the cache is trimmed to after each download.
+                Defaults to TILE_CACHE_MAX_SIZE_BYTES.
+        """
+        if max_size_bytes is None:
+            max_size_bytes = TILE_CACHE_MAX_SIZE_BYTES
+
+        directory = abspath(expanduser(directory))
+        makedirs(join(directory, LOCK_DIRECTORY_NAME), exist_ok=True)
+
+        self.directory = directory
+        self.max_size_bytes = int(max_size_bytes)
+
+    def __repr__(self) -> str:
+        return f"TileCache(directory={self.directory!r}, max_size_bytes={self.max_size_bytes})"
+
+    def filename(self, name: str) -> str:
+        return join(self.directory, basename(name))
+
+    def lock_filename(self, name: str) -> str:
+        return join(self.directory, LOCK_DIRECTORY_NAME, f"{basename(name)}.lock")
+
+    def read_etag(self, name: str) -> Union[str, None]:
+        etag_filename = self.filename(name) + ETAG_EXTENSION
+
+        if not exists(etag_filename):
+            return None
+
+        with open(etag_filename, "r") as file:
+            return file.read().strip()
+
+    def is_valid(self, name: str, size: int, etag: str = None) -> bool:
+        """
+        Check a cached tile against the size and ETag of its S3 object.
+        """
+        filename = self.filename(name)
+
+        if not exists(filename) or getsize(filename) != size:
+            return False
+
+        if etag is not None and self.read_etag(name) != normalize_etag(etag):
+            return False
+
+        return True
+
+    @contextlib.contextmanager
+    def fetch(self, name: str, size: int, etag: str, download: Callable[[str], None]) -> str:
+        """
+        Yield the filename of a cached tile, downloading it first if it's missing or doesn't match its S3 object.
+        The tile can't be evicted until the context is closed.
+
+        Args:
+            name (str): The name of the tile file.
+            size (int): The size of the S3 object in bytes.
+            etag (str): The ETag of the S3 object.
+            download (Callable[[str], None]): Function that downloads the S3 object to the given filename.
+
+        Yields:
+            str: The filename of the cached tile.
+        """
+        filename = self.filename(name)
+        etag = normalize_etag(etag)
+
+        with open(self.lock_filename(name), "a") as lock_file:
+            # hold the entry exclusively while it's checked and downloaded
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            try:
+                if self.is_valid(name, size, etag):
+                    logger.info(f"using cached tile: {cl.file(filename)}")
+                    os.utime(filename)
+                else:
+                    self.download(name, size, etag, download)
+                    self.evict(keep=name)
+
+                # let other processes read the entry while this one uses it
+                fcntl.flock(lock_file, fcntl.LOCK_SH)
+
+                yield filename
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def download(self, name: str, size: int, etag: str, download: Callable[[str], None]):
+        """
+        Download a tile to a temporary file, validate it and rename it into the cache.
+        """
+        filename = self.filename(name)
+        temporary_filename = f"{filename}.{os.getpid()}{TEMPORARY_EXTENSION}"
+
+        try:
+            download(temporary_filename)
+
+            if getsize(temporary_filename) != size:
+                raise IOError(f"downloaded {getsize(temporary_filename)} bytes of {size} byte tile: {name}")
+
+            # multipart ETags aren't MD5 checksums of the whole object
+            if etag is not None and "-" not in etag and file_MD5(temporary_filename) != etag:
+                raise IOError(f"checksum of downloaded tile doesn't match ETag {etag}: {name}")
+
+            if etag is not None:
+                with open(temporary_filename + ETAG_EXTENSION, "w") as file:
+                    file.write(etag)
+
+                os.replace(temporary_filename + ETAG_EXTENSION, filename + ETAG_EXTENSION)
+
+            os.replace(temporary_filename, filename)
+        finally:
+            for leftover_filename in (temporary_filename, temporary_filename + ETAG_EXTENSION):
+                if exists(leftover_filename):
+                    os.remove(leftover_filename)
+
+    def size(self) -> int:
+        """
+        Get the total size of the cached tiles in bytes.
+        """
+        return sum(entry.stat().st_size for entry in self.entries())
+
+    def entries(self) -> list:
+        with os.scandir(self.directory) as scan:
+            return [
+                entry
+                for entry in scan
+                if entry.is_file()
+                and not entry.name.endswith(ETAG_EXTENSION)
+                and not entry.name.endswith(TEMPORARY_EXTENSION)
+            ]
+
+    def evict(self, keep: str = None):
+        """
+        Remove the least recently used tiles until the cache fits in its maximum size.
+        Tiles that another process is downloading or reading are skipped.
+        """
+        entries = []
+
+        for entry in self.entries():
+            try:
+                entries.append((entry.stat().st_mtime, entry.stat().st_size, entry.name))
+            except FileNotFoundError:
+                continue
+
+        total_size = sum(size for _, size, _ in entries)
+
+        for _, size, name in sorted(entries):
+            if total_size <= self.max_size_bytes:
+                break
+
+            if name == keep:
+                continue
+
+            with open(self.lock_filename(name), "a") as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+
+                try:
+                    logger.info(f"evicting cached tile: {cl.file(self.filename(name))}")
+
+                    for filename in (self.filename(name), self.filename(name) + ETAG_EXTENSION):
+                        if exists(filename):
+                            os.remove(filename)
+
+                    total_size -= size
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
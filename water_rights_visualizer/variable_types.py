@@ -1,5 +1,7 @@
 from datetime import datetime
 
+from .constants import DEFAULT_INTERPOLATION
+
 OPENET_TRANSITION_DATE = 2008
 
 
@@ -14,6 +16,7 @@ class VariableType:
         parent_dir: str,
         start: datetime.date,
         end: datetime.date,
+        interpolation: str = DEFAULT_INTERPOLATION,
     ):
         self.name = name
         self.variable = variable
@@ -23,6 +26,7 @@ class VariableType:
         self.parent_dir = parent_dir
         self.start = start
         self.end = end
+        self.interpolation = interpolation
 
 
 VARIABLE_TYPES = [
@@ -52,6 +56,7 @@ VARIABLE_TYPES = [
         mapped_variable="ET",
         file_prefix="OPENET_ENSEMBLE_",
         monthly=True,
+        interpolation="monthly",
         parent_dir="monthly",
         start=datetime(2008, 1, 1).date(),
         end=datetime(2025, 1, 1).date(),
@@ -62,6 +67,7 @@ VARIABLE_TYPES = [
         mapped_variable="CCOUNT",
         file_prefix="OPENET_ENSEMBLE_",
         monthly=True,
+        interpolation="monthly",
         parent_dir="monthly",
         start=datetime(2008, 1, 1).date(),
         end=datetime(2025, 1, 1).date(),
@@ -72,6 +78,7 @@ VARIABLE_TYPES = [
         mapped_variable="ET_MIN",
         file_prefix="OPENET_ENSEMBLE_",
         monthly=True,
+        interpolation="monthly",
         parent_dir="uncertainty/output/2019",
         start=datetime(2008, 1, 1).date(),
         end=datetime(2025, 1, 1).date(),
@@ -82,6 +89,7 @@ VARIABLE_TYPES = [
         mapped_variable="ET_MAX",
         file_prefix="OPENET_ENSEMBLE_",
         monthly=True,
+        interpolation="monthly",
         parent_dir="uncertainty/output/2019",
         start=datetime(2008, 1, 1).date(),
         end=datetime(2025, 1, 1).date(),
@@ -92,6 +100,7 @@ VARIABLE_TYPES = [
         mapped_variable="COUNT",
         file_prefix="OPENET_PTJPL_",
         monthly=True,
+        interpolation="monthly",
         parent_dir="uncertainty/output/2019",
         start=datetime(2008, 1, 1).date(),
         end=datetime(2025, 1, 1).date(),
@@ -102,6 +111,7 @@ VARIABLE_TYPES = [
         mapped_variable="ETO",
         file_prefix="IDAHO_EPSCOR_GRIDMET_",
         monthly=True,
+        interpolation="monthly",
         parent_dir="monthly",
         start=datetime(2008, 1, 1).date(),
         end=datetime(2025, 1, 1).date(),
@@ -112,6 +122,7 @@ VARIABLE_TYPES = [
         mapped_variable="PPT",
         file_prefix="OREGON_STATE_PRISM_",
         monthly=True,
+        interpolation="monthly",
         parent_dir="precipitation",
         start=datetime(1985, 1, 1).date(),
         end=datetime(2025, 1, 1).date(),
@@ -169,3 +180,22 @@ def get_available_variable_source_for_date(variable: str, date: datetime.date) -
             return source
 
     return None
+
+
+def get_interpolation_for_year(variable: str, year: int) -> str:
+    """
+    Get the interpolation method used to fill the daily stack of a given variable and year.
+
+    Args:
+        variable (str): The variable for which to get the interpolation method.
+        year (int): The year for which to get the interpolation method.
+
+    Returns:
+        str: The interpolation method of the source available at the start of the year.
+    """
+    source = get_available_variable_source_for_date(variable, datetime(year, 1, 1).date())
+
+    if source is None:
+        return DEFAULT_INTERPOLATION
+
+    return source.interpolation
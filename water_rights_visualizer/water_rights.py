@@ -4,11 +4,11 @@ from os import makedirs
 from os.path import splitext, basename, join, exists
 from pathlib import Path
 from tkinter import Tk, Text
+from typing import Callable
 from matplotlib import pyplot as plt
 from matplotlib.backends.backend_pdf import PdfPages
 from tkinter.scrolledtext import ScrolledText
 
-import time
 import geopandas as gpd
 import numpy as np
 import pandas as pd
@@ -26,7 +26,8 @@ from .display_image_tk import display_image_tk
 from .generate_figure import generate_figure
 from .generate_stack import generate_stack
 from .process_monthly import process_monthly
-from .process_year import process_year
+from .process_years import process_years
+from .roi_context import ROIContext
 from .write_status import write_status
 
 logger = logging.getLogger(__name__)
@@ -57,6 +58,12 @@ def water_rights(
     text_panel: ScrolledText = None,
     status_filename: str = None,
     debug: bool = False,
+    subset_workers: int = None,
+    year_workers: int = None,
+    before_year: Callable[[int], bool] = None,
+    stack_memory_budget: int = None,
+    subset_cache_directory: str = None,
+    export_subsets: bool = None,
 ):
     ROI_base = splitext(basename(ROI))[0]
     DEFAULT_FIGURE_DIRECTORY = Path(f"{output_directory}/figures/{ROI_base}")
@@ -124,6 +131,8 @@ def water_rights(
     ROI_latlon = gpd.read_file(ROI).to_crs(WGS84).geometry[0]
     ROI_for_nan = list((gpd.read_file(ROI).to_crs(WGS84)).geometry)
     ROI_acres = round(ROI_area(ROI, working_directory), 2)
+    # the grid, tiles and masks of the ROI are the same for every year
+    ROI_context = ROIContext(ROI_latlon=ROI_latlon, ROI_shapes=ROI_for_nan, target_CRS=target_CRS)
 
     years_available, dates_available = input_datastore.inventory()
     monthly_means = []
@@ -139,52 +148,44 @@ def water_rights(
     else:
         years_x = [*range(int(start_year), int(end_year) + 1)]
 
-    for i, year in enumerate(years_x):
-        year_start_time = time.time()
-
-        monthly_means_df = process_year(
-            year=year,
-            dates_available=dates_available,
-            ROI=ROI,
-            ROI_latlon=ROI_latlon,
-            ROI_acres=ROI_acres,
-            ROI_for_nan=ROI_for_nan,
-            input_datastore=input_datastore,
-            input_directory=input_directory,
-            output_directory=output_directory,
-            start_year=start_year,
-            end_year=end_year,
-            start_month=start_month,
-            end_month=end_month,
-            ROI_name=ROI_name,
-            figure_directory=figure_directory,
-            working_directory=working_directory,
-            subset_directory=subset_directory,
-            nan_subset_directory=nan_subset_directory,
-            stack_directory=stack_directory,
-            monthly_sums_directory=monthly_sums_directory,
-            monthly_means_directory=monthly_means_directory,
-            monthly_nan_directory=monthly_nan_directory,
-            target_CRS=target_CRS,
-            remove_working_directory=remove_working_directory,
-            root=root,
-            text_panel=text_panel,
-            image_panel=image_panel,
-            status_filename=status_filename,
-            debug=debug,
-        )
-
-        monthly_means.append(monthly_means_df)
-
-        year_end_time = time.time()
-        total_year_time = (year_end_time - year_start_time) / 60
-
-        write_status(
-            message=f"Process Year Run Time: {total_year_time} minutes\n\n",
-            status_filename=status_filename,
-            text_panel=text_panel,
-            root=root,
-        )
+    monthly_means = process_years(
+        years=years_x,
+        year_workers=year_workers,
+        before_year=before_year,
+        dates_available=dates_available,
+        ROI=ROI,
+        ROI_latlon=ROI_latlon,
+        ROI_acres=ROI_acres,
+        ROI_for_nan=ROI_for_nan,
+        input_datastore=input_datastore,
+        input_directory=input_directory,
+        output_directory=output_directory,
+        start_year=start_year,
+        end_year=end_year,
+        start_month=start_month,
+        end_month=end_month,
+        ROI_name=ROI_name,
+        figure_directory=figure_directory,
+        working_directory=working_directory,
+        subset_directory=subset_directory,
+        nan_subset_directory=nan_subset_directory,
+        stack_directory=stack_directory,
+        monthly_sums_directory=monthly_sums_directory,
+        monthly_means_directory=monthly_means_directory,
+        monthly_nan_directory=monthly_nan_directory,
+        target_CRS=target_CRS,
+        remove_working_directory=remove_working_directory,
+        root=root,
+        text_panel=text_panel,
+        image_panel=image_panel,
+        status_filename=status_filename,
+        debug=debug,
+        subset_workers=subset_workers,
+        stack_memory_budget=stack_memory_budget,
+        subset_cache_directory=subset_cache_directory,
+        ROI_context=ROI_context,
+        export_subsets=export_subsets,
+    )
 
     metric_report_filename = join(figure_directory, f"{ROI_name}_Report.pdf")
     metric_report_pdf = PdfPages(metric_report_filename)
@@ -0,0 +1,370 @@
+import logging
+import zipfile
+from os import makedirs, scandir
+from os.path import splitext, basename, join, exists, isdir
+from typing import Dict, List, Tuple
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from shapely.geometry import Polygon, box
+from shapely.ops import unary_union
+
+import cl
+from .constants import WGS84, UTM, START_MONTH, END_MONTH, START_YEAR, END_YEAR, MONTHS_IN_YEAR
+from .constants import BATCH_OUTPUT_PADDING_PERCENTAGE
+from .data_source import DataSource
+from .date_helpers import get_one_month_slice
+from .file_path_source import FilepathSource
+from .generate_stack import generate_stack
+from .roi_context import ROIContext
+from .stack_cache import close_stack
+from .select_tiles import select_tiles
+from .subset_store import SubsetStore
+from .zonal_stats import ROI_labels, ROI_label_layers, labelled_monthly_stats
+
+logger = logging.getLogger(__name__)
+
+SQUARE_METERS_PER_ACRE = 4046.8564224
+
+
+def shapefile_in_zip(filename: str) -> str:
+    """
+    Get the path GDAL reads the first shapefile of a zip file from, wherever it is in the zip file.
+    """
+    with zipfile.ZipFile(filename) as zip_file:
+        members = [name for name in zip_file.namelist() if name.lower().endswith(".shp")]
+
+    if len(members) == 0:
+        raise IOError(f"no shapefile found in zip file: {filename}")
+
+    return f"zip://{filename}!{members[0]}"
+
+
+def read_ROI_features(boundary_filename: str, name_column: str = None) -> gpd.GeoDataFrame:
+    """
+    Read the polygons of a batch run in latitude and longitude, each with a name, from a vector file,
+    a zip file of a shapefile, or a directory of GeoJSON files.
+
+    Args:
+        boundary_filename (str): The vector file, zip file or directory.
+        name_column (str, optional): The column holding the name of each polygon.
+            Defaults to the name of the file followed by the number of the polygon in the file.
+
+    Returns:
+        gpd.GeoDataFrame: The polygons, with their names in the "ROI" column.
+    """
+    if isdir(boundary_filename):
+        filenames = sorted(entry.path for entry in scandir(boundary_filename) if entry.name.endswith(".geojson"))
+    else:
+        filenames = [boundary_filename]
+
+    features = []
+
+    for filename in filenames:
+        ROI_base = splitext(basename(filename))[0]
+        path = shapefile_in_zip(filename) if filename.lower().endswith(".zip") else filename
+        logger.info(f"loading ROIs: {cl.file(filename)}")
+        file_features = gpd.read_file(path).to_crs(WGS84)
+
+        if name_column is not None:
+            file_features["ROI"] = file_features[name_column].astype(str)
+        elif len(file_features) == 1 and len(filenames) > 1:
+            file_features["ROI"] = ROI_base
+        else:
+            file_features["ROI"] = [f"{ROI_base}_{number}" for number in range(1, len(file_features) + 1)]
+
+        features.append(file_features)
+
+    features = gpd.GeoDataFrame(pd.concat(features, ignore_index=True), crs=WGS84)
+    empty = features.geometry.is_empty | features.geometry.isna()
+
+    if empty.any():
+        logger.warning(f"skipping {int(empty.sum())} empty ROIs")
+        features = features[~empty].reset_index(drop=True)
+
+    return features
+
+
+def cluster_ROI_features(geometries: List[Polygon]) -> Dict[Tuple[str], List[int]]:
+    """
+    Group polygons by the ARD tiles they cover, so that each group shares one target grid and one pair of stacks.
+
+    Args:
+        geometries (List[Polygon]): The polygons in latitude and longitude.
+
+    Returns:
+        Dict[Tuple[str], List[int]]: The indices of the polygons covering each combination of tiles.
+    """
+    clusters = {}
+
+    for index, geometry in enumerate(geometries):
+        tiles = tuple(select_tiles(geometry))
+
+        if len(tiles) == 0:
+            logger.warning(f"no tiles found for ROI {index + 1}, skipping")
+            continue
+
+        clusters.setdefault(tiles, []).append(index)
+
+    return clusters
+
+
+def batch_monthly_means(
+    ET_stack: np.ndarray,
+    PET_stack: np.ndarray,
+    labels: List[np.ndarray],
+    ROI_names: List[str],
+    year: int,
+    start_month: int = START_MONTH,
+    end_month: int = END_MONTH,
+) -> pd.DataFrame:
+    """
+    Average the monthly sums of ET and PET within each polygon of the label images of a cluster,
+    aggregating every polygon at once. As for a single ROI, polygons that cover no cells have a mean of 0.
+
+    Args:
+        ET_stack (np.ndarray): Array of ET values for each day of the year, or for each month of the year.
+        PET_stack (np.ndarray): Array of PET values for each day of the year, or for each month of the year.
+        labels (List[np.ndarray]): The label image of each layer of polygons that don't overlap, on the grid of the
+            stacks, where 0 is outside every polygon and the labels of each layer continue from the layer before.
+        ROI_names (List[str]): The names of the polygons of labels 1 to N.
+        year (int): The year of the stacks.
+
+    Returns:
+        pd.DataFrame: The monthly sums, counts and means of each polygon.
+    """
+    # monthly stacks already hold the monthly sums
+    monthly_stack = ET_stack.shape[0] == MONTHS_IN_YEAR
+    months = list(range(start_month, end_month + 1))
+
+    def monthly_sums(stack: np.ndarray):
+        for month in months:
+            if monthly_stack:
+                start_index, end_index = month - 1, month
+            else:
+                start_index, end_index = get_one_month_slice(year, month)
+
+            yield np.nansum(stack[start_index:end_index, :, :], axis=0)
+
+    # each monthly sum is computed once and reduced to the cells of the polygons before the next one
+    return labelled_monthly_stats(
+        monthly_sums={"ET": monthly_sums(ET_stack), "PET": monthly_sums(PET_stack)},
+        labels=labels,
+        year=year,
+        months=months,
+        ROI_names=ROI_names,
+    )
+
+
+def water_rights_batch(
+    boundary_filename: str,
+    input_datastore: DataSource = None,
+    output_directory: str = None,
+    start_year: int = START_YEAR,
+    end_year: int = END_YEAR,
+    start_month: int = START_MONTH,
+    end_month: int = END_MONTH,
+    ROI_name: str = None,
+    name_column: str = None,
+    input_directory: str = None,
+    subset_directory: str = None,
+    stack_directory: str = None,
+    monthly_means_directory: str = None,
+    target_CRS: str = None,
+    subset_workers: int = None,
+    stack_memory_budget: int = None,
+    subset_cache_directory: str = None,
+) -> pd.DataFrame:
+    """
+    Calculate the monthly means of ET and PET of every polygon of a multi-polygon upload.
+    The polygons are grouped by the tiles they cover, and the stacks of each group are generated once on a grid shared
+    by its polygons, which are then averaged together from one label image instead of processing each polygon as its
+    own ROI. The monthly means of each year are written to a CSV file with one row per polygon and month once every
+    polygon of the year has them, so that a year with failed clusters is redone on the next run.
+
+    Args:
+        boundary_filename (str): The vector file, zip file of a shapefile, or directory of GeoJSON files of the polygons.
+        input_datastore (DataSource, optional): The source of the input tiles.
+            Defaults to the files in input_directory.
+        output_directory (str, optional): The directory of the outputs. Defaults to the name of the upload.
+        start_year (int, optional): The first year. Defaults to the first year available.
+        end_year (int, optional): The last year. Defaults to the last year available.
+        start_month (int, optional): The first month of each year. Defaults to START_MONTH.
+        end_month (int, optional): The last month of each year. Defaults to END_MONTH.
+        ROI_name (str, optional): The name of the upload. Defaults to the name of boundary_filename.
+        name_column (str, optional): The column holding the name of each polygon.
+            Defaults to the name of the file followed by the number of the polygon in the file.
+        input_directory (str, optional): The directory of the input tiles, used if no data source is given.
+        subset_directory (str, optional): The directory subsets are written to if they're exported.
+        stack_directory (str, optional): The directory of the stacks of each group of polygons.
+        monthly_means_directory (str, optional): The directory of the monthly means of each year.
+        target_CRS (str, optional): The coordinate reference system of the grids. Defaults to WGS84.
+        subset_workers (int, optional): The number of worker processes that generate the subsets of each date.
+        stack_memory_budget (int, optional): The memory in bytes that the stacks of a group may take.
+        subset_cache_directory (str, optional): The directory of the subset cache shared between runs.
+
+    Returns:
+        pd.DataFrame: The monthly means of each polygon for every year processed.
+    """
+    if ROI_name is None:
+        ROI_name = splitext(basename(boundary_filename.rstrip("/")))[0]
+
+    if output_directory is None:
+        output_directory = ROI_name
+
+    if input_datastore is None and input_directory is not None:
+        input_datastore = FilepathSource(directory=input_directory)
+
+    if input_datastore is None:
+        raise ValueError("no input data source given")
+
+    if subset_directory is None:
+        subset_directory = join(output_directory, "subset", ROI_name)
+
+    if stack_directory is None:
+        stack_directory = join(output_directory, "stack", ROI_name)
+
+    if monthly_means_directory is None:
+        monthly_means_directory = join(output_directory, "monthly_means", ROI_name)
+
+    if target_CRS is None:
+        target_CRS = WGS84
+
+    features = read_ROI_features(boundary_filename, name_column=name_column)
+    geometries = list(features.geometry)
+    ROI_names = list(features["ROI"])
+    logger.info(f"batch {cl.name(ROI_name)} of {len(geometries)} ROIs")
+
+    clusters = cluster_ROI_features(geometries)
+    logger.info(f"grouped ROIs into {len(clusters)} tile clusters")
+    cluster_contexts = []
+
+    # the grid of each cluster is the same for every year
+    for cluster_number, indices in enumerate(clusters.values(), start=1):
+        cluster_geometries = gpd.GeoSeries([geometries[index] for index in indices], crs=WGS84)
+        # the bounding box of the cluster keeps its grid centered on every polygon of the cluster
+        cluster_latlon = box(*unary_union(list(cluster_geometries)).bounds)
+        ROI_context = ROIContext(
+            ROI_latlon=cluster_latlon,
+            target_CRS=target_CRS,
+            output_padding_percentage=BATCH_OUTPUT_PADDING_PERCENTAGE,
+        )
+        cluster_acres = round(cluster_geometries.to_crs(UTM).area.sum() / SQUARE_METERS_PER_ACRE, 2)
+        cluster_contexts.append((f"{ROI_name}_cluster{cluster_number}", indices, ROI_context, cluster_acres))
+
+    years_available, dates_available = input_datastore.inventory()
+
+    if start_year is None:
+        start_year = sorted(years_available)[0]
+
+    if end_year is None:
+        end_year = sorted(years_available)[-1]
+
+    years = [year for year in range(int(start_year), int(end_year) + 1) if year in years_available]
+    makedirs(monthly_means_directory, exist_ok=True)
+    batch_means = {}
+
+    for year in years:
+        monthly_means_filename = join(monthly_means_directory, f"{year}_{ROI_name}_batch_monthly_means.csv")
+
+        if exists(monthly_means_filename):
+            logger.info(f"loading batch monthly means: {cl.file(monthly_means_filename)}")
+            batch_means[year] = pd.read_csv(monthly_means_filename)
+
+    remaining_years = [year for year in years if year not in batch_means]
+    year_means = {year: [] for year in remaining_years}
+    # the polygons of the clusters whose stacks failed in each year
+    year_missing_ROIs = {year: [] for year in remaining_years}
+
+    for cluster_name, indices, ROI_context, cluster_acres in cluster_contexts:
+        # the polygons of a cluster are rasterized once, on the grid shared by every year
+        labels = None
+        cluster_projected = list(gpd.GeoSeries([geometries[index] for index in indices], crs=WGS84).to_crs(target_CRS))
+        layers = ROI_label_layers(cluster_projected)
+
+        for year in remaining_years:
+            logger.info(
+                f"processing year {cl.time(year)} cluster {cl.name(cluster_name)} "
+                f"of {len(indices)} ROIs from tiles: {', '.join(ROI_context.tiles)}"
+            )
+
+            try:
+                ET_stack, PET_stack, affine = generate_stack(
+                    ROI_name=cluster_name,
+                    ROI_latlon=ROI_context.ROI_latlon,
+                    year=year,
+                    ROI_acres=cluster_acres,
+                    input_datastore=input_datastore,
+                    subset_directory=subset_directory,
+                    dates_available=dates_available,
+                    stack_filename=join(stack_directory, f"{year:04d}_{cluster_name}_stack.h5"),
+                    target_CRS=target_CRS,
+                    subset_workers=subset_workers,
+                    memory_budget=stack_memory_budget,
+                    subset_cache_directory=subset_cache_directory,
+                    ROI_context=ROI_context,
+                    # the subsets aren't needed after the stacks without the uncertainty of a report
+                    subset_store=SubsetStore(subset_directory, cluster_name, memory_budget=0, spill_subsets=False),
+                )
+            except Exception as e:
+                logger.exception(e)
+                logger.warning(f"unable to generate stack for year {cl.time(year)} at cluster {cl.name(cluster_name)}")
+                year_missing_ROIs[year].extend(ROI_names[index] for index in indices)
+                continue
+
+            try:
+                _, rows, cols = ET_stack.shape
+
+                if labels is None:
+                    labels = [
+                        ROI_labels(
+                            [cluster_projected[i] for i in layer],
+                            affine,
+                            (rows, cols),
+                            first_label=sum(len(earlier_layer) for earlier_layer in layers[:number]) + 1,
+                        )
+                        for number, layer in enumerate(layers)
+                    ]
+
+                year_means[year].append(
+                    batch_monthly_means(
+                        ET_stack=ET_stack,
+                        PET_stack=PET_stack,
+                        labels=labels,
+                        ROI_names=[ROI_names[indices[i]] for layer in layers for i in layer],
+                        year=year,
+                        start_month=start_month,
+                        end_month=end_month,
+                    )
+                )
+            finally:
+                # the stacks aren't needed after the monthly means, so a cached stack's file is closed
+                close_stack(ET_stack, PET_stack)
+
+    for year in remaining_years:
+        if len(year_missing_ROIs[year]) > 0:
+            logger.warning(
+                f"missing batch monthly means for year {cl.time(year)} "
+                f"of {len(year_missing_ROIs[year])} ROIs: {', '.join(map(str, year_missing_ROIs[year]))}"
+            )
+
+        if len(year_means[year]) == 0:
+            logger.warning(f"no monthly means for year {cl.time(year)}")
+            continue
+
+        monthly_means_filename = join(monthly_means_directory, f"{year}_{ROI_name}_batch_monthly_means.csv")
+        batch_means[year] = pd.concat(year_means[year], ignore_index=True)[["ROI", "Year", "Month", "ET", "PET"]]
+
+        # an existing file marks the year as done, so a year with missing ROIs is left to be redone on the next run
+        if len(year_missing_ROIs[year]) > 0:
+            logger.warning(f"not writing batch monthly means for incomplete year {cl.time(year)}")
+            continue
+
+        logger.info(f"writing batch monthly means: {cl.file(monthly_means_filename)}")
+        batch_means[year].to_csv(monthly_means_filename, index=False)
+
+    if len(batch_means) == 0:
+        return pd.DataFrame(columns=["ROI", "Year", "Month", "ET", "PET"])
+
+    return pd.concat([batch_means[year] for year in sorted(batch_means)], ignore_index=True)
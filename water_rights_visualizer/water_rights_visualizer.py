@@ -5,11 +5,13 @@ import sys
 from os import makedirs, scandir
 from os.path import basename, isdir, splitext, abspath, exists, isfile, expanduser, join, dirname
 from pathlib import Path
+from typing import Callable
 
 import matplotlib as mpl
 
 import cl
 from .water_rights import water_rights
+from .water_rights_batch import water_rights_batch
 from .constants import *
 from .data_source import DataSource
 from .file_path_source import FilepathSource
@@ -42,6 +44,13 @@ def water_rights_visualizer(
     end_month: int = END_MONTH,
     status_filename: str = None,
     debug=False,
+    subset_workers: int = None,
+    year_workers: int = None,
+    before_year: Callable[[int], bool] = None,
+    stack_memory_budget: int = None,
+    subset_cache_directory: str = None,
+    export_subsets: bool = None,
+    batch: bool = False,
 ):
     boundary_filename = abspath(expanduser(boundary_filename))
     output_directory = abspath(expanduser(output_directory))
@@ -86,7 +95,23 @@ def water_rights_visualizer(
     TILE_SELECTION_BUFFER_RADIUS_DEGREES = 0.01
     ARD_TILES_FILENAME = join(abspath(dirname(__file__)), "ARD_tiles.geojson")
 
-    if isfile(ROI):
+    if batch:
+        # every polygon of the file, or of the GeoJSON files of the directory, shares the stacks of its tiles
+        water_rights_batch(
+            str(ROI),
+            input_datastore=input_datastore,
+            output_directory=output_directory,
+            start_year=start_year,
+            end_year=end_year,
+            start_month=start_month,
+            end_month=end_month,
+            monthly_means_directory=monthly_means_directory,
+            subset_workers=subset_workers,
+            stack_memory_budget=stack_memory_budget,
+            subset_cache_directory=subset_cache_directory,
+        )
+
+    elif isfile(ROI):
         water_rights(
             ROI,
             input_datastore=input_datastore,
@@ -107,6 +132,12 @@ def water_rights_visualizer(
             target_CRS=None,
             status_filename=status_filename,
             debug=debug,
+            subset_workers=subset_workers,
+            year_workers=year_workers,
+            before_year=before_year,
+            stack_memory_budget=stack_memory_budget,
+            subset_cache_directory=subset_cache_directory,
+            export_subsets=export_subsets,
         )
 
     elif isdir(ROI):
@@ -133,6 +164,12 @@ def water_rights_visualizer(
                     target_CRS=None,
                     status_filename=status_filename,
                     debug=debug,
+                    subset_workers=subset_workers,
+                    year_workers=year_workers,
+                    before_year=before_year,
+                    stack_memory_budget=stack_memory_budget,
+                    subset_cache_directory=subset_cache_directory,
+                    export_subsets=export_subsets,
                 )
     else:
         logger.warning(f"invalid ROI: {ROI}")
@@ -179,6 +216,28 @@ def main(argv=sys.argv):
     else:
         end_year = None
 
+    if "--subset-workers" in argv:
+        subset_workers = int(argv[argv.index("--subset-workers") + 1])
+    else:
+        subset_workers = None
+
+    if "--year-workers" in argv:
+        year_workers = int(argv[argv.index("--year-workers") + 1])
+    else:
+        year_workers = None
+
+    if "--stack-memory-budget-GB" in argv:
+        stack_memory_budget = int(float(argv[argv.index("--stack-memory-budget-GB") + 1]) * 1024**3)
+    else:
+        stack_memory_budget = None
+
+    if "--subset-cache-directory" in argv:
+        subset_cache_directory = str(argv[argv.index("--subset-cache-directory") + 1])
+    else:
+        subset_cache_directory = None
+
+    export_subsets = "--export-subsets" in argv
+    batch = "--batch" in argv
     debug = "--debug" in argv
 
     water_rights_visualizer(
@@ -191,6 +250,12 @@ def main(argv=sys.argv):
         start_year=start_year,
         end_year=end_year,
         debug=debug,
+        subset_workers=subset_workers,
+        year_workers=year_workers,
+        stack_memory_budget=stack_memory_budget,
+        subset_cache_directory=subset_cache_directory,
+        export_subsets=export_subsets,
+        batch=batch,
     )
 
 
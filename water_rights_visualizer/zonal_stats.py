@@ -0,0 +1,216 @@
+from functools import lru_cache
+from logging import getLogger
+from typing import Dict, Iterable, List, Tuple, Union
+
+import numpy as np
+import pandas as pd
+import shapely
+from shapely import STRtree
+from affine import Affine
+from rasterio.features import geometry_mask, rasterize
+from shapely.geometry import Polygon
+from shapely.geometry.base import BaseGeometry
+
+logger = getLogger(__name__)
+
+# number of distinct ROI and grid combinations whose masks are remembered in each process
+ROI_MASK_CACHE_SIZE = 64
+
+
+@lru_cache(maxsize=ROI_MASK_CACHE_SIZE)
+def ROI_mask_for_WKB(shapes_WKB: Tuple[bytes], affine: Tuple[float], shape: Tuple[int, int]) -> np.ndarray:
+    logger.info("rasterizing ROI")
+    shapes = [shapely.from_wkb(shape_WKB) for shape_WKB in shapes_WKB]
+    mask = geometry_mask(shapes, shape, Affine(*affine), invert=True)
+    # the same mask is handed to every caller
+    mask.setflags(write=False)
+
+    return mask
+
+
+def ROI_mask(ROI_geometry: Union[Polygon, List[Polygon]], affine: Affine, shape: Tuple[int, int]) -> np.ndarray:
+    """
+    Get the mask of the cells of a grid inside the ROI, rasterizing each ROI once per grid.
+
+    Args:
+        ROI_geometry (Union[Polygon, List[Polygon]]): The ROI, or the shapes of the ROI, in the CRS of the grid.
+        affine (Affine): The affine transformation of the grid.
+        shape (Tuple[int, int]): The rows and columns of the grid.
+
+    Returns:
+        np.ndarray: A read-only boolean array that's True inside the ROI.
+    """
+    shapes = [ROI_geometry] if isinstance(ROI_geometry, BaseGeometry) else list(ROI_geometry)
+
+    return ROI_mask_for_WKB(tuple(shape.wkb for shape in shapes), tuple(affine)[:6], tuple(shape))
+
+
+def ROI_values(array: np.ndarray, mask: np.ndarray, nodata=None) -> np.ndarray:
+    """
+    Get the values of an array inside the ROI mask that are neither NaN nor nodata.
+    """
+    values = np.asarray(array)[mask]
+
+    if nodata is not None:
+        values = values[values != nodata]
+
+    return values[~np.isnan(values)]
+
+
+def ROI_count(array: np.ndarray, mask: np.ndarray, nodata=None) -> int:
+    """
+    Count the values of an array inside the ROI mask that are neither NaN nor nodata.
+    """
+    return len(ROI_values(array, mask, nodata))
+
+
+def ROI_mean(array: np.ndarray, mask: np.ndarray, nodata=None) -> float:
+    """
+    Average the values of an array inside the ROI mask that are neither NaN nor nodata,
+    which is NaN if there are none.
+    """
+    return np.mean(ROI_values(array, mask, nodata))
+
+
+def ROI_nan_fraction(array: np.ndarray, mask: np.ndarray) -> float:
+    """
+    Get the fraction of the cells inside the ROI mask that are NaN.
+    """
+    return np.count_nonzero(np.isnan(np.asarray(array)[mask])) / np.count_nonzero(mask)
+
+
+def ROI_labels(
+    ROI_geometries: List[Polygon],
+    affine: Affine,
+    shape: Tuple[int, int],
+    first_label: int = 1,
+) -> np.ndarray:
+    """
+    Rasterize several ROIs into one label image, where the cells of the ROI at index i are labelled i + first_label
+    and the cells outside every ROI are labelled 0.
+    Where ROIs overlap, each cell belongs to the last of them, so overlapping ROIs are split by ROI_label_layers.
+
+    Args:
+        ROI_geometries (List[Polygon]): The ROIs in the CRS of the grid.
+        affine (Affine): The affine transformation of the grid.
+        shape (Tuple[int, int]): The rows and columns of the grid.
+        first_label (int, optional): The label of the first ROI, for label images that continue from another.
+            Defaults to 1.
+
+    Returns:
+        np.ndarray: An integer array of the label of each cell.
+    """
+    logger.info(f"rasterizing {len(ROI_geometries)} ROIs")
+
+    return rasterize(
+        ((geometry, label) for label, geometry in enumerate(ROI_geometries, start=first_label)),
+        out_shape=tuple(shape),
+        transform=affine,
+        fill=0,
+        dtype="int32",
+    )
+
+
+def ROI_label_layers(ROI_geometries: List[Polygon]) -> List[List[int]]:
+    """
+    Split ROIs into layers of ROIs that don't overlap each other, so that every ROI keeps all of its cells
+    in the label image of its layer. ROIs that only touch share a layer.
+
+    Args:
+        ROI_geometries (List[Polygon]): The ROIs.
+
+    Returns:
+        List[List[int]]: The indices of the ROIs of each layer, most of them in the first layer.
+    """
+    tree = STRtree(ROI_geometries)
+    layer_of_ROI = {}
+    layers = []
+
+    for index, geometry in enumerate(ROI_geometries):
+        overlapping_layers = {
+            layer_of_ROI[other]
+            for other in tree.query(geometry, predicate="intersects")
+            if other in layer_of_ROI and not geometry.touches(ROI_geometries[other])
+        }
+
+        layer = next(layer for layer in range(len(layers) + 1) if layer not in overlapping_layers)
+
+        if layer == len(layers):
+            layers.append([])
+
+        layers[layer].append(index)
+        layer_of_ROI[index] = layer
+
+    return layers
+
+
+def labelled_monthly_stats(
+    monthly_sums: Dict[str, Iterable[np.ndarray]],
+    labels: Union[np.ndarray, List[np.ndarray]],
+    year: int,
+    months: List[int],
+    ROI_names: List[str] = None,
+) -> pd.DataFrame:
+    """
+    Aggregate the monthly sums of each variable within every ROI of a label raster, reducing the labelled cells of
+    every month at once. Overlapping ROIs are given as several label rasters, one for each layer of ROI_label_layers,
+    numbered on from each other so that each ROI has a label of its own.
+
+    The mean of a ROI is NaN if all of its cells are NaN, and 0 if it doesn't cover any cells.
+
+    Args:
+        monthly_sums (Dict[str, Iterable[np.ndarray]]): The monthly sums of each variable, one layer for each month on
+            the grid of the labels, which are read one layer at a time.
+        labels (Union[np.ndarray, List[np.ndarray]]): The label raster, or the label raster of each layer of ROIs,
+            where 0 is outside every ROI and the ROI at index i is labelled i + 1.
+        year (int): The year of the monthly sums.
+        months (List[int]): The month of each layer of the monthly sums.
+        ROI_names (List[str], optional): The name of each ROI. Defaults to the labels.
+
+    Returns:
+        pd.DataFrame: One row per ROI and month with the columns ROI, Year and Month, and the sum, the number of values
+            and the mean of each variable, named {variable}_sum, {variable}_count and {variable}.
+    """
+    label_layers = [labels] if isinstance(labels, np.ndarray) and labels.ndim == 2 else list(labels)
+    insides = [np.asarray(layer) > 0 for layer in label_layers]
+    cell_labels = np.concatenate(
+        [np.asarray(layer)[inside].astype(np.intp) - 1 for layer, inside in zip(label_layers, insides)]
+    )
+
+    if ROI_names is None:
+        ROI_names = list(range(1, max(int(np.max(layer, initial=0)) for layer in label_layers) + 1))
+
+    count = len(ROI_names)
+    month_count = len(months)
+    cells = np.tile(np.bincount(cell_labels, minlength=count), month_count)
+    # each month of each ROI is a bin of its own, so the (months, cells) cube is reduced in one pass
+    bins = (np.arange(month_count)[:, np.newaxis] * count + cell_labels).ravel()
+
+    stats = {
+        "ROI": np.tile(np.asarray(ROI_names, dtype=object), month_count),
+        "Year": year,
+        "Month": np.repeat(months, count),
+    }
+
+    for variable_name, layers in monthly_sums.items():
+        # only the labelled cells of each month are kept
+        values = np.stack([np.concatenate([np.asarray(layer)[inside] for inside in insides]) for layer in layers])
+
+        if values.shape[0] != month_count:
+            raise ValueError(f"{values.shape[0]} monthly {variable_name} layers given for {month_count} months")
+
+        values = values.ravel()
+        valid = ~np.isnan(values)
+        sums = np.bincount(bins[valid], weights=values[valid], minlength=month_count * count)
+        valid_counts = np.bincount(bins[valid], minlength=month_count * count)
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = (sums / valid_counts).astype(values.dtype)
+
+        means[cells == 0] = 0
+
+        stats[f"{variable_name}_sum"] = sums
+        stats[f"{variable_name}_count"] = valid_counts
+        stats[variable_name] = means
+
+    return pd.DataFrame(stats)